@@ -0,0 +1,65 @@
+"""Specifies the CompressCache class."""
+
+# Standard library imports
+from __future__ import print_function # For python earlier than 3
+import collections
+import threading
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def shared(settings):
+	"""Return this process's CompressCache, setting it up the first time.
+
+		settings - a dictionary which may have key compresscachesize (bytes, 0
+							 to turn caching off).
+
+	"""
+	global _shared
+	with _shared_lock:
+		if _shared is None:
+			_shared = CompressCache(int(settings.get("compresscachesize",
+																							 8*1024*1024)))
+		return _shared
+
+class CompressCache():
+	"""A least recently used cache of compressed responses.
+
+	Responses are keyed by the ETag of what was compressed and the content
+	coding, so a response that's changed is never mistaken for the old one.
+	No one response may take more than a quarter of the cache.
+
+	"""
+
+	def __init__(self, maxbytes):
+		"""Setup a cache holding at most maxbytes of compressed data."""
+		self._maxbytes = maxbytes
+		self._entries = collections.OrderedDict()	# Least recently used first
+		self._size = 0
+		self._lock = threading.Lock()
+
+	def get(self, etag, coding):
+		"""Return the cached compressed data for etag and coding, or None."""
+		with self._lock:
+			data = self._entries.pop((etag, coding), None)
+			if data is not None:
+				self._entries[(etag, coding)] = data
+			return data
+
+	def put(self, etag, coding, data):
+		"""Keep compressed data for etag and coding, if it's not too big."""
+		if not self.fits(len(data)):
+			return
+		with self._lock:
+			old = self._entries.pop((etag, coding), None)
+			if old is not None:
+				self._size -= len(old)
+			self._entries[(etag, coding)] = data
+			self._size += len(data)
+			while self._size > self._maxbytes:
+				key, old = self._entries.popitem(last=False)
+				self._size -= len(old)
+
+	def fits(self, size):
+		"""Return True if a response of size bytes may be cached."""
+		return size <= self._maxbytes // 4
@@ -0,0 +1,118 @@
+"""Functions for choosing and applying HTTP content codings."""
+
+# Standard library imports
+from __future__ import print_function # For python earlier than 3
+import os.path
+import zlib
+try:
+	import brotli
+except ImportError:
+	brotli = None  # Brotli isn't offered
+try:
+	import zstandard
+except ImportError:
+	zstandard = None  # Zstandard isn't offered
+
+# Content codings
+IDENTITY = "identity"
+GZIP = "gzip"
+BROTLI = "br"
+ZSTD = "zstd"
+
+# Bodies smaller than this aren't worth compressing
+MIN_SIZE = 1024
+# How much of a file is compressed to judge if the rest will compress
+SAMPLE_SIZE = 65536
+# Files whose sample doesn't shrink below this fraction are sent as they are
+_MAX_RATIO = 0.9
+# Extensions of formats that are compressed already
+_COMPRESSED_EXTENSIONS = frozenset([
+	".7z", ".apk", ".avi", ".br", ".bz2", ".docx", ".flac", ".gif", ".gz",
+	".heic", ".jar", ".jpeg", ".jpg", ".lz4", ".m4a", ".m4v", ".mkv", ".mov",
+	".mp3", ".mp4", ".ogg", ".png", ".pptx", ".rar", ".tgz", ".webm", ".webp",
+	".woff", ".woff2", ".xlsx", ".xz", ".zip", ".zst"])
+
+def available():
+	"""Return the content codings this server can produce, best first."""
+	codings = [GZIP]
+	if zstandard is not None:
+		codings.insert(0, ZSTD)
+	if brotli is not None:
+		codings.insert(0, BROTLI)
+	return codings
+
+def negotiate(acceptencoding, offered):
+	"""Return which of the codings offered (best first) an Accept-Encoding
+		header value prefers, or IDENTITY if it accepts none of them.
+
+		Codings with a higher q value win, and ties go to the earlier offer.
+
+	"""
+	weights = dict()
+	for part in acceptencoding.split(","):
+		fields = part.split(";")
+		coding = fields[0].strip().lower()
+		weight = 1.0
+		for field in fields[1:]:
+			name, sep, value = field.partition("=")
+			if name.strip().lower() == "q":
+				try:
+					weight = float(value)
+				except ValueError:
+					weight = 0.0
+		if coding:
+			weights[coding] = weight
+	best = IDENTITY
+	bestweight = 0.0
+	for coding in offered:
+		weight = weights.get(coding, weights.get("*", 0.0))
+		if weight > bestweight:
+			best = coding
+			bestweight = weight
+	return best
+
+def compress(data, coding):
+	"""Return data compressed with a content coding, as small as it can be.
+		This is slow, so it's for data that's compressed once and sent often."""
+	if coding == BROTLI:
+		return brotli.compress(data)
+	if coding == ZSTD:
+		return zstandard.ZstdCompressor(level=19).compress(data)
+	# wbits of 16 plus the window size asks zlib for a gzip wrapper
+	compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	return compressor.compress(data) + compressor.flush()
+
+def compressor(coding):
+	"""Return an object compressing a stream with a content coding, quickly
+		enough to keep up with a network connection.
+
+		Its compress(data) method returns the compressed data that's ready, and
+		flush() returns the rest once all the data is in.
+
+	"""
+	if coding == BROTLI:
+		return _BrotliCompressor()
+	if coding == ZSTD:
+		return zstandard.ZstdCompressor(level=3).compressobj()
+	return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def worth_compressing(filename, sample):
+	"""Return True if a file is worth compressing, judging by its name and a
+		sample of its contents (its first SAMPLE_SIZE bytes)."""
+	extension = os.path.splitext(filename)[1].lower()
+	if extension in _COMPRESSED_EXTENSIONS or len(sample) < MIN_SIZE:
+		return False
+	compressed = zlib.compress(sample, 1)
+	return len(compressed) < len(sample) * _MAX_RATIO
+
+class _BrotliCompressor():
+	"""Give a brotli stream compressor the same methods as zlib's"""
+
+	def __init__(self):
+		self._compressor = brotli.Compressor(quality=5)
+
+	def compress(self, data):
+		return self._compressor.process(data)
+
+	def flush(self):
+		return self._compressor.finish()
@@ -0,0 +1,177 @@
+"""Specifies the DedupeStore class."""
+
+# Standard library imports
+from __future__ import print_function # For python earlier than 3
+import errno
+import os
+import sys
+import threading
+try:
+	import fcntl
+except ImportError:
+	fcntl = None  # No reflinks
+
+# Local imports
+import Digest
+
+# Ways stored content can be shared with an upload
+REFLINK = "reflink"
+HARDLINK = "hardlink"
+
+# The Linux ioctl making a file share another's blocks, copy-on-write
+_FICLONE = 0x40049409
+# Errors from os.link meaning the store and the file can't share an inode
+_NO_LINK = tuple(getattr(errno, name) for name in
+								 ("EPERM", "EXDEV", "EOPNOTSUPP", "ENOTSUP", "EMLINK")
+								 if hasattr(errno, name))
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def shared(settings):
+	"""Return this process's DedupeStore, setting it up the first time.
+
+		settings - a dictionary which may have keys dedupedir (the store's
+							 directory, empty for no store) and dedupelink (reflink or
+							 hardlink).
+
+	"""
+	global _shared
+	with _shared_lock:
+		if _shared is None:
+			_shared = DedupeStore(settings.get("dedupedir", "").strip(),
+														settings.get("dedupelink", REFLINK).strip().lower())
+		return _shared
+
+class DedupeStore():
+	"""Keep one copy of each uploaded file's content, named by its digest.
+
+	Uploads are published as usual and then added to the store.  An upload
+	whose content is stored already is made a copy of the stored one instead,
+	so its blocks are only on disk once.  Reflinks (on filesystems such as
+	Btrfs and XFS) share blocks copy-on-write, so every copy stays
+	independent.  Hard links work on any filesystem, but they're one file under
+	several names - changing one in place changes them all.  A stored copy is
+	only used while its digest is still valid, so one changed that way is
+	ignored.
+
+	Data items:
+		enabled - get - Whether there's a store at all
+
+	"""
+
+	def __init__(self, directory, method):
+		"""Setup a store in directory, sharing content by method (REFLINK or
+			HARDLINK).  With no directory nothing is stored."""
+		self._directory = directory
+		self._method = HARDLINK if method == HARDLINK else REFLINK
+		self._lock = threading.Lock()
+
+	def place(self, filepath, algorithm, hexdigest, size):
+		"""Create filepath as a copy of the stored content with the digest and
+			size given, without replacing anything already there.
+
+			Returns True if the file was created, False if the store hasn't got
+			the content or can't share it with filepath.
+
+			Throws: OSError (EEXIST if filepath is taken)
+
+		"""
+		storepath = self._stored(algorithm, hexdigest, size)
+		if storepath is None:
+			return False
+		if self._method == HARDLINK:
+			try:
+				os.link(storepath, filepath)
+			except OSError as e:
+				if e.errno in _NO_LINK:
+					return False
+				raise
+		elif not self._clone(storepath, filepath):
+			return False
+		Digest.record(filepath, algorithm, hexdigest)
+		return True
+
+	def add(self, filepath, algorithm, hexdigest):
+		"""Put a published file's content in the store, unless it's there
+			already.  Returns True if it was added."""
+		if not self._directory:
+			return False
+		try:
+			size = os.stat(filepath).st_size
+			if self._stored(algorithm, hexdigest, size) is not None:
+				return False
+			storepath = self._path(algorithm, hexdigest)
+			self._make_directory(os.path.dirname(storepath))
+			with self._lock:
+				newpath = storepath + ".new" + str(os.getpid())
+				if os.path.lexists(newpath):
+					os.unlink(newpath)	# Left by a crash
+				if self._method == HARDLINK:
+					os.link(filepath, newpath)
+				elif not self._clone(filepath, newpath):
+					return False
+				try:
+					if hasattr(os, "replace"):
+						os.replace(newpath, storepath)
+					else:
+						os.rename(newpath, storepath)
+				except OSError:
+					os.unlink(newpath)
+					raise
+				return Digest.record(storepath, algorithm, hexdigest)
+		except OSError:
+			return False  # The store is unusable, or can't share with the file
+
+	def _get_enabled(self):
+		return bool(self._directory)
+
+	enabled = property(_get_enabled)
+
+	# Return the path content with a digest is stored at
+	def _path(self, algorithm, hexdigest):
+		return os.path.join(self._directory, algorithm, hexdigest[:2], hexdigest)
+
+	# Return the path of the stored content with a digest and size, or None if
+	# it's not there or has changed since it was stored
+	def _stored(self, algorithm, hexdigest, size):
+		if not self._directory:
+			return None
+		storepath = self._path(algorithm, hexdigest)
+		try:
+			storestat = os.stat(storepath)
+		except OSError:
+			return None
+		if (storestat.st_size != size or
+				Digest.lookup(storepath, storestat) != (algorithm, hexdigest)):
+			return None
+		return storepath
+
+	# Create a directory and any missing parents, if it isn't there already
+	def _make_directory(self, directory):
+		try:
+			os.makedirs(directory)
+		except OSError as e:
+			if e.errno != errno.EEXIST:
+				raise
+
+	# Create destpath sharing the blocks of srcpath.  Returns False if the
+	# filesystem can't, leaving nothing behind
+	def _clone(self, srcpath, destpath):
+		if fcntl is None or not sys.platform.startswith("linux"):
+			return False
+		srcfd = os.open(srcpath, os.O_RDONLY)
+		try:
+			destfd = os.open(destpath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+			try:
+				fcntl.ioctl(destfd, _FICLONE, srcfd)
+				cloned = True
+			except (IOError, OSError):
+				cloned = False
+			finally:
+				os.close(destfd)
+			if not cloned:
+				os.unlink(destpath)
+			return cloned
+		finally:
+			os.close(srcfd)
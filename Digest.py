@@ -0,0 +1,122 @@
+"""Functions for hashing uploads and keeping the digests with the files."""
+
+# Standard library imports
+from __future__ import print_function # For python earlier than 3
+import base64
+import binascii
+import hashlib
+import os
+import re
+
+# The extended attribute a file's digest is kept in, where there are any
+XATTR_NAME = "user.frontporch.digest"
+# Otherwise it's kept in a hidden file beside it, named for it plus this
+SIDECAR_SUFFIX = ".digest"
+# How much of a file is read at a time when hashing it from disk
+READ_SIZE = 1024*1024
+
+# A digest as "<algorithm>:<hex digest>"
+_DIGEST_RE = re.compile(r"^([a-z0-9_]+):((?:[0-9a-f]{2})+)$")
+# What digests are called in a Repr-Digest header, where they have a name
+_HTTP_NAMES = {"sha256": "sha-256", "sha512": "sha-512"}
+
+def new(algorithm):
+	"""Return a new hash object for algorithm, or None if this Python hasn't
+		got it."""
+	try:
+		return hashlib.new(algorithm)
+	except (ValueError, TypeError):
+		return None
+
+def parse(text):
+	"""Split a digest given as "<algorithm>:<hex digest>" into its algorithm
+		and hex digest, both lowercase.  Returns None if it's not in that form."""
+	match = _DIGEST_RE.match(text.strip().lower())
+	if match is None:
+		return None
+	return match.group(1), match.group(2)
+
+def hash_file(fileno, hasher, start, end):
+	"""Feed bytes start up to end of an open file to hasher.  The file's
+		position is changed if the OS can't read at an offset."""
+	pos = start
+	while pos < end:
+		amount = min(READ_SIZE, end - pos)
+		if hasattr(os, "pread"):
+			data = os.pread(fileno, amount, pos)
+		else:
+			os.lseek(fileno, pos, os.SEEK_SET)
+			data = os.read(fileno, amount)
+		if not data:
+			break  # The file is shorter than expected
+		hasher.update(data)
+		pos += len(data)
+
+def record(filepath, algorithm, hexdigest):
+	"""Keep a file's digest with it, in an extended attribute if the
+		filesystem has them or a sidecar file if not.  Returns True if it was
+		kept."""
+	try:
+		stamp = _mtime_stamp(os.stat(filepath))
+	except OSError:
+		return False
+	value = (algorithm + ":" + hexdigest + " " + stamp).encode("ascii")
+	if hasattr(os, "setxattr"):
+		try:
+			os.setxattr(filepath, XATTR_NAME, value)
+			return True
+		except OSError:
+			pass  # Not supported here
+	try:
+		with open(_sidecar_path(filepath), "wb") as f:
+			f.write(value + b"\n")
+	except (IOError, OSError):
+		return False
+	return True
+
+def lookup(filepath, filestat):
+	"""Return the (algorithm, hex digest) kept with a file, or None.  filestat
+		is the file's stat result - a digest kept before the file was last
+		modified is ignored, as the file has changed since."""
+	value = None
+	if hasattr(os, "getxattr"):
+		try:
+			value = os.getxattr(filepath, XATTR_NAME)
+		except OSError:
+			pass  # It has none, or they're not supported
+	if value is None:
+		sidecar = _sidecar_path(filepath)
+		try:
+			with open(sidecar, "rb") as f:
+				value = f.read(256)
+		except (IOError, OSError):
+			return None
+	try:
+		digest, sep, stamp = value.decode("ascii").strip().partition(" ")
+	except UnicodeDecodeError:
+		return None
+	if stamp != _mtime_stamp(filestat):
+		return None
+	return parse(digest)
+
+def is_sidecar(name):
+	"""Return True if the file name is that of a sidecar holding a digest."""
+	return (name.startswith(".") and name.endswith(SIDECAR_SUFFIX) and
+					len(name) > len(SIDECAR_SUFFIX) + 1)
+
+def header(algorithm, hexdigest):
+	"""Return a Repr-Digest header line giving a file's digest."""
+	name = _HTTP_NAMES.get(algorithm, algorithm)
+	encoded = base64.b64encode(binascii.unhexlify(hexdigest)).decode("ascii")
+	return "Repr-Digest: " + name + "=:" + encoded + ":\r\n"
+
+# Return a file's modification time as text, as precisely as the OS gives it
+def _mtime_stamp(filestat):
+	if hasattr(filestat, "st_mtime_ns"):
+		return str(filestat.st_mtime_ns)
+	return repr(filestat.st_mtime)
+
+# Return the path of the sidecar file holding a file's digest
+def _sidecar_path(filepath):
+	directory, name = os.path.split(filepath)
+	return os.path.join(directory, "." + name + SIDECAR_SUFFIX)
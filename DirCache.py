@@ -0,0 +1,265 @@
+"""Specifies the DirCache class."""
+
+# Standard library imports
+from __future__ import print_function # For python earlier than 3
+import collections
+import errno
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+try:
+	import ctypes
+	import ctypes.util
+except ImportError:
+	ctypes = None  # No inotify - directories are always checked by mtime
+
+# inotify flags, from <sys/inotify.h>
+_IN_ATTRIB = 0x4
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_DELETE_SELF = 0x400
+_IN_MOVE_SELF = 0x800
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_IN_ONLYDIR = 0x1000000
+_IN_CLOEXEC = 0o2000000
+# Anything that changes what a listing shows.  Plain writes are left out - a
+# file's new size shows up when it's closed
+_WATCH_MASK = (_IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO |
+							 _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF |
+							 _IN_ONLYDIR)
+# An inotify event is a header of wd, mask, cookie and name length, then a name
+_EVENT_HEADER = struct.Struct("iIII")
+# A directory changed this recently may change again without its mtime moving
+# on, so listings built that soon after a change are rebuilt next time
+_MTIME_SLACK = 1.0
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def shared(settings):
+	"""Return this process's DirCache, setting it up the first time.
+
+		settings - a dictionary which may have keys dircachesize (bytes, 0 to
+							 turn caching off) and dircachebackend (mtime or inotify).
+
+	"""
+	global _shared
+	with _shared_lock:
+		if _shared is None:
+			backend = settings.get("dircachebackend", "mtime").lower()
+			_shared = DirCache(int(settings.get("dircachesize", 16*1024*1024)),
+												 backend == "inotify")
+		return _shared
+
+class _Entry():
+	"""A cached listing and what's needed to tell if it's still current"""
+
+	def __init__(self, value, size, stamp, trusted, watched):
+		self.value = value
+		self.size = size	# Roughly how many bytes value takes up
+		self.stamp = stamp	# The directory's stat details when it was listed
+		self.trusted = trusted	# Whether a matching stamp means it's current
+		self.watched = watched	# Whether inotify will report changes to it
+
+class DirCache():
+	"""A least recently used cache of directory listings.
+
+	Listings are kept until the memory bound is reached, in whatever form
+	they're built in so a cache hit needs no more work.  Normally a listing is
+	checked against the directory's mtime, costing one stat per view.  With the
+	inotify backend (Linux only) the kernel reports changes instead, so a view
+	costs nothing and changes to the files listed are picked up too.
+
+	"""
+
+	def __init__(self, maxbytes, useinotify=False):
+		"""Setup a cache holding at most maxbytes of listings."""
+		self._maxbytes = maxbytes
+		self._entries = collections.OrderedDict()	# Least recently used first
+		self._size = 0
+		self._changes = 0	# Counts invalidations, to spot them during a build
+		self._lock = threading.Lock()
+		self._watcher = None
+		if useinotify and maxbytes > 0:
+			self._watcher = _InotifyWatcher.start(self.invalidate)
+			if self._watcher is None:
+				logging.warning("DirCache: inotify unavailable, using mtime checks")
+
+	def get(self, path, build, sizeof=len):
+		"""Return the listing for directory path, calling build(path) for it if
+			there isn't a current one cached.
+
+			sizeof(listing) should say roughly how many bytes a listing build
+			returns takes up.  Errors from build are left for the caller.
+
+		"""
+		if self._maxbytes <= 0:
+			return build(path)
+		with self._lock:
+			entry = self._entries.pop(path, None)
+			if entry is not None:
+				self._entries[path] = entry
+			changes = self._changes
+		if entry is not None and entry.watched:
+			return entry.value
+		watched = self._watcher is not None and self._watcher.watch(path)
+		stamp, mtime = self._stamp(path)
+		if (entry is not None and entry.trusted and entry.stamp == stamp and
+				not watched):
+			return entry.value
+		buildtime = time.time()
+		value = build(path)
+		trusted = buildtime - mtime > _MTIME_SLACK
+		self._store(path, _Entry(value, sizeof(value), stamp, trusted, watched),
+								changes)
+		return value
+
+	def invalidate(self, path=None):
+		"""Forget the listing of directory path, or every listing."""
+		with self._lock:
+			self._changes += 1
+			if path is None:
+				self._entries.clear()
+				self._size = 0
+			else:
+				entry = self._entries.pop(path, None)
+				if entry is not None:
+					self._size -= entry.size
+
+	# Return the details of a directory which change when its entries do, and
+	# its mtime
+	def _stamp(self, path):
+		st = os.stat(path)
+		mtime = getattr(st, "st_mtime_ns", st.st_mtime)
+		ctime = getattr(st, "st_ctime_ns", st.st_ctime)
+		return (mtime, ctime, st.st_ino, st.st_dev, st.st_size), st.st_mtime
+
+	# Add an entry, dropping the least recently used ones to make room
+	def _store(self, path, entry, changes):
+		if entry.size > self._maxbytes:
+			return
+		with self._lock:
+			if changes != self._changes:
+				# Something changed during the build - it may not be in the listing
+				entry.watched = False
+				entry.trusted = False
+			old = self._entries.pop(path, None)
+			if old is not None:
+				self._size -= old.size
+			self._entries[path] = entry
+			self._size += entry.size
+			evicted = list()
+			while self._size > self._maxbytes:
+				oldpath, old = self._entries.popitem(last=False)
+				self._size -= old.size
+				evicted.append(oldpath)
+		if self._watcher is not None:
+			for oldpath in evicted:
+				self._watcher.unwatch(oldpath)
+
+class _InotifyWatcher():
+	"""Watch directories with inotify, reporting changes from a thread"""
+
+	@classmethod
+	def start(cls, callback):
+		"""Return a running watcher calling callback(path) when the directory
+			path changes, or None if inotify isn't available."""
+		if ctypes is None or not sys.platform.startswith("linux"):
+			return None
+		try:
+			libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+												 use_errno=True)
+			fd = libc.inotify_init1(_IN_CLOEXEC)
+		except (OSError, AttributeError):
+			return None
+		if fd < 0:
+			return None
+		return cls(libc, fd, callback)
+
+	def __init__(self, libc, fd, callback):
+		self._libc = libc
+		self._fd = fd
+		self._callback = callback
+		self._paths = dict()	# Watched paths by watch descriptor
+		self._wds = dict()	# Watch descriptors by path
+		self._failed = False	# Set if events can't be read any more
+		self._lock = threading.Lock()
+		thread = threading.Thread(target=self._read_events)
+		thread.daemon = True
+		thread.start()
+
+	def watch(self, path):
+		"""Start watching directory path.  Return False if it can't be."""
+		with self._lock:
+			if self._failed:
+				return False
+			elif path in self._wds:
+				return True
+			encoded = path
+			if not isinstance(path, bytes):
+				encoded = path.encode(sys.getfilesystemencoding())
+			wd = self._libc.inotify_add_watch(self._fd, encoded, _WATCH_MASK)
+			if wd < 0:
+				# Most likely out of watches - fall back on mtime checks
+				return False
+			self._paths[wd] = path
+			self._wds[path] = wd
+			return True
+
+	def unwatch(self, path):
+		"""Stop watching directory path."""
+		with self._lock:
+			wd = self._wds.pop(path, None)
+			if wd is not None:
+				self._paths.pop(wd, None)
+				self._libc.inotify_rm_watch(self._fd, wd)
+
+	# Report each change to the callback, until events can't be read
+	def _read_events(self):
+		while True:
+			try:
+				data = os.read(self._fd, 65536)
+			except OSError as e:
+				if e.errno == errno.EINTR:
+					continue
+				self._fail(e)
+				return
+			pos = 0
+			while pos + _EVENT_HEADER.size <= len(data):
+				wd, mask, cookie, namelen = _EVENT_HEADER.unpack_from(data, pos)
+				pos += _EVENT_HEADER.size + namelen
+				if mask & _IN_Q_OVERFLOW:
+					# Events were lost, so anything could have changed
+					self._callback(None)
+					continue
+				with self._lock:
+					path = self._paths.get(wd)
+					if mask & _IN_IGNORED and path is not None:
+						# The watch is gone, e.g. the directory was deleted
+						del self._paths[wd]
+						if self._wds.get(path) == wd:
+							del self._wds[path]
+				if path is not None:
+					self._callback(path)
+
+	# Stop watching for good.  Every listing goes back to mtime checks, since
+	# changes to those thought watched won't be reported
+	def _fail(self, error):
+		logging.error("DirCache: Reading inotify events failed (%s), using mtime "
+									"checks", error)
+		with self._lock:
+			self._failed = True
+			self._paths.clear()
+			self._wds.clear()
+		self._callback(None)
+		try:
+			os.close(self._fd)
+		except OSError:
+			pass
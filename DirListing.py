@@ -0,0 +1,172 @@
+"""Functions for enumerating a directory's contents cheaply, and the Listing
+class for serving them a page at a time."""
+
+# Standard library imports
+from __future__ import print_function # For python earlier than 3
+import os
+import stat
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir  # The backport, for Python before 3.5
+	except ImportError:
+		scandir = None  # Entries are listed, then stat'd one by one
+
+# Local imports
+import FileWriter
+
+# Entry types
+TYPE_FILE = "file"
+TYPE_DIR = "dir"
+TYPE_OTHER = "other"
+
+# Listing sort keys, and the entry fields they sort by
+SORT_KEYS = {"name": 0, "type": 1, "size": 2, "accessed": 3, "modified": 4}
+# Timestamps are only so precise, so changes this close before a change token
+# are reported again
+CHANGE_SLACK = 1.0
+# Roughly what each entry costs to keep, on top of its name
+_ENTRY_OVERHEAD = 200
+
+def scan(dirname):
+	"""Generate (name, type, stat result) for each entry in directory dirname.
+
+		Each entry is stat'd at most once, and its type comes from that stat.
+		Symlinks are followed, except broken ones, which are described as they
+		are.  Entries which vanish part way through the scan, and unfinished
+		uploads, are left out.
+
+		Throws: OSError if dirname itself can't be listed
+
+	"""
+	if scandir is None:
+		for name in os.listdir(dirname):
+			if FileWriter.is_internal(name):
+				continue
+			info = stat_path(os.path.join(dirname, name))
+			if info is not None:
+				yield (name,) + info
+		return
+	entries = scandir(dirname)
+	try:
+		for entry in entries:
+			if FileWriter.is_internal(entry.name):
+				continue
+			try:
+				# Costs one stat, or none on Windows
+				filestat = entry.stat()
+			except OSError:
+				try:
+					filestat = entry.stat(follow_symlinks=False)
+				except OSError:
+					continue  # It's gone
+			yield entry.name, get_type(filestat), filestat
+	finally:
+		if hasattr(entries, "close"):
+			entries.close()
+
+def stat_path(path):
+	"""Return (type, stat result) for path, or None if it doesn't exist."""
+	try:
+		filestat = os.stat(path)
+	except OSError:
+		try:
+			filestat = os.lstat(path)
+		except OSError:
+			return None
+	return get_type(filestat), filestat
+
+def get_type(filestat):
+	"""Return the entry type a stat result describes."""
+	if stat.S_ISREG(filestat.st_mode):
+		return TYPE_FILE
+	elif stat.S_ISDIR(filestat.st_mode):
+		return TYPE_DIR
+	return TYPE_OTHER
+
+class Listing():
+	"""A snapshot of a directory's entries, to be served a page at a time.
+
+	Each entry is a tuple of (name, type, size, atime, mtime, changed), where
+	changed is the later of the entry's mtime and ctime.  Orders are sorted
+	the first time they're asked for and kept, so paging through a large
+	directory costs one sort per key.
+
+	Data items:
+		lastchange - get - When the directory or any entry last changed, which
+											 serves as a change token
+		memsize - get - Roughly how many bytes the listing takes up
+
+	"""
+
+	def __init__(self, dirname):
+		"""Scan directory dirname.
+
+			Throws: OSError if dirname can't be listed
+
+		"""
+		dirstat = os.stat(dirname)
+		self._lastchange = max(dirstat.st_mtime, dirstat.st_ctime)
+		self._entries = list()
+		namebytes = 0
+		for name, filetype, filestat in scan(dirname):
+			self._entries.append((name, filetype, filestat.st_size,
+														filestat.st_atime, filestat.st_mtime,
+														max(filestat.st_mtime, filestat.st_ctime)))
+			namebytes += len(name)
+			self._lastchange = max(self._lastchange, self._entries[-1][5])
+		self._orders = dict()	# Sorted entries by sort key
+		# Count every order the entries may be sorted in, so the size doesn't
+		# change once the listing is cached
+		self._memsize = namebytes + ((_ENTRY_OVERHEAD + 8 * len(SORT_KEYS)) *
+																 len(self._entries))
+
+	def page(self, offset=0, limit=None, sort="name", reverse=False,
+					 namefilter=None, since=None):
+		"""Return (total, entries) for one page of the listing.
+
+			total counts every entry matching namefilter (a case insensitive
+			substring of the name).  entries holds at most limit of them, from
+			offset on, in sort order.  If since is given, entries only holds those
+			changed at or after that change token.
+
+		"""
+		entries = self._sorted(sort)
+		if namefilter:
+			namefilter = namefilter.lower()
+			entries = [entry for entry in entries if namefilter in entry[0].lower()]
+		total = len(entries)
+		if since is not None:
+			since -= CHANGE_SLACK
+			entries = [entry for entry in entries if entry[5] >= since]
+		offset = min(offset, len(entries))
+		if limit is None:
+			limit = len(entries)
+		if not reverse:
+			return total, entries[offset:offset + limit]
+		# Slice from the end rather than reversing the whole directory
+		last = len(entries) - offset
+		return total, entries[max(last - limit, 0):last][::-1]
+
+	# Return the entries sorted by key, sorting them if it's the first time
+	def _sorted(self, key):
+		entries = self._orders.get(key)
+		if entries is None:
+			field = SORT_KEYS[key]
+			# Ties, and every sort but by name, fall back on the name
+			entries = sorted(self._entries,
+											 key=lambda entry: (entry[field], entry[0]))
+			self._orders[key] = entries
+		return entries
+
+	# Return when the directory or any entry last changed
+	def _get_lastchange(self):
+		return self._lastchange
+
+	# Return roughly how many bytes the listing takes up
+	def _get_memsize(self):
+		return self._memsize
+
+	lastchange = property(_get_lastchange)
+	memsize = property(_get_memsize)
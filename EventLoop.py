@@ -0,0 +1,442 @@
+"""Serve connections from one thread with non-blocking sockets."""
+
+# Standard library imports
+from __future__ import print_function # For python earlier than 3
+import collections
+import errno
+import os
+import socket
+import logging
+import time
+try:
+	import selectors
+except ImportError:
+	selectors = None  # Python earlier than 3.4 - the event loop is unavailable
+
+# Local imports
+import UserConnection
+import Websocket
+import Metrics
+import RateLimiter
+from Error import ProtocolError
+
+# Errors that just mean a non-blocking socket isn't ready yet
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+# Errors from os.sendfile meaning it can't be used for this file or socket
+_NO_SENDFILE = (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP)
+
+
+def available():
+	"""Return True if this Python can run the event loop."""
+	return selectors is not None
+
+
+class EventLoop():
+	"""Run every connection as a non-blocking state machine on one thread.
+
+	Connections cost a socket and a little buffer space instead of a thread,
+	so idle or slow clients are cheap.
+
+	"""
+
+	def __init__(self, settings, listensock):
+		"""Setup the loop to accept from an already listening socket."""
+		self._settings = settings
+		self._listensock = listensock
+		self._selector = selectors.DefaultSelector()
+		self._conns = dict()	# Maps file descriptor to LoopConnection
+		self._paused = set()	# Connections waiting on the rate limits
+
+	def run(self, stopped):
+		"""Serve connections until the stopped function returns True."""
+		self._listensock.setblocking(False)
+		self._selector.register(self._listensock, selectors.EVENT_READ)
+		try:
+			while not stopped():
+				for key, events in self._selector.select(timeout=self._timeout()):
+					if key.fileobj is self._listensock:
+						self._accept()
+					else:
+						self._service(key, events)
+				self._resume_paused()
+				self._close_idle()
+		finally:
+			for conn in list(self._conns.values()):
+				self._close(conn)
+			self._selector.unregister(self._listensock)
+			self._selector.close()
+
+	# Accept every connection that is waiting
+	def _accept(self):
+		while True:
+			try:
+				conn, addr = self._listensock.accept()
+			except socket.error as e:
+				if e.errno not in _WOULD_BLOCK:
+					logging.error("EventLoop: Accept failed: %s", e)
+				return
+			UserConnection.set_nodelay(conn)
+			handler = LoopConnection(self._settings, conn, addr)
+			self._conns[conn.fileno()] = handler
+			self._watch(handler)
+
+	# Let a connection handle the events it received, then update its interest
+	def _service(self, key, events):
+		handler = key.data
+		try:
+			if events & selectors.EVENT_READ:
+				handler.handle_read()
+			if events & selectors.EVENT_WRITE and not handler.closed:
+				handler.handle_write()
+		except socket.error:
+			logging.error("%s: Connection closed unexpectedly", handler.addr)
+			handler.closed = True
+		except Exception:
+			# Unlike a thread, the loop must outlive a connection's failure
+			logging.exception("%s: Unknown error occurred", handler.addr)
+			handler.closed = True
+		if handler.closed:
+			self._close(handler)
+			return
+		self._watch(handler)
+		if handler.resume_at is not None:
+			self._paused.add(handler)
+
+	# Watch a connection for the events it wants now.  One waiting on the rate
+	# limits may want none for a while
+	def _watch(self, handler):
+		events = handler.events
+		try:
+			key = self._selector.get_key(handler.sock)
+		except KeyError:
+			key = None
+		if key is None and events:
+			self._selector.register(handler.sock, events, handler)
+		elif key is not None and not events:
+			self._selector.unregister(handler.sock)
+		elif key is not None and events != key.events:
+			self._selector.modify(handler.sock, events, handler)
+
+	# Return how long select may wait - not past when a paused connection may
+	# carry on
+	def _timeout(self):
+		timeout = 1.0
+		now = time.time()
+		for handler in self._paused:
+			resume = handler.resume_at
+			if resume is not None:
+				timeout = min(timeout, max(resume - now, 0))
+		return timeout
+
+	# Watch connections for what the rate limits let them carry on with
+	def _resume_paused(self):
+		for handler in list(self._paused):
+			self._watch(handler)
+			if handler.resume_at is None:
+				self._paused.discard(handler)
+
+	# Close connections that have gone quiet for too long
+	def _close_idle(self):
+		now = time.time()
+		for handler in list(self._conns.values()):
+			if handler.idle_since(now) > handler.timeout:
+				handler.handle_timeout()
+				self._close(handler)
+
+	# Forget about a connection and close it
+	def _close(self, handler):
+		fileno = handler.sock.fileno()
+		if self._conns.pop(fileno, None) is not None:
+			self._paused.discard(handler)
+			try:
+				self._selector.unregister(handler.sock)
+			except KeyError:
+				pass  # It was waiting on the rate limits
+			handler.close()
+
+
+class _OutputQueue():
+	"""Stand in for a socket's sendall, queueing data for the event loop.
+
+	Queued items are byte strings, or iterators that lazily produce byte
+	strings and FileRegions so that large files never sit in memory.
+
+	"""
+
+	def __init__(self):
+		self._pending = collections.deque()
+
+	def sendall(self, data):
+		"""Queue bytes to be sent."""
+		self._pending.append(bytes(data))
+
+	def push(self, producer):
+		"""Queue an iterator of byte strings and FileRegions to be sent."""
+		self._pending.append(producer)
+
+	def next_chunk(self):
+		"""Return the next byte string or FileRegion, or None if none is queued."""
+		while self._pending:
+			item = self._pending[0]
+			if isinstance(item, bytes):
+				self._pending.popleft()
+				return item
+			try:
+				return next(item)
+			except StopIteration:
+				self._pending.popleft()
+		return None
+
+	def close(self):
+		"""Drop anything still queued, closing any open producers."""
+		for item in self._pending:
+			if hasattr(item, "close"):
+				item.close()
+		self._pending.clear()
+
+	def __len__(self):
+		return len(self._pending)
+
+
+class LoopConnection(UserConnection.UserConnection):
+	"""Handle a user connection without ever blocking the loop.
+
+	The handler reuses UserConnection's request processing and response
+	building, but everything it sends is queued and written as the socket
+	becomes writable.
+
+	"""
+	# These are the connection states
+	ST_REQUEST = "waiting for request headers"
+	ST_RESPONSE = "sending the response"
+	ST_WEBSOCKET = "handling a websocket"
+	ST_CLOSING = "flushing output before close"
+
+	# Seconds of inactivity tolerated, matching the threaded socket timeouts
+	REQUEST_TIMEOUT = 5
+	WEBSOCKET_TIMEOUT = 10
+	RECV_SIZE = 1024*256
+
+	def __init__(self, settings, conn, addr):
+		"""Setup the handler with a connection and address to handle."""
+		UserConnection.UserConnection.__init__(self, settings, _OutputQueue(),
+																					 addr)
+		self.sock = conn
+		self.sock.setblocking(False)
+		self.addr = addr
+		self.closed = False
+		self._state = self.ST_REQUEST
+		self._outchunk = None	# The part of a chunk which hasn't been sent yet
+		self._websocket = None
+		self._lastactive = time.time()
+		# Sending and receiving wait until these times to pay the rate limits
+		self._sendresume = 0
+		self._recvresume = 0
+		logging.info("%s: Connection Received", self._addr)
+		self._metrics.add(Metrics.CONNECTIONS)
+
+	def _get_events(self):
+		events = 0
+		now = time.time()
+		pending = self._outchunk is not None or len(self._conn) > 0
+		if pending and self._sendresume <= now:
+			events = selectors.EVENT_WRITE
+		# Stop reading if too much is pipelined behind the current response, or
+		# while the receive rate limits are being paid
+		if self._recvresume <= now and (self._state != self.ST_RESPONSE or
+				not pending or self._parser.buffered <= self._parser.maxheadersize):
+			events |= selectors.EVENT_READ
+		return events
+
+	def _get_timeout(self):
+		if self._state == self.ST_WEBSOCKET:
+			return self.WEBSOCKET_TIMEOUT
+		elif self._state == self.ST_REQUEST and self._requests > 0:
+			return self._keepalivetimeout
+		return self.REQUEST_TIMEOUT
+
+	def _get_resume_at(self):
+		now = time.time()
+		waits = [resume for resume in (self._sendresume, self._recvresume)
+						 if resume > now]
+		return min(waits) if waits else None
+
+	events = property(_get_events)
+	timeout = property(_get_timeout)
+	resume_at = property(_get_resume_at)
+
+	def idle_since(self, now):
+		"""Return the seconds since this connection last made progress.  Time
+			spent waiting on the rate limits doesn't count."""
+		return now - max(self._lastactive, self._sendresume, self._recvresume)
+
+	def handle_timeout(self):
+		"""Note that the connection has been idle too long and will be closed."""
+		if self._state != self.ST_REQUEST or self._requests == 0:
+			logging.error("%s: Fatal socket timeout", self._addr)
+		# Otherwise a kept-alive connection just went idle
+
+	def handle_read(self):
+		"""Receive whatever data is available and act on it."""
+		try:
+			if self._state == self.ST_WEBSOCKET:
+				# Frames are received straight into the websocket's buffer
+				received = self._websocket.recv_from(self.sock)
+			else:
+				data = self.sock.recv(self.RECV_SIZE)
+				received = len(data)
+		except socket.error as e:
+			if e.errno in _WOULD_BLOCK:
+				return
+			raise
+		if received == 0:
+			# The client hung up
+			self.closed = True
+			return
+		self._metrics.add(Metrics.RECEIVED, received)
+		self._lastactive = time.time()
+		if self._state == self.ST_WEBSOCKET:
+			# Only uploads are held to the receive rate limits
+			self._pay_recv(received)
+			if not self._websocket.feed_data():
+				self._state = self.ST_CLOSING
+		elif self._state != self.ST_CLOSING:
+			# Pipelined requests wait in the parser until the response is sent
+			self._parser.feed(data)
+			self._process_requests()
+
+	def handle_write(self):
+		"""Send queued data until the socket would block, or the send rate
+			limits say to wait."""
+		while True:
+			if self._outchunk is None:
+				chunk = self._conn.next_chunk()
+				if chunk is None and self._next_response():
+					continue
+				elif chunk is None:
+					break
+				if not isinstance(chunk, UserConnection.FileRegion):
+					chunk = memoryview(chunk)
+				self._outchunk = chunk
+			if self._sendresume > time.time():
+				return
+			try:
+				if isinstance(self._outchunk, UserConnection.FileRegion):
+					done = self._send_region_nowait(self._outchunk)
+				else:
+					sent = self.sock.send(self._outchunk[:self._sendquantum])
+					self._metrics.add(Metrics.SENT, sent)
+					self._pay_send(sent)
+					self._outchunk = self._outchunk[sent:]
+					done = len(self._outchunk) == 0
+			except socket.error as e:
+				if e.errno in _WOULD_BLOCK:
+					return
+				raise
+			self._lastactive = time.time()
+			if done:
+				self._outchunk = None
+		# Everything is sent - close if the response is over
+		if self._state in (self.ST_RESPONSE, self.ST_CLOSING):
+			self.closed = True
+
+	# The response is sent.  If the connection persists, start on any pipelined
+	# request.  Return True if that queued more to send
+	def _next_response(self):
+		if self._state == self.ST_RESPONSE:
+			self._end_response()
+		if self._state != self.ST_RESPONSE or not self._keepalive:
+			return False
+		self._state = self.ST_REQUEST
+		self._process_requests()
+		return len(self._conn) > 0
+
+	def close(self):
+		"""Close the socket and release anything still queued."""
+		self.closed = True
+		if self._websocket is not None:
+			self._websocket.abort()
+		self._conn.close()
+		self.sock.close()
+		self._end_response()
+		self._metrics.add(Metrics.CONNECTIONS, -1)
+		logging.info("%s: Connection Closed", self._addr)
+
+	# Respond to the next request if it's all here and we're ready for it
+	def _process_requests(self):
+		if self._state != self.ST_REQUEST:
+			return
+		try:
+			data = self._parser.next_request()
+		except ProtocolError:
+			logging.error("%s: Invalid headers specified", self._addr)
+			self.closed = True
+			return
+		if data is None:
+			return
+		try:
+			url = self._process_headers(data)
+		except ProtocolError:
+			logging.error("%s: Invalid headers specified", self._addr)
+			self.closed = True
+			return
+		self._state = self.ST_RESPONSE
+		self._respond(url)
+		# Websocket data may have arrived right behind the headers
+		if self._state == self.ST_WEBSOCKET:
+			remainder = self._parser.take_buffer()
+			if remainder and not self._websocket.feed_data(remainder):
+				self._state = self.ST_CLOSING
+
+	# Handle an upload over a websocket - frames are fed in as they arrive
+	def _handle_upload(self, url):
+		self._websocket = Websocket.Websocket(self._conn, self._addr, url,
+																					self._settings)
+		self._websocket.start_websocket()
+		self._keepalive = False
+		self._state = self.ST_WEBSOCKET
+
+	# Send as much of a file region as the socket takes.  Return True when done
+	def _send_region_nowait(self, region):
+		sent = None
+		count = min(region.count, self._sendquantum or region.count)
+		if self._usesendfile and hasattr(os, "sendfile"):
+			try:
+				sent = os.sendfile(self.sock.fileno(), region.fileobj.fileno(),
+													 region.offset, count)
+			except OSError as e:
+				if e.errno not in _NO_SENDFILE:
+					raise
+				self._usesendfile = False
+		if sent is None:
+			# Fall back to reading the file through in chunks
+			region.fileobj.seek(region.offset)
+			data = region.fileobj.read(min(self._chunksize, count))
+			sent = self.sock.send(data) if data else 0
+		if sent == 0:
+			# The file shrank underneath us.  The client is still waiting for the
+			# rest, so close the connection once the response is over
+			self._keepalive = False
+			return True
+		self._metrics.add(Metrics.SENT, sent)
+		region.advance(sent)
+		self._pay_send(sent)
+		return region.count <= 0
+
+	# Pay the send rate limits for amount bytes sent.  Sending waits until
+	# they're paid, without holding up the loop
+	def _pay_send(self, amount):
+		delay = self._limiter.take(RateLimiter.SEND, self._clientip, amount)
+		if delay > 0:
+			self._sendresume = time.time() + delay
+
+	# Pay the receive rate limits for amount bytes received.  Receiving waits
+	# until they're paid, and the client's sends back up meanwhile
+	def _pay_recv(self, amount):
+		delay = self._limiter.take(RateLimiter.RECV, self._clientip, amount)
+		if delay > 0:
+			self._recvresume = time.time() + delay
+
+	# Queue a generator's byte strings and FileRegions to be sent
+	def _send_chunks(self, chunks):
+		self._conn.push(chunks)
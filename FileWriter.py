@@ -1,73 +1,535 @@
 # Standard library imports
 from __future__ import print_function #Make print work correctly prior to python 3
-import tempfile
-import shutil
+import errno
+import json
+import os
 import os.path
+import re
+import threading
+import time
+try:
+	import fcntl
+except ImportError:
+	fcntl = None  # Partial uploads can't be shared between processes
 
 #Local imports
+import Digest
 from Error import StateError, ProtocolError
 
+# Errors from os.link meaning the filesystem can't hard link, not that the
+# destination is taken
+_NO_LINK = tuple(getattr(errno, name) for name in
+								 ("EPERM", "EXDEV", "EOPNOTSUPP", "ENOTSUP", "EMLINK")
+								 if hasattr(errno, name))
+# Errors from posix_fallocate meaning the filesystem can't preallocate
+_NO_FALLOCATE = tuple(getattr(errno, name) for name in
+											("EINVAL", "EOPNOTSUPP", "ENOTSUP", "ENOSYS")
+											if hasattr(errno, name))
+# Save the received ranges at most this often while an upload is going
+_SAVE_INTERVAL = 1.0
+# The names of partial files, ".<name>.<size>.part", and of their indexes,
+# ".<name>.<size>.ranges"
+_PARTIAL_RE = re.compile(r"^\..+\.\d+\.(part|ranges)$")
+# Those, and indexes being saved
+_INTERNAL_RE = re.compile(r"^\..+\.\d+\.(?:part|ranges(?:\.new\d+)?)$")
+
+# The partial uploads open in this process, by partial file path
+_uploads = dict()
+_uploads_lock = threading.Lock()
+
+def open_upload(filepath, filesize, algorithm=None, store=None):
+	"""Return the FileWriter for an upload of filesize bytes to filepath.
+
+		Every connection uploading the same file and size shares one FileWriter,
+		so several can send different segments of it at once.  Each connection
+		must close the FileWriter when it's done with it.  If algorithm names a
+		hashlib algorithm the file's digest is worked out as it arrives.  If
+		store is a DedupeStore, the finished file's content is shared with it.
+
+		Throws: StateError
+
+	"""
+	writer = FileWriter(filepath, filesize, algorithm, store)
+	with _uploads_lock:
+		shared = _uploads.get(writer.temppath)
+		if shared is not None:
+			shared._users += 1
+			return shared
+		try:
+			writer._open()
+		except (IOError, OSError):
+			raise StateError("Temp file not created", "Finish Error: -1")
+		_uploads[writer.temppath] = writer
+	return writer
+
+def is_internal(name):
+	"""Return True if the file name is one uploads keep their partial state or
+		digest in.  Such files are never listed, downloaded or uploaded to."""
+	return _INTERNAL_RE.match(name) is not None or Digest.is_sidecar(name)
+
+def add_range(ranges, start, end):
+	"""Merge [start, end) into a sorted list of disjoint [start, end) ranges."""
+	merged = list()
+	for rstart, rend in ranges:
+		if rend < start or rstart > end:
+			merged.append([rstart, rend])
+		else:
+			start = min(start, rstart)
+			end = max(end, rend)
+	merged.append([start, end])
+	merged.sort()
+	return merged
+
+def remove_expired(directory, maxage):
+	"""Delete partial uploads in directory untouched for maxage seconds."""
+	now = time.time()
+	try:
+		names = os.listdir(directory)
+	except OSError:
+		return
+	for name in names:
+		match = _PARTIAL_RE.match(name)
+		if match is None:
+			continue
+		elif match.group(1) == "part":
+			partpath = os.path.join(directory, name)
+			indexpath = partpath[:-len(".part")] + ".ranges"
+		else:
+			# An index left behind after its partial file went
+			indexpath = os.path.join(directory, name)
+			partpath = indexpath[:-len(".ranges")] + ".part"
+			if os.path.exists(partpath):
+				continue
+			partpath = indexpath
+		try:
+			if now - os.path.getmtime(partpath) < maxage:
+				continue
+			with _uploads_lock:
+				if partpath in _uploads:
+					continue
+				for path in (partpath, indexpath):
+					if os.path.exists(path):
+						os.unlink(path)
+		except OSError:
+			pass
+
+class Segment():
+	"""One connection's progress through a segment of an upload"""
+
+	def __init__(self, start, finish, exact):
+		self.start = start
+		self.pos = start	# Where the next data goes
+		self.finish = finish
+		self.exact = exact	# Whether the segment must reach its finish
+
 class FileWriter():
-	def __init__(self, filepath, filesize):
+	"""Write an upload straight into its destination directory.
+
+	Data goes into a hidden partial file next to the destination, named for the
+	destination and the file size, so it's only written once.  The partial file
+	is preallocated and each segment is written at its own offset, so any
+	number of connections can send different segments at the same time.  The
+	ranges received so far are kept in an index file beside it.  If every
+	connection drops, a later upload of the same file and size picks up the
+	partial file and only needs the missing ranges.  When every byte is in the
+	file is synced to disk and published under its real name in one step,
+	without replacing anything that appeared meanwhile.
+
+	Data arriving in order is hashed as it's written, so the digest costs no
+	extra pass over the file.  Only what arrived out of order, or before a
+	resume, is read back at the end.  The digest is checked against the one the
+	client sent, if any, and kept with the published file.  With a dedupe store
+	a file whose content is stored already is published as a copy of that
+	instead, and the partial file dropped.
+
+	Get a FileWriter with open_upload rather than creating one directly.
+
+	Data items:
+		ranges - get - A sorted list of the [start, end) byte ranges received
+		temppath - get - The path of the partial file
+		digest - get - The (algorithm, hex digest) of the published file, or None
+
+	"""
+
+	def __init__(self, filepath, filesize, algorithm=None, store=None):
 		self._filepath = filepath
 		self._filesize = int(filesize)
-		self._writtendat = 0
-		self._tempfile = None
-		try:
-			self._tempfile = tempfile.TemporaryFile()
-		except IOError:
-			self._tempfile = None
+		directory, name = os.path.split(filepath)
+		base = os.path.join(directory, "." + name + "." + str(self._filesize))
+		self._temppath = base + ".part"
+		self._indexpath = base + ".ranges"
+		self._ranges = list()
+		self._lastsave = time.time()
+		self._fd = None
+		self._users = 1	# Connections using this FileWriter
+		self._published = False
+		self._lock = threading.Lock()
+		self._algorithm = algorithm
+		self._hasher = Digest.new(algorithm) if algorithm else None
+		self._hashed = 0	# The hasher has had the file up to here
+		self._digest = None
+		self._digests = dict()	# The complete file's hex digests by algorithm
+		self._expected = set()	# The (algorithm, hex digest)s clients expect
+		self._store = store
 
 	def test_size(self):
-		"""Compare the amount of written data to the amount we're supposed to have
+		"""Compare the amount of received data to the amount we're supposed to have
 
 			Return 1 if too much has been received, 0 if the right amount has been
 			received, and -1 if not enough data has been received
 
 		"""
 		retval = -1
-		if self._writtendat > self._filesize:
+		received = sum(end - start for start, end in self._ranges)
+		if received > self._filesize:
 			retval = 1
-		elif self._writtendat == self._filesize:
+		elif received == self._filesize:
 			retval = 0
 		return retval
 
-	def append(self, data):
-		"""Append data to the temporary file.
-			
-			Throws: StateError
-			
+	def start_segment(self, start, finish=None):
+		"""Return a Segment for receiving the bytes from start up to finish.
+
+			Without a finish the segment may run to the end of the file.
+
+			Throws: ProtocolError
+
 		"""
-		if self._tempfile is None:
-			raise StateError("Temp file not created")
-		else:
-			self._tempfile.write(data)
-			self._writtendat += len(data)
+		exact = finish is not None
+		if finish is None:
+			finish = self._filesize
+		if not 0 <= start <= finish <= self._filesize:
+			raise ProtocolError("Segment outside of the file", "Segment Error: -1")
+		return Segment(start, finish, exact)
+
+	def append(self, segment, data):
+		"""Write data to the partial file as the next part of segment.
+
+			Throws: StateError, ProtocolError
+
+		"""
+		if self._fd is None or self._published:
+			raise StateError("Temp file not open")
+		elif segment.pos + len(data) > segment.finish:
+			raise ProtocolError("Received data past the end of the segment",
+													"Segment Error: -1")
+		try:
+			self._write_at(segment.pos, data)
+		except (IOError, OSError):
+			raise StateError("Error writing file", "Segment Error: -1")
+		if self._hasher is not None:
+			with self._lock:
+				if segment.pos == self._hashed:
+					self._hasher.update(data)
+					self._hashed += len(data)
+		segment.pos += len(data)
+
+	def end_segment(self, segment, complete=True):
+		"""Record a segment's data as received.
+
+			If complete is set it's a ProtocolError for the segment to be short of
+			the finish it was started with.  Otherwise whatever arrived is recorded.
+
+			Throws: ProtocolError
+
+		"""
+		if complete and segment.exact and segment.pos != segment.finish:
+			raise ProtocolError("Segment ended before its finish",
+													"Segment Error: -1")
+		if segment.pos > segment.start:
+			with self._lock:
+				self._ranges = add_range(self._ranges, segment.start, segment.pos)
+				if time.time() - self._lastsave >= _SAVE_INTERVAL:
+					try:
+						self._save_ranges()
+					except (IOError, OSError):
+						pass  # Try again next time
+
+	def finish(self, expected=None):
+		"""Publish the partial file as the real file if all of it has arrived.
+
+			Returns True once the file is published.  If it's incomplete but other
+			connections are still sending to it, returns False - one of them will
+			finish it.  Otherwise the incomplete file is kept so the upload can be
+			resumed.  expected is the (algorithm, hex digest) the client says the
+			file has, or None.  Every connection's expected digest is kept, and a
+			file that doesn't match them all is thrown away.  A connection
+			finishing after the file is published has its digest checked then.
 
-	def finish(self):
-		"""Write the temporary file out to the real file.
-			
 			Throws: StateError, ProtocolError
 
 		"""
 		# TODO: improve the usefulness of the error responses
-		if self._tempfile is None:
-			raise StateError("Temp file not created", "Finish Error: -1")
-		# This will make sure that the temp file is closed when finish is done
+		with self._lock:
+			if expected is not None:
+				self._expected.add(expected)
+			if self._published:
+				if (expected is not None and
+						self._digest_with(expected[0]) != expected[1]):
+					raise ProtocolError("File doesn't match its digest",
+															"Digest Error: -1")
+				return True
+			elif self._fd is None:
+				raise StateError("Temp file not created", "Finish Error: -1")
+			try:
+				# Other processes may have received some of the file too
+				self._save_ranges()
+				if self._ranges != [[0, self._filesize]] and self._filesize > 0:
+					if self._others_writing():
+						return False
+					raise ProtocolError("File wasn't completely received",
+															"Finish Error: -2")
+				self._check_digest()
+				if not self._publish_stored():
+					self._publish()
+					if self._digest is not None:
+						Digest.record(self._filepath, *self._digest)
+						if self._store is not None:
+							self._store.add(self._filepath, *self._digest)
+			except (IOError, OSError):
+				raise StateError("Error writing file", "Finish Error: -1")
+			finally:
+				if self._published or not os.path.exists(self._temppath):
+					# The partial file is gone one way or another
+					self._unlink(self._indexpath)
+			return True
+
+	def close(self):
+		"""Finish with the FileWriter for one connection.
+
+			When the last connection closes it, what's been received is kept so it
+			can be resumed.
+
+		"""
+		with _uploads_lock:
+			self._users -= 1
+			if self._users > 0:
+				return
+			if _uploads.get(self._temppath) is self:
+				del _uploads[self._temppath]
+		with self._lock:
+			if self._fd is None:
+				return
+			try:
+				if not self._published and self._ranges:
+					self._save_ranges()
+				elif not self._published:
+					# Nothing worth resuming
+					self._unlink(self._temppath)
+			except (IOError, OSError):
+				pass
+			finally:
+				os.close(self._fd)
+				self._fd = None
+
+	def _get_ranges(self):
+		with self._lock:
+			return list(self._ranges)
+
+	ranges = property(_get_ranges)
+
+	def _get_temppath(self):
+		return self._temppath
+
+	temppath = property(_get_temppath)
+
+	def _get_digest(self):
+		return self._digest
+
+	digest = property(_get_digest)
+
+	# Open the partial file, preallocating it if it's new and picking up the
+	# ranges already received if it isn't.  Unlike mkstemp, the umask decides
+	# its permissions, as it would for the real file
+	def _open(self):
+		fd = os.open(self._temppath, os.O_RDWR | os.O_CREAT |
+								 getattr(os, "O_BINARY", 0), 0o666)
+		try:
+			if fcntl is not None:
+				# Show other processes this one is writing the file too
+				fcntl.lockf(fd, fcntl.LOCK_SH, 1, 1)
+			if os.fstat(fd).st_size != self._filesize:
+				self._preallocate(fd)
+			self._ranges = self._load_ranges()
+		except (IOError, OSError):
+			os.close(fd)
+			raise
+		self._fd = fd
+
+	# Give the partial file its full size up front, so writes at any offset
+	# don't fragment it or run out of space half way
+	def _preallocate(self, fd):
+		os.ftruncate(fd, self._filesize)
+		if hasattr(os, "posix_fallocate") and self._filesize > 0:
+			try:
+				os.posix_fallocate(fd, 0, self._filesize)
+			except OSError as e:
+				if e.errno not in _NO_FALLOCATE:
+					raise
+				# Not supported here - the file is just sparse
+
+	# Write all of data at offset in the partial file
+	def _write_at(self, offset, data):
+		data = memoryview(data)
+		while len(data) > 0:
+			if hasattr(os, "pwrite"):
+				written = os.pwrite(self._fd, data, offset)
+			else:
+				# Seeking and writing has to be done as one step
+				with self._lock:
+					os.lseek(self._fd, offset, os.SEEK_SET)
+					written = os.write(self._fd, data)
+			offset += written
+			data = data[written:]
+
+	# Read the saved ranges
+	def _load_ranges(self):
+		try:
+			with open(self._indexpath) as f:
+				index = json.load(f)
+		except (IOError, OSError, ValueError):
+			return list()
+		ranges = list()
+		if isinstance(index, dict) and index.get("size") == self._filesize:
+			for item in index.get("ranges", list()):
+				try:
+					start, end = int(item[0]), min(int(item[1]), self._filesize)
+				except (TypeError, ValueError, IndexError):
+					continue
+				if 0 <= start < end:
+					ranges = add_range(ranges, start, end)
+		return ranges
+
+	# Return true if another connection, maybe in another process, is writing
+	# the file.  Call with the lock held
+	def _others_writing(self):
+		if self._users > 1:
+			return True
+		elif fcntl is None:
+			return False
+		# Every process writing the file holds a shared lock on its second byte
+		try:
+			fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, 1)
+		except (IOError, OSError):
+			return True
+		fcntl.lockf(self._fd, fcntl.LOCK_SH, 1, 1)
+		return False
+
+	# Save the received ranges, merged with any another process has saved.  The
+	# data is synced first, so the index never claims anything a crash could
+	# lose.  Call with the lock held
+	def _save_ranges(self):
+		os.fsync(self._fd)
+		if fcntl is not None:
+			# Processes take turns on the index with a lock on the first byte
+			fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, 0)
+		try:
+			for start, end in self._load_ranges():
+				self._ranges = add_range(self._ranges, start, end)
+			newpath = self._indexpath + ".new" + str(os.getpid())
+			with open(newpath, "w") as f:
+				json.dump({"size": self._filesize, "ranges": self._ranges}, f)
+			if hasattr(os, "replace"):
+				os.replace(newpath, self._indexpath)
+			else:
+				os.rename(newpath, self._indexpath)
+		finally:
+			if fcntl is not None:
+				fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, 0)
+		self._lastsave = time.time()
+
+	# Work out the complete file's digest, and throw the file away if it isn't
+	# every one the clients expected.  Call with the lock held
+	def _check_digest(self):
+		if self._hasher is not None:
+			Digest.hash_file(self._fd, self._hasher, self._hashed, self._filesize)
+			self._hashed = self._filesize
+			self._digests[self._algorithm] = self._hasher.hexdigest()
+			self._digest = (self._algorithm, self._digests[self._algorithm])
+		for algorithm, hexdigest in sorted(self._expected):
+			if self._digest_with(algorithm) != hexdigest:
+				# Every byte arrived, so there's nothing worth resuming
+				self._ranges = list()
+				self._unlink(self._temppath)
+				raise ProtocolError("File doesn't match its digest",
+														"Digest Error: -1")
+			if self._digest is None:
+				self._digest = (algorithm, hexdigest)
+
+	# Return the complete file's hex digest with algorithm, reading the file
+	# again if it hasn't been hashed with that.  Call with the lock held
+	def _digest_with(self, algorithm):
+		if algorithm not in self._digests:
+			hasher = Digest.new(algorithm)
+			if hasher is None:
+				raise ProtocolError("Unknown digest algorithm", "Digest Error: -2")
+			Digest.hash_file(self._fd, hasher, 0, self._filesize)
+			self._digests[algorithm] = hasher.hexdigest()
+		return self._digests[algorithm]
+
+	# Remove a file if it's there
+	def _unlink(self, path):
+		try:
+			os.unlink(path)
+		except OSError:
+			pass
+
+	# Give the partial file its real name, failing if that name has been taken
+	def _publish(self):
 		try:
-			if self.test_size() == 0:
-				self._tempfile.seek(0)
-				# TODO: Resolve this race condition - perhaps os.open, os.fdopen
-				if not os.path.exists(self._filepath):
-					with open(self._filepath, 'wb') as f:
-						shutil.copyfileobj(self._tempfile, f)
-				else:
+			if not hasattr(os, "link"):
+				raise OSError(errno.EPERM, "No hard links")
+			os.link(self._temppath, self._filepath)
+		except OSError as e:
+			if e.errno == errno.EEXIST:
+				self._unlink(self._temppath)
+				raise StateError("File already exists", "Finish Error: -1")
+			elif e.errno not in _NO_LINK:
+				raise
+			# No hard links here.  Claim the name with an exclusive create, then
+			# rename over the empty file that holds it
+			try:
+				os.close(os.open(self._filepath,
+												 os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+			except OSError as e:
+				if e.errno == errno.EEXIST:
+					self._unlink(self._temppath)
 					raise StateError("File already exists", "Finish Error: -1")
-			elif self.test_size() != 0:
-				raise ProtocolError("File wasn't completely received",
-														"Finish Error: -2")
-		except IOError:
-			raise StateError("Error writing file", "Finish Error: -1")
+				raise
+			os.rename(self._temppath, self._filepath)
+		else:
+			self._unlink(self._temppath)
+		self._published = True
+		self._sync_directory()
+
+	# Publish the file as a copy of the same content in the dedupe store, if
+	# it's there, and drop the partial file.  Returns True if it was
+	def _publish_stored(self):
+		if self._store is None or self._digest is None:
+			return False
+		try:
+			placed = self._store.place(self._filepath, self._digest[0],
+																 self._digest[1], self._filesize)
+		except OSError as e:
+			if e.errno == errno.EEXIST:
+				self._unlink(self._temppath)
+				raise StateError("File already exists", "Finish Error: -1")
+			raise
+		if placed:
+			self._unlink(self._temppath)
+			self._published = True
+			self._sync_directory()
+		return placed
+
+	# Make sure the new directory entry is on disk too, where the OS allows it
+	def _sync_directory(self):
+		try:
+			fd = os.open(os.path.dirname(self._filepath) or ".", os.O_RDONLY)
+		except OSError:
+			return
+		try:
+			os.fsync(fd)
+		except OSError:
+			pass
 		finally:
-			self._tempfile.close()
-			self._tempfile = None
+			os.close(fd)
@@ -0,0 +1,205 @@
+"""Specifies the Metrics class, and the metrics the server keeps."""
+
+# Standard library imports
+from __future__ import print_function # For python earlier than 3
+import bisect
+import threading
+
+# Metric names
+REQUESTS = "frontporch_requests_total"
+LATENCY = "frontporch_request_duration_seconds"
+SENT = "frontporch_sent_bytes_total"
+RECEIVED = "frontporch_received_bytes_total"
+CONNECTIONS = "frontporch_active_connections"
+UPLOADS = "frontporch_uploads_total"
+UPLOADED = "frontporch_upload_bytes_total"
+UPLOADTIME = "frontporch_upload_seconds_total"
+
+# Metric types
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+# The upper bounds of the histograms' buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+									 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# The type and help text of each metric, in the order they're shown
+_DEFINITIONS = (
+	(REQUESTS, COUNTER, "Requests answered, by URL classification."),
+	(LATENCY, HISTOGRAM, "Time from a request to the end of its response, by "
+											 "URL classification.  Uploads take until they end."),
+	(SENT, COUNTER, "Bytes sent to clients."),
+	(RECEIVED, COUNTER, "Bytes received from clients, uploads included."),
+	(CONNECTIONS, GAUGE, "Client connections open now."),
+	(UPLOADS, COUNTER, "Uploads ended, by result."),
+	(UPLOADED, COUNTER, "File data received by uploads.  Its rate is the upload "
+											"throughput."),
+	(UPLOADTIME, COUNTER, "Time spent receiving uploads.  Bytes over seconds is "
+												"the average upload speed."))
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def shared(settings):
+	"""Return this process's Metrics, setting it up the first time.
+
+		settings - a dictionary, unused for now.
+
+	"""
+	global _shared
+	with _shared_lock:
+		if _shared is None:
+			_shared = Metrics()
+		return _shared
+
+class _Shard():
+	"""The counts one thread has made.  Only that thread changes them."""
+
+	def __init__(self):
+		self.values = dict()	# Counter and gauge values by (name, labels)
+		# Histograms by (name, labels).  Each is a count per bucket, with one
+		# for +Inf, followed by the sum of the observations
+		self.histograms = dict()
+
+	def merge(self, other):
+		"""Add another shard's counts to this one's."""
+		for key, value in other.values.copy().items():
+			self.values[key] = self.values.get(key, 0) + value
+		for key, counts in other.histograms.copy().items():
+			mine = self.histograms.get(key)
+			if mine is None:
+				self.histograms[key] = list(counts)
+			else:
+				self.histograms[key] = [a + b for a, b in zip(mine, counts)]
+
+class _Reaper():
+	"""Fold a thread's shard into the retired counts when the thread ends, so
+	threads that come and go don't leave their shards behind."""
+
+	def __init__(self, metrics, shard):
+		self._metrics = metrics
+		self._shard = shard
+
+	def __del__(self):
+		self._metrics._retire(self._shard)
+
+class Metrics():
+	"""Count what the server does, cheaply enough to do on every request.
+
+	Each thread counts into its own shard, so counting takes no locks.  The
+	shards are only added up when the metrics are read, which is rare.
+
+	Labels are a tuple of (name, value) pairs, in the order they're shown.
+
+	"""
+
+	def __init__(self):
+		self._local = threading.local()
+		self._lock = threading.Lock()	# Protects the shard list and retired
+		self._shards = list()
+		self._retired = _Shard()	# The counts of threads that have ended
+		self._collectors = list()
+
+	def add(self, name, amount=1, labels=()):
+		"""Add amount to a counter or gauge.  Gauges go down by adding less
+			than 0."""
+		values = self._shard().values
+		key = (name, labels)
+		values[key] = values.get(key, 0) + amount
+
+	def observe(self, name, value, labels=()):
+		"""Count value in a histogram with LATENCY_BUCKETS."""
+		histograms = self._shard().histograms
+		key = (name, labels)
+		counts = histograms.get(key)
+		if counts is None:
+			counts = [0] * (len(LATENCY_BUCKETS) + 2)
+			histograms[key] = counts
+		counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+		counts[-1] += value
+
+	def add_collector(self, collector):
+		"""Have collector called whenever the metrics are read.  It returns a
+			list of (name, type, help, value) for metrics worked out then."""
+		with self._lock:
+			self._collectors.append(collector)
+
+	def render(self):
+		"""Return the metrics in the Prometheus text exposition format."""
+		total = _Shard()
+		with self._lock:
+			total.merge(self._retired)
+			for shard in self._shards:
+				total.merge(shard)
+			collectors = list(self._collectors)
+		lines = list()
+		for name, metrictype, helptext in _DEFINITIONS:
+			lines.append("# HELP " + name + " " + helptext)
+			lines.append("# TYPE " + name + " " + metrictype)
+			if metrictype == HISTOGRAM:
+				lines.extend(self._render_histograms(name, total.histograms))
+				continue
+			for (valuename, labels), value in sorted(total.values.items()):
+				if valuename == name:
+					lines.append(name + self._labels(labels) + " " +
+											 self._number(value))
+		for collector in collectors:
+			for name, metrictype, helptext, value in collector():
+				lines.append("# HELP " + name + " " + helptext)
+				lines.append("# TYPE " + name + " " + metrictype)
+				lines.append(name + " " + self._number(value))
+		return "\n".join(lines) + "\n"
+
+	# Return the lines showing each histogram with the name
+	def _render_histograms(self, name, histograms):
+		lines = list()
+		for (histname, labels), counts in sorted(histograms.items()):
+			if histname != name:
+				continue
+			bounds = [self._number(bound) for bound in LATENCY_BUCKETS]
+			cumulative = 0
+			for bound, count in zip(bounds + ["+Inf"], counts):
+				cumulative += count
+				lines.append(name + "_bucket" +
+										 self._labels(labels + (("le", bound),)) + " " +
+										 str(cumulative))
+			lines.append(name + "_sum" + self._labels(labels) + " " +
+									 self._number(counts[-1]))
+			lines.append(name + "_count" + self._labels(labels) + " " +
+									 str(cumulative))
+		return lines
+
+	# Return the labels as shown after a metric name
+	def _labels(self, labels):
+		if not labels:
+			return ""
+		return "{" + ",".join(
+			name + "=\"" + str(value).replace("\\", "\\\\").replace(
+				"\"", "\\\"").replace("\n", "\\n") + "\""
+			for name, value in labels) + "}"
+
+	# Return a metric value as text
+	def _number(self, value):
+		if isinstance(value, float):
+			return repr(value)
+		return str(value)
+
+	# Return this thread's shard, starting one if it hasn't got one
+	def _shard(self):
+		try:
+			return self._local.shard
+		except AttributeError:
+			pass
+		shard = _Shard()
+		with self._lock:
+			self._shards.append(shard)
+		self._local.shard = shard
+		self._local.reaper = _Reaper(self, shard)
+		return shard
+
+	# Keep the counts of a thread that has ended, and forget its shard
+	def _retire(self, shard):
+		with self._lock:
+			self._retired.merge(shard)
+			self._shards.remove(shard)
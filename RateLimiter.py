@@ -0,0 +1,155 @@
+"""Specifies the RateLimiter and TokenBucket classes."""
+
+# Standard library imports
+from __future__ import print_function # For python earlier than 3
+import threading
+import time
+
+# Directions data moves in, from the server's side
+SEND = "send"
+RECV = "recv"
+
+# A bucket holds this many seconds' worth of its rate, so a transfer that's
+# been quiet can burst a little
+_BURST_SECONDS = 0.25
+# Rate limited data is sent in pieces of this many seconds' worth of the
+# tightest limit, so transfers take turns often enough to share fairly
+_QUANTUM_SECONDS = 0.05
+# But pieces are never smaller than this, in bytes
+_MIN_QUANTUM = 4096
+# Idle client buckets are swept out once there are more than this many
+_MIN_SWEEP = 1024
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def shared(settings):
+	"""Return this process's RateLimiter, setting it up the first time.
+
+		settings - a dictionary which may have keys sendratelimit,
+							 recvratelimit, clientsendratelimit and clientrecvratelimit
+							 (bytes per second, 0 for no limit).
+
+	"""
+	global _shared
+	with _shared_lock:
+		if _shared is None:
+			rates = dict()
+			clientrates = dict()
+			for direction in (SEND, RECV):
+				rates[direction] = int(settings.get(direction + "ratelimit", 0))
+				clientrates[direction] = int(settings.get(
+					"client" + direction + "ratelimit", 0))
+			_shared = RateLimiter(rates, clientrates)
+		return _shared
+
+class TokenBucket():
+	"""Let data through at rate bytes per second, with bursts of up to burst.
+
+	Data is paid for after it moves, so the bucket can go into debt.  Whoever
+	put it there waits until the debt is paid off, and everyone sharing the
+	bucket waits their turn behind it.
+
+	"""
+
+	def __init__(self, rate, burst):
+		self._rate = float(rate)
+		self._burst = burst
+		self._tokens = burst
+		self._stamp = time.time()
+
+	def take(self, amount, now):
+		"""Pay for amount bytes.  Returns the seconds to wait before moving
+			more, 0 if there's no need."""
+		self._refill(now)
+		self._tokens -= amount
+		if self._tokens >= 0:
+			return 0
+		return -self._tokens / self._rate
+
+	def idle(self, now):
+		"""Return True if the bucket has filled up since it was last used."""
+		self._refill(now)
+		return self._tokens >= self._burst
+
+	# Add the tokens earned since the last refill
+	def _refill(self, now):
+		self._tokens = min(self._burst,
+											 self._tokens + (now - self._stamp) * self._rate)
+		self._stamp = now
+
+class RateLimiter():
+	"""Limit the bandwidth used in each direction, overall and by each client.
+
+	Transfers move a piece (the quantum) at a time and then pay for it,
+	waiting as long as the limits say.  The buckets charge everyone in the
+	order they pay, so active transfers take turns fairly, and a small response
+	goes out straight away unless its own connection is still paying.
+
+	"""
+
+	def __init__(self, rates, clientrates):
+		"""Setup the limits.  rates and clientrates map SEND and RECV to bytes
+			per second overall, and for each client address.  0 is no limit."""
+		self._buckets = dict()
+		self._clientrates = dict()
+		self._clientbuckets = dict()	# Maps (direction, client) to its bucket
+		self._quanta = dict()
+		self._sweepat = _MIN_SWEEP
+		self._lock = threading.Lock()
+		for direction in (SEND, RECV):
+			limits = list()
+			if rates.get(direction, 0) > 0:
+				rate = rates[direction]
+				self._buckets[direction] = TokenBucket(rate, self._burst(rate))
+				limits.append(rate)
+			if clientrates.get(direction, 0) > 0:
+				self._clientrates[direction] = clientrates[direction]
+				limits.append(clientrates[direction])
+			if limits:
+				self._quanta[direction] = max(
+					int(min(limits) * _QUANTUM_SECONDS), _MIN_QUANTUM)
+
+	def quantum(self, direction):
+		"""Return the most bytes to move in one piece, or None if there's no
+			limit in that direction."""
+		return self._quanta.get(direction)
+
+	def take(self, direction, client, amount):
+		"""Pay for amount bytes moved to or from client.  Returns the seconds
+			to wait before moving more, 0 if there's no need."""
+		if direction not in self._quanta:
+			return 0
+		now = time.time()
+		delay = 0
+		with self._lock:
+			bucket = self._buckets.get(direction)
+			if bucket is not None:
+				delay = bucket.take(amount, now)
+			if direction in self._clientrates:
+				delay = max(delay, self._client_bucket(direction, client,
+																							 now).take(amount, now))
+		return delay
+
+	# Return the bucket for a client and direction, starting one if need be
+	def _client_bucket(self, direction, client, now):
+		bucket = self._clientbuckets.get((direction, client))
+		if bucket is None:
+			if len(self._clientbuckets) >= self._sweepat:
+				self._sweep(now)
+			rate = self._clientrates[direction]
+			bucket = TokenBucket(rate, self._burst(rate))
+			self._clientbuckets[(direction, client)] = bucket
+		return bucket
+
+	# Forget the buckets of clients that haven't moved data lately.  They'd be
+	# full, so starting them again is the same
+	def _sweep(self, now):
+		for key, bucket in list(self._clientbuckets.items()):
+			if bucket.idle(now):
+				del self._clientbuckets[key]
+		self._sweepat = max(_MIN_SWEEP, 2 * len(self._clientbuckets))
+
+	# Return the burst a bucket with rate allows
+	def _burst(self, rate):
+		return max(int(rate * _BURST_SECONDS), _MIN_QUANTUM)
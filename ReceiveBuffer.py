@@ -0,0 +1,104 @@
+"""Specifies the ReceiveBuffer class."""
+
+# Standard library imports
+from __future__ import print_function # For python earlier than 3
+import sys
+
+class ReceiveBuffer():
+	"""A reusable buffer which sockets receive straight into.
+
+	Unconsumed data sits between a start and an end position in one
+	preallocated bytearray.  Consuming from the front just moves the start
+	position, and payloads are handed out as memoryviews instead of copies.
+	Data is only moved when the free space at the end runs low, and the
+	bytearray only grows when a payload won't fit at all - never past maxsize.
+
+	"""
+
+	def __init__(self, size=1024*256, maxsize=None):
+		"""Setup a buffer which starts out holding size bytes.
+
+			If maxsize is given the buffer will refuse to grow past it, raising
+			BufferError instead.
+
+		"""
+		self._buf = bytearray(size)
+		self._maxsize = maxsize
+		self._start = 0
+		self._end = 0
+
+	def __len__(self):
+		return self._end - self._start
+
+	def recv_into(self, conn, amount=0):
+		"""Receive from a socket into the buffer, making room for amount bytes.
+
+			Returns the number of bytes received, which is 0 if the connection
+			was closed.  Socket errors are left for the caller.
+
+			Throws: BufferError
+
+		"""
+		self._make_room(max(amount, len(self) + 1))
+		received = conn.recv_into(memoryview(self._buf)[self._end:])
+		self._end += received
+		return received
+
+	def extend(self, data):
+		"""Copy data onto the end of the buffer.
+
+			Throws: BufferError
+
+		"""
+		self._make_room(len(self) + len(data))
+		self._buf[self._end:self._end + len(data)] = data
+		self._end += len(data)
+
+	def peek(self, amount):
+		"""Return a copy of up to amount bytes from the front of the buffer."""
+		return self._buf[self._start:min(self._start + amount, self._end)]
+
+	def take(self, amount):
+		"""Consume amount bytes from the front of the buffer and return them.
+
+			On Python 3 this is a memoryview into the buffer, which is only valid
+			until more data is put into the buffer.
+
+		"""
+		if sys.version_info[0] >= 3:
+			data = memoryview(self._buf)[self._start:self._start + amount]
+		else:
+			# Python 2's memoryview can't stand in for a bytearray
+			data = self._buf[self._start:self._start + amount]
+		self.consume(amount)
+		return data
+
+	def consume(self, amount):
+		"""Drop amount bytes from the front of the buffer."""
+		self._start = min(self._start + amount, self._end)
+		if self._start == self._end:
+			self._start = self._end = 0
+
+	# Make sure the buffer can hold needed unconsumed bytes, and still has some
+	# space free at the end to receive into
+	def _make_room(self, needed):
+		length = len(self)
+		if needed > len(self._buf):
+			# Too small - move to a bigger bytearray.  Old views stay valid
+			newsize = max(needed, len(self._buf) * 2)
+			if self._maxsize is not None:
+				if needed > self._maxsize:
+					raise BufferError("Receive buffer limit exceeded")
+				newsize = min(newsize, self._maxsize)
+			newbuf = bytearray(newsize)
+			newbuf[0:length] = self._buf[self._start:self._end]
+			self._buf = newbuf
+			self._start = 0
+			self._end = length
+		elif (self._start > 0 and
+					(self._start + needed > len(self._buf) or
+					 len(self._buf) - self._end < len(self._buf) // 4)):
+			# Move the unconsumed data to the front to free up the end
+			self._buf[0:length] = self._buf[self._start:self._end]
+			self._start = 0
+			self._end = length
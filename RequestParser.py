@@ -0,0 +1,94 @@
+"""Specifies the RequestParser class."""
+
+# Standard library imports
+from __future__ import print_function # For python earlier than 3
+
+# Local imports
+from Error import ProtocolError
+
+class RequestParser():
+	"""Split a stream of received bytes into HTTP request headers.
+
+	Data can be fed in however it arrives - a header may be split across many
+	reads, and one read may hold several pipelined requests.  Request bodies
+	are skipped, since only GET is served.
+
+	Data items:
+		buffered - get - The number of received bytes not yet handed out
+		maxheadersize - get - The longest request header that will be accepted
+
+	"""
+
+	def __init__(self, maxheadersize=65536):
+		"""Setup a parser which refuses headers longer than maxheadersize."""
+		self.maxheadersize = maxheadersize
+		self._buf = bytearray()
+		self._scanpos = 0	# Where to resume looking for the end of the header
+		self._skip = 0	# Bytes of request body still to be thrown away
+
+	def feed(self, data):
+		"""Add received data to the parser."""
+		self._buf.extend(data)
+
+	def next_request(self):
+		"""Return the next complete request header, or None if there isn't one.
+
+			The header is returned as bytes, including the blank line ending it.
+
+			Throws: ProtocolError
+
+		"""
+		self._skip_body()
+		if self._skip > 0:
+			return None
+		# Blank lines between pipelined requests are allowed
+		while self._buf[:2] == b"\r\n":
+			del self._buf[:2]
+		end = self._buf.find(b"\r\n\r\n", self._scanpos)
+		if end < 0:
+			if len(self._buf) > self.maxheadersize:
+				raise ProtocolError("Request header too large", "Invalid Headers")
+			# The end marker may be split across reads - back up a little
+			self._scanpos = max(len(self._buf) - 3, 0)
+			return None
+		end += 4
+		header = bytes(self._buf[:end])
+		del self._buf[:end]
+		self._scanpos = 0
+		self._skip = self._body_length(header)
+		return header
+
+	def take_buffer(self):
+		"""Remove and return everything received after the last request."""
+		self._skip_body()
+		data = bytes(self._buf)
+		self._buf = bytearray()
+		self._scanpos = 0
+		return data
+
+	# Throw away as much of a request body as has arrived
+	def _skip_body(self):
+		if self._skip > 0:
+			skipped = min(self._skip, len(self._buf))
+			del self._buf[:skipped]
+			self._skip -= skipped
+
+	# Find the length of the body following a request header
+	def _body_length(self, header):
+		for line in header.split(b"\r\n")[1:]:
+			name, sep, value = line.partition(b":")
+			name = name.strip().lower()
+			if name == b"transfer-encoding":
+				raise ProtocolError("Request bodies must have a length",
+														"Invalid Headers")
+			elif name == b"content-length":
+				value = value.strip()
+				if not value.isdigit():
+					raise ProtocolError("Invalid Content-Length", "Invalid Headers")
+				return int(value)
+		return 0
+
+	def _get_buffered(self):
+		return len(self._buf)
+
+	buffered = property(_get_buffered)
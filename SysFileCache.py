@@ -0,0 +1,140 @@
+"""Specifies the SysFileCache class."""
+
+# Standard library imports
+from __future__ import print_function # For python earlier than 3
+import hashlib
+import logging
+import os
+import stat
+import threading
+import time
+
+# Local imports
+import Compression
+
+# Files bigger than this are left on disk and sent from there
+_MAX_CACHED = 1024*1024
+# A cached file is checked against the disk at most this often, in seconds
+_RECHECK_INTERVAL = 1.0
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def shared(settings):
+	"""Return this process's SysFileCache, loading it the first time.
+
+		settings - a dictionary which requires key systemfiledir, and may have
+							 keys errorfile and dirhtmlfile for files kept elsewhere.
+
+	"""
+	global _shared
+	with _shared_lock:
+		if _shared is None:
+			extras = [settings[name] for name in ("errorfile", "dirhtmlfile")
+								if name in settings]
+			_shared = SysFileCache(settings["systemfiledir"], extras)
+		return _shared
+
+class SysFile():
+	"""One cached system file, with a compressed copy per content coding.
+
+	Data items:
+		filename - The file's name on disk
+		bodies - The file's contents by content coding, only for the codings
+						 that make it smaller.  Identity is always there
+		etags - A strong ETag for each of the bodies
+		codings - The content codings in bodies, best first
+		responses - Complete responses built from the bodies, for the caller
+								to fill in and reuse as it likes
+
+	"""
+
+	def __init__(self, filename, body, stamp):
+		self.filename = filename
+		self.stamp = stamp	# The file's size and mtime when it was read
+		self.checked = time.time()	# When stamp was last compared to the file
+		digest = hashlib.sha1(body).hexdigest()
+		self.bodies = {Compression.IDENTITY: body}
+		self.etags = {Compression.IDENTITY: "\"" + digest + "\""}
+		self.codings = list()
+		for coding in Compression.available():
+			compressed = Compression.compress(body, coding)
+			if len(compressed) < len(body):
+				self.bodies[coding] = compressed
+				self.etags[coding] = "\"" + digest + "-" + coding + "\""
+				self.codings.append(coding)
+		self.responses = dict()
+
+	def negotiate(self, acceptencoding):
+		"""Return the content coding to send, given an Accept-Encoding value."""
+		return Compression.negotiate(acceptencoding, self.codings)
+
+class SysFileCache():
+	"""Keep the server's own small files in memory, ready to send.
+
+	Everything in the system file directory is read and compressed at
+	startup.  Files are checked against the disk at most once a second, and
+	read again if they've changed, so editing one takes effect without a
+	restart.
+
+	"""
+
+	def __init__(self, sysfiledir, extras=()):
+		"""Load the files in sysfiledir, and each of the files named in extras."""
+		self._files = dict()
+		self._lock = threading.Lock()
+		names = list()
+		try:
+			names = [os.path.join(sysfiledir, name)
+							 for name in os.listdir(sysfiledir)]
+		except OSError:
+			logging.warning("SysFileCache: Couldn't list %s", sysfiledir)
+		for filename in names + list(extras):
+			self.get(filename)
+
+	def get(self, filename):
+		"""Return the current SysFile for filename, or None if it's missing,
+			not a regular file or too big to cache."""
+		entry = self._files.get(filename)
+		now = time.time()
+		if entry is not None and now - entry.checked < _RECHECK_INTERVAL:
+			return entry
+		with self._lock:
+			entry = self._files.get(filename)
+			if entry is not None and now - entry.checked < _RECHECK_INTERVAL:
+				return entry
+			stamp = self._stamp(filename)
+			if entry is not None and stamp == entry.stamp:
+				entry.checked = now
+				return entry
+			entry = self._load(filename, stamp)
+			if entry is None:
+				self._files.pop(filename, None)
+			else:
+				self._files[filename] = entry
+			return entry
+
+	# Return the size and mtime of a regular file, or None
+	def _stamp(self, filename):
+		try:
+			st = os.stat(filename)
+		except OSError:
+			return None
+		if not stat.S_ISREG(st.st_mode):
+			return None
+		return (st.st_size, getattr(st, "st_mtime_ns", st.st_mtime))
+
+	# Read a file into a new SysFile, or return None if it shouldn't be cached
+	def _load(self, filename, stamp):
+		if stamp is None or stamp[0] > _MAX_CACHED:
+			return None
+		try:
+			with open(filename, "rb") as f:
+				body = f.read(_MAX_CACHED + 1)
+		except IOError:
+			return None
+		if len(body) > _MAX_CACHED:
+			return None
+		# Stamp the file as it was before it was read, so a change during the
+		# read is picked up next time
+		return SysFile(filename, body, stamp)
@@ -7,10 +7,13 @@ import base64
 import sys
 import hashlib
 import os.path
+import URLCache
+import FileWriter
 if sys.version_info[0] >= 3:
-	from urllib.parse	import unquote_plus
+	from urllib.parse	import unquote_plus, parse_qs
 else:
 	from urllib import unquote_plus
+	from urlparse import parse_qs
 
 # URL Classifications
 URL_ERR = "err"
@@ -18,6 +21,14 @@ URL_WS = "websocket"
 URL_FILE = "file"
 URL_DIR = "dir"
 URL_SYS = "sys"
+URL_LIST = "listing"
+URL_METRICS = "metrics"
+
+# The system URL of the JSON directory listing API.  Its dir query parameter
+# names the directory
+LISTING_NAME = "listing"
+# The system URL of the server's metrics
+METRICS_NAME = "metrics"
 
 _WS_MAGIC_KEY = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
 _VALID_URL_CHARS = string.ascii_letters + string.digits + "/. -_"
@@ -31,11 +42,15 @@ class URL():
 		URL_FILE - This URL requests a file download
 		URL_DIR - This URL requests a directory listing
 		URL_SYS - This URL requests a system file
+		URL_LIST - This URL requests a page of a directory listing as JSON
+		URL_METRICS - This URL requests the server's metrics
 
 	Data items:
 		websocket_key - set/get - The websocket_key specified in a websocket header
+		websocket_extensions - set/get - The extensions a websocket request offers
 		accept_key - get - The calculated accept key corresponding to websocket_key
 		filename - A server filename corresponding to the requested URL
+		query - A dictionary of the URL's query string parameters
 		classification - The classification for the URL, values as described above
 
 	"""
@@ -44,16 +59,23 @@ class URL():
 		"""Initialize a URL object.
 
 			settings - a dictionary which requires keys sysdirmagicprefix, basedir,
-								 and systemfiledir.
+								 and systemfiledir, and may have key metrics and the URLCache
+								 keys.
 
 		"""
 		self._urlString = urlString
+		# Anything after a ? is the query string, not part of the file name
+		self._path, sep, self._querystring = urlString.partition("?")
 		self._sysdirprefix = settings["sysdirmagicprefix"]
 		self._basedir = settings["basedir"]
 		self._sysfiledir = settings["systemfiledir"]
+		self._metrics = (settings.get("metrics", "yes").lower() in
+										 ("yes", "true", "1"))
+		self._cache = URLCache.shared(settings)
 		self._filename = None
 		self._classification = None
 		self.websocket_key = None
+		self.websocket_extensions = None
 
 	def __str__(self):
 		"""Return the text version of the URL."""
@@ -62,14 +84,35 @@ class URL():
 	__repr__ = __str__
 
 	#TODO: Test for bugs in the classification
-	# Resolve the URL into a filename, and classify it.  Cache the result
+	# Resolve the URL into a filename, and classify it.  Cache the result, and
+	# share it with later requests for the same URL.  Websocket URLs are uploads,
+	# which need checking every time
 	def _resolve(self):
+		if self.websocket_key is None:
+			cached = self._cache.get(self._urlString)
+			if cached is not None:
+				self._filename, self._classification = cached
+				return
 		filename, issystemfile = self._build_filename()
 		response = URL_ERR
 		if filename is None:
 			pass
+		elif (not issystemfile and
+					FileWriter.is_internal(os.path.basename(filename))):
+			filename = None	# Unfinished uploads aren't served or uploaded to
 		elif self.websocket_key is not None:
 			response = URL_WS
+		elif issystemfile and filename == os.path.join(self._sysfiledir,
+																									 LISTING_NAME):
+			# The listing API names the directory to list in the query string
+			filename = self._build_listing_dirname()
+			if filename is not None and os.path.isdir(filename):
+				response = URL_LIST
+			else:
+				filename = None
+		elif (issystemfile and self._metrics and
+					filename == os.path.join(self._sysfiledir, METRICS_NAME)):
+			response = URL_METRICS
 		elif os.path.isfile(filename) and issystemfile:
 			response = URL_SYS
 		elif os.path.isfile(filename) and not issystemfile:
@@ -81,10 +124,12 @@ class URL():
 			response = URL_ERR
 		self._filename = filename
 		self._classification = response
+		if response != URL_ERR and self.websocket_key is None:
+			self._cache.put(self._urlString, filename, response)
 
 	# Return the corresponding file name, and if it's a system file
 	def _build_filename(self):
-		parsed = unquote_plus(self._urlString).lstrip("/ ")
+		parsed = unquote_plus(self._path).lstrip("/ ")
 		basedir = self._basedir
 		# Handle the case where the URL refers to a system file
 		issystemfile = parsed.startswith(self._sysdirprefix)
@@ -96,6 +141,13 @@ class URL():
 			filename = os.path.join(basedir, parsed)
 		return filename, issystemfile
 
+	# Return the directory a listing API URL asks for
+	def _build_listing_dirname(self):
+		parsed = self.query.get("dir", "/").lstrip("/ ")
+		if not self._validate_contents(parsed):
+			return None
+		return os.path.join(self._basedir, parsed)
+
 	# Ensure that the url contains only valid characters
 	def _validate_contents(self, parsedurl):
 		if (parsedurl.strip(_VALID_URL_CHARS) != "" or 
@@ -124,6 +176,12 @@ class URL():
 			self._resolve()
 		return self._classification
 
+	# Return the query string parameters, with the first value of each
+	def _get_query(self):
+		parsed = parse_qs(self._querystring)
+		return dict((name, values[0]) for name, values in parsed.items())
+
 	accept_key = property(_gen_accept_key)
 	filename = property(_get_filename)
 	classification = property(_get_classification)
+	query = property(_get_query)
@@ -0,0 +1,72 @@
+"""Specifies the URLCache class."""
+
+# Standard library imports
+from __future__ import print_function # For python earlier than 3
+import collections
+import threading
+import time
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def shared(settings):
+	"""Return this process's URLCache, setting it up the first time.
+
+		settings - a dictionary which may have keys urlcachesize (entries, 0 to
+							 turn caching off) and urlcachettl (seconds).
+
+	"""
+	global _shared
+	with _shared_lock:
+		if _shared is None:
+			_shared = URLCache(int(settings.get("urlcachesize", 4096)),
+												 float(settings.get("urlcachettl", 2)))
+		return _shared
+
+class URLCache():
+	"""A least recently used cache of what URLs resolve to.
+
+	Each entry is kept for at most ttl seconds, so a file that's deleted or
+	replaced by a directory is noticed soon after.  Only URLs that resolved to
+	something are cached - a URL that didn't is checked again every time, so
+	new files, uploads included, can be downloaded as soon as they appear.
+
+	"""
+
+	def __init__(self, maxentries, ttl):
+		"""Setup a cache of at most maxentries URLs, each kept for ttl seconds."""
+		self._maxentries = maxentries
+		self._ttl = ttl
+		self._entries = collections.OrderedDict()	# Least recently used first
+		self._lock = threading.Lock()
+
+	def get(self, urlstring):
+		"""Return the (filename, classification) urlstring resolved to, or None
+			if it's not cached."""
+		if self._maxentries <= 0:
+			return None
+		now = time.time()
+		with self._lock:
+			entry = self._entries.pop(urlstring, None)
+			if entry is None or now - entry[2] > self._ttl:
+				return None
+			self._entries[urlstring] = entry
+			return entry[0], entry[1]
+
+	def put(self, urlstring, filename, classification):
+		"""Remember what urlstring resolved to."""
+		if self._maxentries <= 0:
+			return
+		with self._lock:
+			self._entries.pop(urlstring, None)
+			self._entries[urlstring] = (filename, classification, time.time())
+			while len(self._entries) > self._maxentries:
+				self._entries.popitem(last=False)
+
+	def invalidate(self, urlstring=None):
+		"""Forget what urlstring resolved to, or every URL."""
+		with self._lock:
+			if urlstring is None:
+				self._entries.clear()
+			else:
+				self._entries.pop(urlstring, None)
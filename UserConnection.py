@@ -1,37 +1,131 @@
 # Standard library imports
 from __future__ import print_function # For python earlier than 3
-import threading
 import json
 import os.path
+import time
 import socket
 import logging
-from datetime import datetime
+import binascii
+import hashlib
+from email.utils import formatdate, parsedate_tz, mktime_tz
 
 # Local imports
 import URL
+import DirCache
+import DirListing
 import Websocket
+import RequestParser
+import SysFileCache
+import Compression
+import CompressCache
+import Metrics
+import RateLimiter
+import Digest
 from Error import StateError, ProtocolError
 
-class UserConnection(threading.Thread):
+# socket.sendfile copies file data to sockets in the kernel (Python 3.5+)
+_HAVE_SENDFILE = (hasattr(os, "sendfile") and
+									hasattr(socket.socket, "sendfile"))
+# How long browsers may keep system scripts and stylesheets, in seconds
+_CACHE_LIFETIME = 365*24*60*60
+# The digits a Range header's numbers may have.  str.isdigit also accepts
+# ones such as superscripts, which int can't parse
+_DIGITS = "0123456789"
+# How often an idle kept-alive connection checks whether its thread is wanted
+# for another connection, in seconds
+_IDLE_CHECK_INTERVAL = 0.25
+
+def set_nodelay(conn):
+	"""Turn off Nagle's algorithm on an accepted connection.  A response's
+		header and body go out in separate writes, and on a kept-alive
+		connection the body would otherwise wait for the client's delayed ACK
+		of the header."""
+	try:
+		conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+	except (socket.error, AttributeError):
+		pass  # Not a TCP socket
+
+class FileRegion():
+	"""A part of an open file, to be sent as part of a response.
+
+	Data items:
+		fileobj - The open file
+		offset - Where in the file the region starts
+		count - How many bytes of the file to send
+
+	"""
+
+	def __init__(self, fileobj, offset, count):
+		self.fileobj = fileobj
+		self.offset = offset
+		self.count = count
+
+	def advance(self, amount):
+		"""Mark amount bytes from the front of the region as sent."""
+		self.offset += amount
+		self.count -= amount
+
+class UserConnection():
 	"""Handle a user connection.  It does its thing and cleans up when done."""
 	# These consts tell what type of header to build
 	# TODO: Would it make sense to make "header" a class?
 	HEAD_404 = "404"
+	HEAD_503 = "503"
+	HEAD_416 = "416"
+	HEAD_304 = "304"
 	HEAD_FILE = "file"
+	HEAD_RANGE = "range"
 	HEAD_HTML = "html"
 	HEAD_JS = "js"
 	HEAD_CSS = "css"
+	HEAD_JSON = "json"
+	HEAD_METRICS = "metrics"
+	# Requests for more byte ranges than this get the whole file instead
+	MAX_RANGES = 64
+
+	def __init__(self, settings, conn, addr, yieldidle=None):
+		"""Setup the handler with a connection and address to handle.
+
+			yieldidle, if given, is called now and then while a kept-alive
+			connection is idle.  If it returns True the connection is closed, so
+			the thread handling it is free for another.
 
-	def __init__(self, settings, conn, addr):
-		"""Setup the handler with a connection and address to handle."""
-		threading.Thread.__init__(self)
+		"""
 		self._conn = conn
+		self._yieldidle = yieldidle
 		self._addr = addr
 		self._settings = settings
+		self._headers = dict()	# The request's header fields, by lowercase name
+		self._keepalive = False	# Whether to keep the connection after a response
+		self._http11 = False	# Whether the request was HTTP/1.1
+		self._requests = 0	# How many requests have been answered
+		self._keepalivetimeout = float(settings.get("keepalivetimeout", 15))
+		self._parser = RequestParser.RequestParser(
+			int(settings.get("maxheadersize", 65536)))
+		self._usesendfile = (settings.get("usesendfile", "yes").lower() in
+												 ("yes", "true", "1"))
+		self._chunksize = int(settings.get("sendchunksize", 65536))
+		self._compression = (settings.get("compression", "yes").lower() in
+												 ("yes", "true", "1"))
+		# Compressed downloads are sent chunked without sendfile, and can't be
+		# resumed with ranges, so they're only compressed when asked for
+		compressdownloads = settings.get("compressdownloads", "no").lower()
+		self._compressdownloads = (self._compression and
+															 compressdownloads in ("yes", "true", "1"))
+		self._metrics = Metrics.shared(settings)
+		self._limiter = RateLimiter.shared(settings)
+		self._clientip = addr[0] if addr else None	# Rate limits are per address
+		# Sends are broken into pieces this big when the send rate is limited
+		self._sendquantum = self._limiter.quantum(RateLimiter.SEND)
+		if self._sendquantum is not None:
+			self._sendquantum = min(self._sendquantum, self._chunksize)
+		self._responsestart = None	# When the response being sent was requested
+		self._responselabels = ()	# The labels its latency is counted under
 
 	def run(self):
-		"""Executed when the thread is started"""
+		"""Handle the connection to completion.  Run this in its own thread."""
 		logging.info("%s: Connection Received", self._addr)
+		self._metrics.add(Metrics.CONNECTIONS)
 		# Close the connection regardless of exceptions
 		try:
 			self._handle_connection()
@@ -41,21 +135,92 @@ class UserConnection(threading.Thread):
 			logging.error("%s: Unknown error occurred", self._addr)
 			raise
 		finally:
+			self._end_response()
+			self._metrics.add(Metrics.CONNECTIONS, -1)
 			self._conn.close()
 			logging.info("%s: Connection Closed", self._addr)
 
-	# Actually handle the connection
+	def reject(self):
+		"""Turn the connection away quickly because the server is too busy."""
+		try:
+			# Don't let a slow client hold up whoever is turning it away
+			self._conn.settimeout(1)
+			url = self._process_headers(self._conn.recv(4096))
+			self._keepalive = False
+			if url.websocket_key is not None:
+				ws = Websocket.Websocket(self._conn, self._addr, url, self._settings)
+				ws.handle_busy()
+			else:
+				self._send_busy()
+		except (socket.error, ProtocolError):
+			pass  # It was getting turned away anyway
+		finally:
+			self._conn.close()
+
+	# Actually handle the connection, answering requests until it's done
 	def _handle_connection(self):
 		self._conn.settimeout(5)
-		try:
-			data = self._conn.recv(1024)
-			url = self._process_headers(data)
-		except socket.error:
-			logging.error("%s: Fatal socket timeout", self._addr)
-		except ProtocolError:
-			logging.error("%s: Invalid headers specified", self._addr)
-		else:
+		while True:
+			try:
+				data = self._read_request()
+				if data is None:
+					return  # The client closed the connection between requests
+				url = self._process_headers(data)
+			except socket.timeout:
+				if self._requests == 0:
+					logging.error("%s: Fatal socket timeout", self._addr)
+				return  # Otherwise a kept-alive connection just went idle
+			except socket.error:
+				logging.error("%s: Fatal socket timeout", self._addr)
+				return
+			except ProtocolError:
+				logging.error("%s: Invalid headers specified", self._addr)
+				return
 			self._respond(url)
+			self._end_response()
+			if not self._keepalive or not self._await_request():
+				return
+
+	# Wait for the next request on a kept-alive connection to start arriving.
+	# Return False if the connection should close instead
+	def _await_request(self):
+		self._conn.settimeout(self._keepalivetimeout)
+		if self._yieldidle is None or self._parser.buffered > 0:
+			return True
+		# Wake up now and then to check whether the thread is wanted elsewhere
+		self._conn.settimeout(_IDLE_CHECK_INTERVAL)
+		deadline = time.time() + self._keepalivetimeout
+		while True:
+			try:
+				received = self._conn.recv(4096)
+				break
+			except socket.timeout:
+				if time.time() >= deadline or self._yieldidle():
+					return False
+			except socket.error:
+				return False
+		self._metrics.add(Metrics.RECEIVED, len(received))
+		if not received:
+			return False  # The client closed the connection
+		self._parser.feed(received)
+		self._conn.settimeout(self._keepalivetimeout)
+		return True
+
+	# Receive until the parser has a whole request header, and return it.
+	# Return None if the client closes the connection before sending one
+	def _read_request(self):
+		data = self._parser.next_request()
+		while data is None:
+			received = self._conn.recv(4096)
+			self._metrics.add(Metrics.RECEIVED, len(received))
+			if not received:
+				if self._parser.buffered > 0:
+					raise ProtocolError("Connection closed mid-request",
+															"Invalid Headers")
+				return None
+			self._parser.feed(received)
+			data = self._parser.next_request()
+		return data
 
 	# Figure out what the headers say
 	def _process_headers(self, data):
@@ -71,11 +236,23 @@ class UserConnection(threading.Thread):
 		else:
 			url = URL.URL(self._settings, urlstring.decode("ascii"))
 
+		# Keep the rest of the header fields for whoever needs them
+		self._headers = self._parse_header_fields(data)
+
+		# HTTP/1.1 connections persist unless the client says otherwise
+		connection = self._headers.get("connection", "").lower()
+		self._http11 = words[getlocation + 2:getlocation + 3] == [b"HTTP/1.1"]
+		if self._http11:
+			self._keepalive = "close" not in connection
+		else:
+			self._keepalive = "keep-alive" in connection
+
 		# Handle a websocket key header
 		try:
 			wskeylocation = words.index(b"Sec-WebSocket-Key:")
 			# TODO: Is there a problem with assuming the key is ascii?
 			url.websocket_key = words[wskeylocation+1].decode("ascii")
+			url.websocket_extensions = self._headers.get("sec-websocket-extensions")
 		except ValueError:
 			pass  # This was not a websocket connection - no worries!
 		except NameError:
@@ -88,8 +265,21 @@ class UserConnection(threading.Thread):
 			raise StateError("No URL object created.")
 		return url
 
+	# Return a dictionary of header field values keyed by lowercase field name
+	def _parse_header_fields(self, data):
+		fields = dict()
+		for line in data.decode("iso-8859-1").split("\r\n")[1:]:
+			name, sep, value = line.partition(":")
+			if sep:
+				fields[name.strip().lower()] = value.strip()
+		return fields
+
 	# Respond to a user's GET request
 	def _respond(self, url):
+		self._requests += 1
+		self._responsestart = time.time()
+		self._responselabels = (("classification", url.classification),)
+		self._metrics.add(Metrics.REQUESTS, labels=self._responselabels)
 		if url.classification == URL.URL_FILE:
 			logging.info("%s: Requested File %s", self._addr, url)
 			self._send_file(url.filename)
@@ -99,20 +289,46 @@ class UserConnection(threading.Thread):
 		elif url.classification == URL.URL_WS:
 			# Handle an upload - all websockets are uploads, all uploads are websocks
 			logging.info("%s: Requested Upload %s", self._addr, url)
-			ws = Websocket.Websocket(self._conn, self._addr, url, self._settings)
-			ws.handle_websocket()
+			self._handle_upload(url)
 		elif url.classification == URL.URL_SYS:
 			logging.info("%s: Requested System File %s", self._addr, url)
 			self._send_sys(url.filename)
+		elif url.classification == URL.URL_LIST:
+			logging.info("%s: Requested Listing %s", self._addr, url)
+			self._send_listing(url.filename, url.query)
+		elif url.classification == URL.URL_METRICS:
+			logging.info("%s: Requested Metrics %s", self._addr, url)
+			self._send_metrics()
 		else:
 			logging.error("%s: Error with Url Request %s", self._addr, url)
 			if url.websocket_key is not None:
-				ws = Websocket.Websocket(self._conn, self._addr, url, self._settings)
-				ws.handle_invalid_url()
+				self._handle_invalid_upload(url)
 			else:
 				self._send_error()
 
-	# Send the user a system file - build the header, send the file
+	# Count how long the response took, once it's all sent
+	def _end_response(self):
+		if self._responsestart is None:
+			return
+		self._metrics.observe(Metrics.LATENCY, time.time() - self._responsestart,
+													self._responselabels)
+		self._responsestart = None
+
+	# Handle an upload over a websocket - blocks until the upload is done
+	def _handle_upload(self, url):
+		self._keepalive = False
+		ws = Websocket.Websocket(self._conn, self._addr, url, self._settings)
+		# Frames may have arrived right behind the request header
+		ws.handle_websocket(self._parser.take_buffer())
+
+	# Tell a websocket client that its upload URL is invalid
+	def _handle_invalid_upload(self, url):
+		self._keepalive = False
+		ws = Websocket.Websocket(self._conn, self._addr, url, self._settings)
+		ws.handle_invalid_url()
+
+	# Send the user a system file - build the header, send the file.  Responses
+	# for cached files are built once and sent straight from memory after that
 	def _send_sys(self, filename):
 		headertype = self.HEAD_HTML
 		# TODO: Use better, or more, filetype determination
@@ -120,138 +336,643 @@ class UserConnection(threading.Thread):
 			headertype = self.HEAD_JS
 		elif filename.endswith(".css"):
 			headertype = self.HEAD_CSS
-		header = self._build_header(headertype, filename)
-		self._send_file_contents(header, filename)
+		sysfile = SysFileCache.shared(self._settings).get(filename)
+		if sysfile is None:
+			header = self._build_header(headertype, filename)
+			self._send_file_contents(header, filename)
+			return
+		coding = Compression.IDENTITY
+		if self._compression:
+			coding = sysfile.negotiate(self._headers.get("accept-encoding", ""))
+		if self._is_not_modified(sysfile.etags[coding]):
+			validators = "ETag: " + sysfile.etags[coding] + "\r\n"
+			if sysfile.codings:
+				validators += "Vary: Accept-Encoding\r\n"
+			self._send_not_modified(validators)
+			return
+		key = (coding, self._keepalive)
+		response = sysfile.responses.get(key)
+		if response is None:
+			body = sysfile.bodies[coding]
+			header = self._build_header(headertype, filename)
+			header += "ETag: " + sysfile.etags[coding] + "\r\n"
+			if sysfile.codings:
+				header += "Vary: Accept-Encoding\r\n"
+			if coding != Compression.IDENTITY:
+				header += "Content-Encoding: " + coding + "\r\n"
+			header += "Content-Length: {0:d}\r\n\r\n".format(len(body))
+			response = header.encode() + body
+			sysfile.responses[key] = response
+		self._send_chunks(iter([response]))
 	
-	# Send the user a file download - build header, send the file
+	# Send the user a file download - build header, send the file, or just the
+	# byte ranges they asked for
 	def _send_file(self, filename):
-		header = self._build_header(self.HEAD_FILE, filename)
-		self._send_file_contents(header, filename)
+		try:
+			filestat = os.stat(filename)
+		except OSError:
+			# It's gone since its URL was resolved
+			self._send_error()
+			return
+		lastmodified = formatdate(filestat.st_mtime, usegmt=True)
+		etag = self._file_etag(filestat)
+		# Byte ranges are of the file as it is, so they're never compressed
+		coding = Compression.IDENTITY
+		if self._compressdownloads and "range" not in self._headers:
+			coding = self._choose_file_coding(filename, filestat, etag)
+			etag = self._coded_etag(etag, coding)
+		validators = ("Accept-Ranges: bytes\r\nETag: " + etag +
+									"\r\nLast-Modified: " + lastmodified + "\r\n")
+		if self._compressdownloads:
+			validators += "Vary: Accept-Encoding\r\n"
+		if self._is_not_modified(etag, filestat.st_mtime):
+			self._send_not_modified(validators)
+			return
+		if coding == Compression.IDENTITY:
+			# The digest recorded when the file was uploaded, if it was
+			digest = Digest.lookup(filename, filestat)
+			if digest is not None:
+				validators += Digest.header(*digest)
+		ranges = None
+		if "range" in self._headers:
+			# If-Range means only send ranges if the file hasn't changed.  It holds
+			# either an ETag, which must match exactly, or a date
+			ifrange = self._headers.get("if-range", etag)
+			if ifrange == etag or ifrange == lastmodified:
+				ranges = self._parse_ranges(self._headers["range"],
+																		filestat.st_size)
+		if ranges is None and coding != Compression.IDENTITY:
+			self._send_compressed_file(filename, filestat, validators, etag, coding)
+		elif ranges is None:
+			header = self._build_header(self.HEAD_FILE, filename) + validators
+			self._send_file_contents(header, filename)
+		elif len(ranges) == 0:
+			header = self._build_header(self.HEAD_416)
+			header += "Content-Range: bytes */{0:d}\r\n".format(filestat.st_size)
+			self._send_sys_contents(header, self._settings["errorfile"])
+		elif len(ranges) == 1:
+			header = self._build_header(self.HEAD_RANGE, filename) + validators
+			self._send_chunks(self._file_ranges(header, filename, ranges,
+																					filestat.st_size))
+		else:
+			boundary = binascii.hexlify(os.urandom(12)).decode("ascii")
+			header = self._build_header(self.HEAD_RANGE, filename,
+																	"multipart/byteranges; boundary=" + boundary)
+			header += validators
+			self._send_chunks(self._file_ranges(header, filename, ranges,
+																					filestat.st_size, boundary))
+
+	# Parse a Range header into a sorted list of (first, last) byte positions.
+	# Return None if the header should be ignored, or an empty list if none of
+	# the ranges can be satisfied
+	def _parse_ranges(self, rangeheader, size):
+		unit, sep, rangeset = rangeheader.partition("=")
+		specs = rangeset.split(",")
+		if unit.strip().lower() != "bytes" or len(specs) > self.MAX_RANGES:
+			return None
+		ranges = list()
+		for spec in specs:
+			first, sep, last = spec.strip().partition("-")
+			first = first.strip()
+			last = last.strip()
+			if not sep or first.strip(_DIGITS) or last.strip(_DIGITS):
+				return None  # Syntactically invalid
+			if not first:
+				# A suffix range - the final bytes of the file
+				if not last:
+					return None
+				if int(last) > 0 and size > 0:
+					ranges.append((max(size - int(last), 0), size - 1))
+			elif not last or int(first) <= int(last):
+				if int(first) < size:
+					last = size - 1 if not last else min(int(last), size - 1)
+					ranges.append((int(first), last))
+			else:
+				return None
+		# Merge overlapping and adjacent ranges so no byte is sent twice
+		ranges.sort()
+		merged = list()
+		for first, last in ranges:
+			if merged and first <= merged[-1][1] + 1:
+				merged[-1] = (merged[-1][0], max(last, merged[-1][1]))
+			else:
+				merged.append((first, last))
+		return merged
 
 	# Send the user a directory listing - build header, send dir list html file
+	# with the first page of the listing.  The browser fetches the rest
 	def _send_dir(self, filename):
 		dirhtmlfile = self._settings["dirhtmlfile"]
-		header = self._build_header(self.HEAD_HTML)
-		jsondata = self._build_dir_json(filename)
+		try:
+			listing = self._get_listing(filename)
+		except OSError:
+			self._send_error()
+			return
+		# Keep a name from closing the script element early
+		jsondata = self._build_dir_json(filename, listing).replace("</", "<\\/")
 		# The directory listing HTML file needs some of this to wrap it up
 		toappend = ("<script type=\"text/javascript\">\n"
 							  "window.onload = processData(" + jsondata + ")\n"
 							  "</script>\n</body>\n</html>")
-		self._send_file_contents(header, dirhtmlfile, toappend)
+		coding = self._choose_coding()
+		validators = self._listing_validators(toappend, listing, coding,
+																					dirhtmlfile)
+		if validators is None:
+			return
+		etag, validators = validators
+		header = self._build_header(self.HEAD_HTML) + validators
+		# Browsers should check back rather than show an old listing
+		header += "Cache-Control: no-cache\r\n"
+		body = self._sys_body(dirhtmlfile) + toappend.encode()
+		self._send_body(header, body, etag, coding)
+
+	# Send the user a page of a directory listing as JSON
+	def _send_listing(self, dirname, query):
+		try:
+			listing = self._get_listing(dirname)
+		except OSError:
+			self._send_error()
+			return
+		jsondata = self._build_dir_json(dirname, listing, query)
+		coding = Compression.IDENTITY
+		if len(jsondata) >= Compression.MIN_SIZE:
+			coding = self._choose_coding()
+		validators = self._listing_validators(jsondata, listing, coding)
+		if validators is None:
+			return
+		etag, validators = validators
+		header = self._build_header(self.HEAD_JSON) + validators
+		self._send_body(header, jsondata.encode(), etag, coding)
+
+	# Send the server's metrics, as Prometheus scrapes them
+	def _send_metrics(self):
+		header = self._build_header(self.HEAD_METRICS)
+		body = self._metrics.render().encode("utf-8")
+		self._send_body(header, body, None, Compression.IDENTITY)
+
+	# Return the ETag and validator headers for a listing response made of text
+	# and, if given, the contents of filename, to be sent with a content coding.
+	# If the client's copy is current send it a 304 instead, or a 404 if
+	# filename is missing, and return None
+	def _listing_validators(self, text, listing, coding, filename=None):
+		sha = hashlib.sha1(text.encode("utf-8"))
+		if filename is not None:
+			sysfile = SysFileCache.shared(self._settings).get(filename)
+			if sysfile is not None:
+				sha.update(sysfile.etags[Compression.IDENTITY].encode())
+			else:
+				try:
+					filestat = os.stat(filename)
+				except OSError:
+					self._send_error()
+					return None
+				sha.update(self._file_etag(filestat).encode())
+		etag = self._coded_etag("\"" + sha.hexdigest() + "\"", coding)
+		validators = ("ETag: " + etag + "\r\nLast-Modified: " +
+									formatdate(listing.lastchange, usegmt=True) + "\r\n")
+		if self._compression:
+			validators += "Vary: Accept-Encoding\r\n"
+		if self._is_not_modified(etag, listing.lastchange):
+			self._send_not_modified(validators)
+			return None
+		return etag, validators
+
+	# Return the content coding the client would most like a response in, or
+	# identity if compression is off or it takes none this server can produce
+	def _choose_coding(self):
+		if not self._compression:
+			return Compression.IDENTITY
+		return Compression.negotiate(self._headers.get("accept-encoding", ""),
+																 Compression.available())
+
+	# Return the content coding to send a file download in.  Files that are
+	# small or compressed already are sent as they are
+	def _choose_file_coding(self, filename, filestat, etag):
+		if filestat.st_size < Compression.MIN_SIZE:
+			return Compression.IDENTITY
+		coding = self._choose_coding()
+		if coding == Compression.IDENTITY:
+			return coding
+		cached = CompressCache.shared(self._settings).get(
+			self._coded_etag(etag, coding), coding)
+		if cached is not None:
+			return coding
+		with open(filename, "rb") as f:
+			sample = f.read(Compression.SAMPLE_SIZE)
+		if not Compression.worth_compressing(filename, sample):
+			return Compression.IDENTITY
+		return coding
+
+	# Return the ETag of a response's content sent with a content coding.  Each
+	# coding is a different representation, so it needs a different strong ETag
+	def _coded_etag(self, etag, coding):
+		if coding == Compression.IDENTITY:
+			return etag
+		return etag[:-1] + "-" + coding + "\""
+
+	# Send a header and a body held in memory, compressed with a content
+	# coding.  The compressed body is cached by its ETag, so an unchanged one is
+	# only compressed once
+	def _send_body(self, header, body, etag, coding):
+		if coding != Compression.IDENTITY:
+			cache = CompressCache.shared(self._settings)
+			compressed = cache.get(etag, coding)
+			if compressed is None:
+				compressor = Compression.compressor(coding)
+				compressed = compressor.compress(body) + compressor.flush()
+				cache.put(etag, coding, compressed)
+			body = compressed
+			header += "Content-Encoding: " + coding + "\r\n"
+		header += "Content-Length: {0:d}\r\n\r\n".format(len(body))
+		self._send_chunks(iter([header.encode() + body]))
+
+	# Send a file download compressed with a content coding, from the cache if
+	# it's there.  Otherwise it's compressed as it's sent, in chunks, or to the
+	# end of the connection for HTTP/1.0 clients
+	def _send_compressed_file(self, filename, filestat, validators, etag,
+														coding):
+		compressed = CompressCache.shared(self._settings).get(etag, coding)
+		if compressed is None and not self._http11:
+			self._keepalive = False
+		header = self._build_header(self.HEAD_FILE, filename) + validators
+		header += "Content-Encoding: " + coding + "\r\n"
+		if compressed is not None:
+			header += "Content-Length: {0:d}\r\n\r\n".format(len(compressed))
+			self._send_chunks(iter([header.encode() + compressed]))
+			return
+		if self._http11:
+			header += "Transfer-Encoding: chunked\r\n"
+		self._send_chunks(self._compressed_file(header + "\r\n", filename,
+																						filestat, etag, coding))
+
+	# Return a strong ETag for a file, from its stat details
+	def _file_etag(self, filestat):
+		mtime = getattr(filestat, "st_mtime_ns", int(filestat.st_mtime * 1e9))
+		return "\"{0:x}-{1:x}-{2:x}\"".format(filestat.st_ino, filestat.st_size,
+																						mtime)
+
+	# Return True if the request's conditions say the client's copy, with the
+	# given ETag and modification time, is current.  If-None-Match decides if
+	# it's there, otherwise If-Modified-Since does
+	def _is_not_modified(self, etag, mtime=None):
+		ifnonematch = self._headers.get("if-none-match")
+		if ifnonematch is not None:
+			for tag in ifnonematch.split(","):
+				tag = tag.strip()
+				# The weak comparison - a W/ prefix makes no difference
+				if tag.startswith("W/"):
+					tag = tag[2:]
+				if tag == "*" or tag == etag:
+					return True
+			return False
+		ifmodifiedsince = self._headers.get("if-modified-since")
+		if ifmodifiedsince is None or mtime is None:
+			return False
+		parsed = parsedate_tz(ifmodifiedsince)
+		if parsed is None:
+			return False
+		# Dates only go down to the second
+		return int(mtime) <= mktime_tz(parsed)
+
+	# Tell the user their copy is current - just the header and validators
+	def _send_not_modified(self, validators):
+		header = self._build_header(self.HEAD_304) + validators + "\r\n"
+		self._send_chunks(iter([header.encode()]))
 
 	# Send the user an error file - build header, send 404 HTML file
 	def _send_error(self):
 		errorfile = self._settings["errorfile"]
 		header = self._build_header(self.HEAD_404)
-		self._send_file_contents(header, errorfile)
+		self._send_sys_contents(header, errorfile)
+
+	# Send the user a busy error - build header, send the error HTML file
+	def _send_busy(self):
+		errorfile = self._settings["errorfile"]
+		header = self._build_header(self.HEAD_503)
+		self._send_sys_contents(header, errorfile)
 
 	# Build a header to spec
-	def _build_header(self, headertype, filename=""):
+	def _build_header(self, headertype, filename="", contenttype=None):
 		"""Build a specific type of header.
 		
 		headertype specificaiton:
 		HEAD_404 is for 404 errors
+		HEAD_503 is for turning users away when the server is too busy
+		HEAD_416 is for requested byte ranges that are past the end of the file
+		HEAD_304 is for telling the user their copy is current.  It has no body
 		HEAD_FILE is the header for file download, it uses filename (others don't)
+		HEAD_RANGE is for part of a file download, it uses filename too
 		HEAD_HTML is the header for html file download
+		HEAD_JSON is the header for directory listing pages
+		HEAD_METRICS is the header for the metrics
+
+		contenttype, if given, replaces the header type's usual Content-Type.
 
 		"""
 		responsecode = "200 OK"
-		contenttype = ""
+		defaulttype = ""
 		additional = None
 		if headertype == self.HEAD_404:
 			responsecode = "404 Not Found"
-			contenttype = "text/html; charset=UTF-8"
-		elif headertype == self.HEAD_FILE:
-			contenttype = "application/octet-stream"
+			defaulttype = "text/html; charset=UTF-8"
+		elif headertype == self.HEAD_503:
+			responsecode = "503 Service Unavailable"
+			defaulttype = "text/html; charset=UTF-8"
+			additional = "Retry-After: 5"
+		elif headertype == self.HEAD_304:
+			responsecode = "304 Not Modified"
+		elif headertype == self.HEAD_416:
+			responsecode = "416 Range Not Satisfiable"
+			defaulttype = "text/html; charset=UTF-8"
+		elif headertype in (self.HEAD_FILE, self.HEAD_RANGE):
+			if headertype == self.HEAD_RANGE:
+				responsecode = "206 Partial Content"
+			defaulttype = "application/octet-stream"
 			fixedfn = os.path.basename(filename)
 			additional = ("Content-Disposition: attachment; "
 									  "filename=\"" + fixedfn + "\"")
 		elif headertype == self.HEAD_HTML:
-			contenttype = "text/html; charset=UTF-8"
+			defaulttype = "text/html; charset=UTF-8"
 			# No caching settings set.  It's for directory contents right now
 		elif headertype == self.HEAD_JS:
-			contenttype = "text/javascript"
+			defaulttype = "text/javascript"
 			additional = self._get_expiry_date()
 		elif headertype == self.HEAD_CSS:
-			contenttype = "text/css"
+			defaulttype = "text/css"
 			additional = self._get_expiry_date()
-		header = ("HTTP/1.1 " + responsecode + "\r\n" + "Content-Type: " +
-							contenttype + "\r\n" + "Connection: close\r\n")
+		elif headertype == self.HEAD_JSON:
+			defaulttype = "application/json"
+			additional = "Cache-Control: no-cache"
+		elif headertype == self.HEAD_METRICS:
+			defaulttype = "text/plain; version=0.0.4; charset=utf-8"
+			additional = "Cache-Control: no-cache"
+		if contenttype is None:
+			contenttype = defaulttype
+		connection = "keep-alive" if self._keepalive else "close"
+		header = "HTTP/1.1 " + responsecode + "\r\n"
+		if contenttype:
+			header += "Content-Type: " + contenttype + "\r\n"
+		header += "Connection: " + connection + "\r\n"
 		if additional is not None:
 			header += additional + "\r\n"
 		return header
 
-	# Return an expires header for 1 year from now.  This enables client caching
+	# Return an expires header for 1 year from now.  This enables client caching.
+	# Cache-Control says the same in a way that stays right in cached responses
 	def _get_expiry_date(self):
-		curdatetime = datetime.now()
-		curdatetime = curdatetime.replace(curdatetime.year+1)
-		return "Expires: " + curdatetime.strftime("%a, %d %b %Y %H:%M:%S GMT")
+		expires = formatdate(time.time() + _CACHE_LIFETIME, usegmt=True)
+		return ("Expires: " + expires + "\r\nCache-Control: max-age=" +
+						str(_CACHE_LIFETIME))
 
-	# Represent directory contents as a JSON string
-	def _build_dir_json(self, dirname):
-		"""Build the JSON representation of a directory's contents
+	# Represent a page of directory contents as a JSON string
+	def _build_dir_json(self, dirname, listing, query=None):
+		"""Build the JSON representation of a page of a directory's contents
 			
-		JSON Format: { "dirname": "directory name here", "contents":
+		JSON Format: { "dirname": "directory name here", "token": "change token",
+									"total": entriesmatching, "offset": firstentry,
+									"limit": pagesize, "sort": "name, size, modified, accessed
+									or type", "order": "asc or desc",
+									"parent": {file info, only on the first page below the root},
+									"contents":
 									[{"filename":"file name here", "fileurl":"file url here",
 										"type":"dir, file or other", "dateaccessed":
 										"date created here", "datemodified":"date modified here",
 										"size":sizebyteshere}] }
+
+		listing is the directory's DirListing.Listing.  query is a dictionary
+		which may have keys offset, limit, sort, order, filter (part of the names
+		to list) and since (a change token from an earlier page, to list only
+		what's changed since).  Bad values are ignored.
 											
 		"""
-		# Setup a list of everything in the directory to parse through later
-		dirlisting = list()
+		params = self._listing_params(query or dict())
+		total, entries = listing.page(params["offset"], params["limit"],
+																	params["sort"], params["order"] == "desc",
+																	params["filter"], params["since"])
 		basedir = self._settings["basedir"]
 		# Remove local file system directory info from the dir name
 		cleandirname = "/" + dirname.replace(basedir, "", 1).strip("/ ")
+		finaldict = {"dirname": cleandirname, "token": "%.6f" % listing.lastchange,
+								 "total": total, "offset": params["offset"],
+								 "limit": params["limit"], "sort": params["sort"],
+								 "order": params["order"]}
 		# Get the /'s right at beginning and end of the clean directory name
 		if cleandirname != "/":
 			cleandirname += "/"
+			finaldict["dirname"] = cleandirname
 			# Allow user to go up a dir if we're not at the virtual root
-			dirlisting.append("..") 
-		# Add all the directory's files to the directory listing
-		dirlisting.extend(os.listdir(dirname))
-
-		# Peruse the directory contents, build the JSON data for each file
+			parent = DirListing.stat_path(os.path.join(dirname, ".."))
+			if parent is not None and params["offset"] == 0:
+				filetype, filestat = parent
+				finaldict["parent"] = self._file_info(cleandirname, "..", filetype,
+																							filestat.st_size,
+																							filestat.st_atime,
+																							filestat.st_mtime)
 		contents = list()
-		for filename in dirlisting:
-			# Normpath will replace ".." with the parent directory
-			fullpath = os.path.normpath(os.path.join(dirname, filename))
-			# Normpath now replaces ".." with the parent virtual directory
-			fileurl = os.path.normpath(cleandirname + filename)
-			filestat = os.stat(fullpath)
-			filetype = "other"
-			if os.path.isfile(fullpath):
-				filetype = "file"
-			elif os.path.isdir(fullpath):
-				filetype = "dir"
-			accessdatetime = datetime.fromtimestamp(filestat.st_atime)
-			modifydatetime = datetime.fromtimestamp(filestat.st_mtime)
-			accesstime = accessdatetime.strftime("%d %b %Y %H:%M:%S")
-			modifytime = modifydatetime.strftime("%d %b %Y %H:%M:%S")
-			# Build a dictionary representing the file
-			fileinfo = {"filename": filename, "fileurl": fileurl, "type": filetype,
-									"dateaccessed": accesstime, "datemodified": modifytime,
-									"size": filestat.st_size}
-			contents.append(fileinfo)
-		# Put the file JSON together in this nice package dictionary
-		finaldict = {"dirname": cleandirname, "contents": contents}
+		for filename, filetype, size, atime, mtime, changed in entries:
+			contents.append(self._file_info(cleandirname, filename, filetype, size,
+																			atime, mtime))
+		finaldict["contents"] = contents
 		return json.dumps(finaldict)
 
+	# Return the listing of directory dirname, from the cache if it's current
+	def _get_listing(self, dirname):
+		return DirCache.shared(self._settings).get(dirname, DirListing.Listing,
+																							 self._listing_size)
+
+	# Return the listing API parameters in query, with defaults for any that are
+	# missing or invalid
+	def _listing_params(self, query):
+		pagesize = int(self._settings.get("listingpagesize", 500))
+		params = {"offset": 0, "limit": pagesize, "sort": "name", "order": "asc",
+							"filter": query.get("filter") or None, "since": None}
+		for name in ("offset", "limit"):
+			try:
+				params[name] = max(int(query[name]), 0)
+			except (KeyError, ValueError):
+				pass
+		# A page is never bigger than the configured page size
+		params["limit"] = min(max(params["limit"], 1), pagesize)
+		if query.get("sort") in DirListing.SORT_KEYS:
+			params["sort"] = query["sort"]
+		if query.get("order") == "desc":
+			params["order"] = "desc"
+		try:
+			params["since"] = float(query["since"])
+		except (KeyError, ValueError):
+			pass
+		return params
+
+	# Return roughly how much memory a cached listing takes up
+	def _listing_size(self, listing):
+		return listing.memsize
+
+	# Build the dictionary representing one file in a directory listing
+	def _file_info(self, cleandirname, filename, filetype, size, atime, mtime):
+		# Normpath replaces ".." with the parent virtual directory
+		fileurl = os.path.normpath(cleandirname + filename)
+		accesstime = time.strftime("%d %b %Y %H:%M:%S", time.localtime(atime))
+		modifytime = time.strftime("%d %b %Y %H:%M:%S", time.localtime(mtime))
+		return {"filename": filename, "fileurl": fileurl, "type": filetype,
+						"dateaccessed": accesstime, "datemodified": modifytime,
+						"size": size}
+
 	# Send a header, fill in the size, send a file's contents too
 	# TODO: throw a custom type of exception so it can be handled at top level
 	def _send_file_contents(self, header, filename, append=None):
-		size = os.path.getsize(filename)
+		self._send_chunks(self._file_contents(header, filename, append))
+
+	# Return a system file's contents, from memory if it's cached
+	def _sys_body(self, filename):
+		sysfile = SysFileCache.shared(self._settings).get(filename)
+		if sysfile is not None:
+			return sysfile.bodies[Compression.IDENTITY]
+		with open(filename, "rb") as f:
+			return f.read()
+
+	# Send a header and a system file's contents, from memory if it's cached
+	def _send_sys_contents(self, header, filename):
+		sysfile = SysFileCache.shared(self._settings).get(filename)
+		if sysfile is None:
+			self._send_file_contents(header, filename)
+			return
+		body = sysfile.bodies[Compression.IDENTITY]
+		header += "Content-Length: {0:d}\r\n\r\n".format(len(body))
+		self._send_chunks(iter([header.encode() + body]))
+
+	# Send each of the byte strings and FileRegions a generator produces
+	def _send_chunks(self, chunks):
+		for chunk in chunks:
+			if isinstance(chunk, FileRegion):
+				self._send_region(chunk)
+			else:
+				self._send_bytes(chunk)
+
+	# Send bytes, a piece at a time if the send rate is limited
+	def _send_bytes(self, data):
+		if self._sendquantum is None:
+			self._conn.sendall(data)
+			self._metrics.add(Metrics.SENT, len(data))
+			return
+		view = memoryview(data)
+		for start in range(0, len(view), self._sendquantum):
+			piece = view[start:start + self._sendquantum]
+			self._conn.sendall(piece)
+			self._metrics.add(Metrics.SENT, len(piece))
+			self._pay_send(len(piece))
+
+	# Pay the send rate limits for amount bytes sent, by waiting if need be
+	def _pay_send(self, amount):
+		delay = self._limiter.take(RateLimiter.SEND, self._clientip, amount)
+		if delay > 0:
+			time.sleep(delay)
+
+	# Generate the header, the file's contents as a FileRegion, and the trailer
+	def _file_contents(self, header, filename, append=None):
 		if append is not None:
-			size += len(append)
-		# Append the content-length to the header
-		header += "Content-Length: {0:d}\r\n\r\n".format(size)
-		self._conn.sendall(header.encode())
-		# Send the file in 4 kb chunks
+			append = append.encode()
 		with open(filename, 'rb') as f:
-			data = f.read(4096)
-			while data != b"":
-				self._conn.sendall(data)
-				data = f.read(4096)
+			size = os.fstat(f.fileno()).st_size
+			# Append the content-length to the header
+			contentlength = size
+			if append is not None:
+				contentlength += len(append)
+			header += "Content-Length: {0:d}\r\n\r\n".format(contentlength)
+			yield header.encode()
+			yield FileRegion(f, 0, size)
 		# Append the trailer, if one was specified
 		if append is not None:
-			self._conn.sendall(append.encode())
+			yield append
+
+	# Generate the header and a file's contents compressed with a content coding,
+	# in HTTP/1.1 chunks if the request was HTTP/1.1.  The compressed file is
+	# cached if it's small enough and the file didn't change while it was read
+	def _compressed_file(self, header, filename, filestat, etag, coding):
+		cache = CompressCache.shared(self._settings)
+		compressor = Compression.compressor(coding)
+		kept = list()	# The compressed data so far, while it'd fit in the cache
+		keptsize = 0
+		with open(filename, "rb") as f:
+			yield header.encode()
+			while True:
+				data = f.read(self._chunksize)
+				compressed = compressor.compress(data) if data else compressor.flush()
+				if compressed and kept is not None:
+					kept.append(compressed)
+					keptsize += len(compressed)
+					if not cache.fits(keptsize):
+						kept = None
+				if compressed and self._http11:
+					yield ("{0:x}\r\n".format(len(compressed)).encode() + compressed +
+								 b"\r\n")
+				elif compressed:
+					yield compressed
+				if not data:
+					break
+			unchanged = self._file_etag(os.fstat(f.fileno())) == self._file_etag(
+				filestat)
+		if self._http11:
+			yield b"0\r\n\r\n"
+		if kept is not None and unchanged:
+			cache.put(etag, coding, b"".join(kept))
+
+	# Generate the header and the requested byte ranges of a file.  More than
+	# one range is sent as multipart/byteranges separated by boundary
+	def _file_ranges(self, header, filename, ranges, size, boundary=None):
+		if boundary is None:
+			first, last = ranges[0]
+			header += ("Content-Range: bytes {0:d}-{1:d}/{2:d}\r\n"
+								 "Content-Length: {3:d}\r\n\r\n").format(first, last, size,
+																											 last - first + 1)
+			with open(filename, 'rb') as f:
+				yield header.encode()
+				yield FileRegion(f, first, last - first + 1)
+			return
+		# Each range gets its own part header, then there's a closing delimiter
+		partheaders = list()
+		for first, last in ranges:
+			partheaders.append(("\r\n--" + boundary + "\r\n"
+				"Content-Type: application/octet-stream\r\n"
+				"Content-Range: bytes {0:d}-{1:d}/{2:d}\r\n\r\n").format(
+					first, last, size).encode())
+		closing = ("\r\n--" + boundary + "--\r\n").encode()
+		length = len(closing)
+		for partheader, (first, last) in zip(partheaders, ranges):
+			length += len(partheader) + last - first + 1
+		header += "Content-Length: {0:d}\r\n\r\n".format(length)
+		with open(filename, 'rb') as f:
+			yield header.encode()
+			for partheader, (first, last) in zip(partheaders, ranges):
+				yield partheader
+				yield FileRegion(f, first, last - first + 1)
+		yield closing
+
+	# Send a file region, with the kernel doing the copying if possible
+	def _send_region(self, region):
+		if region.count <= 0:
+			return
+		quantum = self._sendquantum or region.count
+		if self._usesendfile and _HAVE_SENDFILE:
+			while region.count > 0:
+				sent = self._conn.sendfile(region.fileobj, region.offset,
+																	 min(quantum, region.count))
+				if sent == 0:
+					# The file shrank underneath us.  The client is still waiting for
+					# the rest, so close the connection once the response is over
+					self._keepalive = False
+					break
+				self._metrics.add(Metrics.SENT, sent)
+				region.advance(sent)
+				self._pay_send(sent)
+			return
+		# Fall back to reading the file through in chunks
+		region.fileobj.seek(region.offset)
+		while region.count > 0:
+			data = region.fileobj.read(min(self._chunksize, quantum, region.count))
+			if data == b"":
+				self._keepalive = False  # The file shrank underneath us, as above
+				break
+			self._conn.sendall(data)
+			self._metrics.add(Metrics.SENT, len(data))
+			region.advance(len(data))
+			self._pay_send(len(data))
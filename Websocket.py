@@ -1,17 +1,111 @@
 # Standard library imports
 from __future__ import print_function #Make print work correctly prior to python 3
 import base64
+import errno
+import re
 import struct
 import os.path
 import socket
 import logging
+import time
+import zlib
+try:
+	import numpy
+except ImportError:
+	numpy = None  # Unmasking will use the pure python methods
 
 # Local imports
-from FileWriter import FileWriter
+import DedupeStore
+import Digest
+import FileWriter
+import Metrics
+import RateLimiter
+from ReceiveBuffer import ReceiveBuffer
 from Error import StateError, ProtocolError
 
+# The longest a frame header can be - 2 bytes, 8 of length, 4 of mask
+_MAX_HEADER = 14
+# Payloads shorter than this aren't worth setting up the fast unmasking for
+_SHORT_PAYLOAD = 64
+# Control frames can't be fragmented or carry more than this
+_MAX_CONTROL_PAYLOAD = 125
+# The text messages between segments are short - refuse to buffer more
+_MAX_TEXT_MESSAGE = 4096
+# Segment metadata: "Segment Start: <offset> Segment Finish: <end offset>"
+_SEGMENT_RE = re.compile(br"Segment Start:\s*(\d+)\s*Segment Finish:\s*(\d+)")
+# The start of an upload: "Filesize: <size>", maybe with "Digest: <digest>"
+_FILESIZE_RE = re.compile(br"Filesize: (\d+)(?:\s+Digest:\s*(\S+))?\s*$")
+# The end of an upload: "File Finish", maybe with "Digest: <algorithm>:<hex>"
+_FINISH_RE = re.compile(br"File Finish(?:\s+Digest:\s*(\S+))?\s*$")
+# permessage-deflate leaves this off the end of each compressed message
+_DEFLATE_TRAILER = b"\x00\x00\xff\xff"
+
+def unmask(data, mask):
+	"""Unmask a websocket payload in place.
+
+		data - a bytearray or writable memoryview holding the payload
+		mask - the frame's 4 byte masking key
+
+	"""
+	mask = bytearray(mask)
+	if len(data) < _SHORT_PAYLOAD:
+		_unmask_bytewise(data, mask)
+	elif numpy is not None:
+		_unmask_numpy(data, mask)
+	else:
+		_unmask_translate(data, mask)
+
+# XOR each byte with its byte of the mask, one at a time
+def _unmask_bytewise(data, mask):
+	for i in range(len(data)):
+		data[i] ^= mask[i%4]
+
+# Every 4th byte is XORed with the same mask byte, so a translation table does
+# a whole stride of the payload at once
+def _unmask_translate(data, mask):
+	for i in range(4):
+		table = bytes(bytearray(byte ^ mask[i] for byte in range(256)))
+		stride = data[i::4]
+		if isinstance(stride, memoryview):
+			stride = stride.tobytes()
+		data[i::4] = stride.translate(table)
+
+# XOR the payload 4 bytes at a time as 32 bit words, then finish the tail
+def _unmask_numpy(data, mask):
+	words = len(data) // 4
+	wordview = numpy.frombuffer(data, dtype=numpy.uint32, count=words)
+	wordview ^= numpy.frombuffer(bytes(mask), dtype=numpy.uint32)[0]
+	for i in range(words * 4, len(data)):
+		data[i] ^= mask[i%4]
+
+class _Frame():
+	"""The header of the frame currently being received"""
+
+	def __init__(self, opcode, fin, mask, length):
+		self.opcode = opcode
+		self.fin = fin
+		self.mask = mask
+		self.remaining = length	# Payload bytes not yet received
+		self.received = 0
+
+	def take_mask(self, amount):
+		"""Return the mask for the next amount bytes of payload, rotated to
+			line up with where they start."""
+		offset = self.received % 4
+		self.received += amount
+		self.remaining -= amount
+		return self.mask[offset:] + self.mask[:offset]
+
 class Websocket():
-	"""Handle a websocket connection"""
+	"""Handle a websocket connection
+
+	File data is written out as it arrives rather than once a frame is complete,
+	so frames of any size can be received in at most wsmemorylimit bytes.
+	Messages may be fragmented across continuation frames.  Clients offering the
+	permessage-deflate extension may compress messages, which are inflated as
+	they arrive, a piece at a time.
+
+	"""
 
 	# TODO: Make opcode its own object?
 	# These are the possible opcodes
@@ -39,112 +133,419 @@ class Websocket():
 			# Make sure there's one / at the end of the directory
 			self._permitted_upload_dir = settings["uploaddir"].rstrip("/ ") + "/"
 		self._filewriter = None
-		self._curbuf=bytearray()	# Store the buffer of received bytes
+		self._segment = None	# The file segment being received
+		self._segnext = 0	# Where a segment without offsets starts
+		self._partialexpiry = float(settings.get("partialuploadexpiry", 172800))
+		# The algorithm uploads are hashed with as they arrive, if any
+		self._algorithm = settings.get("uploaddigest", "sha256").strip().lower()
+		if self._algorithm in ("", "no", "none"):
+			self._algorithm = None
+		self._expected = None	# The digest the client says the file has
+		self._store = DedupeStore.shared(settings)
+		# Whether a digest sent with the file size may create the file from the
+		# store, so the upload is skipped
+		self._dedupeskip = (self._store.enabled and
+												settings.get("dedupeskip", "no").lower() in
+												("yes", "true", "1"))
+		self._deduped = False	# Whether the file was in the store, so wasn't sent
+		self._state = self.ST_FILESIZE  # First, wait for the file size
+		memorylimit = max(int(settings.get("wsmemorylimit", 1048576)), 1024)
+		bufsize = min(memorylimit, 1024*256)
+		# Store the buffer of received bytes.  File data is handed on in pieces
+		# of at least _piecesize, which always leaves the buffer room to spare
+		self._curbuf = ReceiveBuffer(bufsize, memorylimit)
+		self._piecesize = bufsize // 4
+		self._frame = None	# The frame being received, once its header is in
+		self._msgopcode = None	# The opcode of a message continuing over frames
+		self._msgbuf = bytearray()	# A text message received so far
+		self._b64carry = b""	# Base64 text left over from the last piece
+		self._pending = b""	# Data received before the websocket started
+		self._pendingpos = 0
+		self._deflate = (settings.get("wsdeflate", "yes").lower() in
+										 ("yes", "true", "1"))
+		# The largest compression window clients asking what it should be get
+		self._deflatebits = min(max(int(settings.get("wsdeflatewindowbits", 15)),
+																9), 15)
+		self._inflater = None	# Set once permessage-deflate is agreed
+		self._msgcompressed = False	# Whether the current message is compressed
+		self._metrics = Metrics.shared(settings)
+		self._limiter = RateLimiter.shared(settings)
+		self._started = None	# When the upload started, until its end is counted
 
-	def handle_websocket(self):
-		"""Handle a websocket connection"""
+	def handle_websocket(self, data=b""):
+		"""Handle a websocket connection, blocking until the upload is done
+
+			data is anything already received after the request header.
+
+		"""
+		self._pending = data
+		self._started = time.time()
 		self._send_header()
-		state = self.ST_FILESIZE  # First, wait for the file size
 		# Handle file upload.  Close connection nicely in any case
 		try:
-			while state != self.ST_FINISH:
-				opcode, data = self._get_frame()
-				if opcode == self.OP_PING:
-					# Handle a ping in any state.  Don't do anything else with the data
-					self._send_msg(data, self.OP_PONG)
-				elif state == self.ST_FILESIZE:
-					state = self._state_filesize(opcode, data)
-				elif state == self.ST_FILESEGM:
-					state = self._state_filesegm(opcode, data)
-				elif state == self.ST_FILESEGD:
-					state = self._state_filesegd(opcode, data)
-				else:	
-					raise StateError("Invalid state")
-			# ST_FINISH state
-			self._filewriter.finish()
+			while self._state != self.ST_FINISH:
+				self._process_piece(*self._get_piece())
 		except (ProtocolError, StateError) as e:
-			logging.error("%s: %s", self._addr, e.msg)
-			if e.response is not None:
-				self._send_msg(e.response.encode())
+			self._end_upload(e)
 		else:
-			self._send_msg(b"Finished")
+			self._end_upload()
 		finally:
-			self._send_msg(None, self.OP_CLOS)
+			self.abort()
+
+	def start_websocket(self):
+		"""Accept a websocket connection whose data will arrive via feed_data"""
+		self._started = time.time()
+		self._send_header()
+
+	def recv_from(self, sock):
+		"""Receive whatever a non-blocking socket has into the frame buffer.
+
+			Returns the number of bytes received, 0 if the client hung up.  The
+			data is processed by a following call to feed_data.
+
+		"""
+		try:
+			return self._curbuf.recv_into(sock)
+		except BufferError:
+			self._end_upload(ProtocolError("Upload exceeded the memory limit",
+																		 "Invalid: -1"))
+			return 0
+
+	def feed_data(self, data=b""):
+		"""Process received data without blocking for more.
+
+			Returns False once the upload has ended and the connection should
+			close, True while more data is expected.
+
+		"""
+		if data:
+			self._pending = self._pending[self._pendingpos:] + data
+			self._pendingpos = 0
+		try:
+			piece = self._next_buffered_piece()
+			while piece is not None:
+				self._process_piece(*piece)
+				if self._state == self.ST_FINISH:
+					break
+				piece = self._next_buffered_piece()
+		except (ProtocolError, StateError) as e:
+			self._end_upload(e)
+			return False
+		if self._state == self.ST_FINISH:
+			self._end_upload()
+			return False
+		return True
+
+	def abort(self):
+		"""Stop any unfinished upload, e.g. when the client disappears.
+
+			What was received is kept so the upload can be resumed.
+
+		"""
+		self._count_upload("aborted")
+		if self._filewriter is not None:
+			if self._segment is not None:
+				self._filewriter.end_segment(self._segment, False)
+				self._segment = None
+			self._filewriter.close()
+			self._filewriter = None
 
 	def handle_invalid_url(self):
 		"""Handle a websocket request for an invalid URL."""
 		self._send_header()
-		self._send_msg("Invalid: -1")
+		self._send_msg(b"Invalid: -1")
 		self._send_msg(None, self.OP_CLOS)
+
+	def handle_busy(self):
+		"""Turn away a websocket request because the server is too busy."""
+		self._send_header()
+		self._send_msg(b"Busy: -1")
+		# Close status 1013 is "Try Again Later"
+		self._send_msg(struct.pack(">H", 1013) + b"Server busy", self.OP_CLOS)
 		
+	# Move the receiver state machine along with one piece of a message.  final
+	# is set on the piece that ends the message
+	def _process_piece(self, opcode, data, final):
+		if opcode < self.OP_CLOS and self._msgcompressed:
+			self._inflate_piece(opcode, data, final)
+		else:
+			self._process_plain(opcode, data, final)
+
+	# Inflate a piece of a compressed message and process the result.  It's
+	# passed on in pieces of at most _piecesize, so the limits on what each
+	# state accepts trip before a small message can inflate into a huge one
+	def _inflate_piece(self, opcode, data, final):
+		data = bytes(data)
+		if final:
+			data += _DEFLATE_TRAILER
+		while True:
+			try:
+				inflated = self._inflater.decompress(data, self._piecesize)
+			except zlib.error:
+				raise ProtocolError("Received invalid compressed data", "Invalid: -1")
+			data = self._inflater.unconsumed_tail
+			if not data and len(inflated) < self._piecesize:
+				break
+			self._process_plain(opcode, inflated, False)
+		self._process_plain(opcode, inflated, final)
+
+	# Move the receiver state machine along with one piece of an uncompressed
+	# message
+	def _process_plain(self, opcode, data, final):
+		if opcode == self.OP_PING:
+			# Handle a ping in any state.  Don't do anything else with the data
+			self._send_msg(data, self.OP_PONG)
+		elif self._state == self.ST_FILESEGD:
+			self._state = self._state_filesegd(opcode, data, final)
+		elif opcode != self.OP_TEXT:
+			# Let the state complain about the wrong kind of message
+			self._process_message(opcode, b"")
+		else:
+			# The other states act on whole text messages, which are short
+			if len(self._msgbuf) + len(data) > _MAX_TEXT_MESSAGE:
+				raise ProtocolError("Text message too long", "Invalid: -1")
+			self._msgbuf.extend(data)
+			if final:
+				message = bytes(self._msgbuf)
+				self._msgbuf = bytearray()
+				self._process_message(opcode, message)
+
+	# Move the receiver state machine along with one whole message
+	def _process_message(self, opcode, data):
+		if self._state == self.ST_FILESIZE:
+			self._state = self._state_filesize(opcode, data)
+		elif self._state == self.ST_FILESEGM:
+			self._state = self._state_filesegm(opcode, data)
+		else:	
+			raise StateError("Invalid state")
+
+	# Finish the file, tell the client how it went, and close the websocket
+	def _end_upload(self, error=None):
+		finished = self._deduped
+		try:
+			if error is None and not finished:
+				finished = self._filewriter.finish(self._expected)
+		except (ProtocolError, StateError) as e:
+			error = e
+		if error is not None:
+			self._count_upload("failed")
+			self.abort()
+		elif self._deduped:
+			self._count_upload("deduplicated")
+		else:
+			self._count_upload("finished" if finished else "partial")
+		try:
+			if error is None and self._deduped:
+				# The file was made from the store without being sent
+				self._send_msg(b"Already Have")
+			elif error is None and finished:
+				self._send_msg(b"Finished")
+			elif error is None:
+				# Another connection is still sending part of the file
+				self._send_msg(b"Segments Received")
+			else:
+				logging.error("%s: %s", self._addr, error.msg)
+				if error.response is not None:
+					self._send_msg(error.response.encode())
+		finally:
+			self._send_msg(None, self.OP_CLOS)
+
+	# Count an upload's end with its result, unless it's been counted already
+	def _count_upload(self, result):
+		if self._started is None:
+			return
+		self._metrics.add(Metrics.UPLOADS, labels=(("result", result),))
+		self._metrics.add(Metrics.UPLOADTIME, time.time() - self._started)
+		self._started = None
+
 	# Send the header responding to the websocket connection request
 	def _send_header(self):
 		header = ("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n"
 							"Connection: Upgrade\r\nSec-WebSocket-Accept: " +
-							self._url.accept_key + "\r\n\r\n")
-		self._conn.sendall(header.encode())
+							self._url.accept_key + "\r\n")
+		extension = self._negotiate_deflate()
+		if extension is not None:
+			header += "Sec-WebSocket-Extensions: " + extension + "\r\n"
+		self._conn.sendall((header + "\r\n").encode())
+
+	# Accept the first permessage-deflate offer in the request that can be, and
+	# return the extension response for it.  Return None if there isn't one.
+	# Messages to the client are short, so they're never compressed, and any
+	# compression parameters the client wants for them are agreed to
+	def _negotiate_deflate(self):
+		offers = self._url.websocket_extensions
+		if not self._deflate or not offers:
+			return None
+		for offer in offers.split(","):
+			params = [param.strip() for param in offer.split(";")]
+			if params[0].lower() != "permessage-deflate":
+				continue
+			accepted = [params[0]]
+			windowbits = 15
+			names = set()
+			for param in params[1:]:
+				name, sep, value = param.partition("=")
+				name = name.strip().lower()
+				value = value.strip().strip("\"")
+				validbits = value.isdigit() and 8 <= int(value) <= 15
+				if name in names:
+					break  # Parameters can't be repeated
+				names.add(name)
+				if name == "server_no_context_takeover" and not sep:
+					accepted.append(name)
+				elif name == "client_no_context_takeover" and not sep:
+					pass  # Inflating copes whether or not the client resets
+				elif name == "server_max_window_bits" and validbits:
+					accepted.append(name + "=" + value)
+				elif name == "client_max_window_bits" and (validbits or not sep):
+					# The client lets us bound the window it compresses with
+					windowbits = self._deflatebits
+					if sep:
+						windowbits = min(windowbits, int(value))
+					accepted.append(name + "=" + str(windowbits))
+				else:
+					break  # An offer with anything else is declined
+			else:
+				# zlib can't use an 8 bit window, but a bigger one always works
+				self._inflater = zlib.decompressobj(-max(windowbits, 9))
+				return "; ".join(accepted)
+		return None
 
 	# Handle the ST_FILESIZE state
 	def _state_filesize(self, opcode, data):
+		data = bytes(data)
 		# Sanity check the frame
 		if opcode != self.OP_TEXT:
 			raise ProtocolError("Received non-text frame while waiting for filesize",
 													"Invalid: -1")
+		elif data.startswith(b"Query Dedupe"):
+			# The client asks whether it's worth waiting for its digest to send with
+			# the file size
+			self._send_msg(b"Dedupe: yes" if self._dedupeskip else b"Dedupe: no")
+			return self.ST_FILESIZE
 		elif not data.startswith(b"Filesize: "):
 			raise ProtocolError("Received invalid text while waiting for filesize",
 													"Invalid: -1")
 
-		# Retrieve the file size
-		filesize = data.decode("ascii").replace("Filesize: ", "", 1).strip()
-		if not filesize.isdigit():
+		# Retrieve the file size, and the digest if the client sent one
+		match = _FILESIZE_RE.match(data)
+		if match is None:
 			raise ProtocolError("Invalid filesize received", "Invalid: -1")
+		filesize = int(match.group(1))
+		if match.group(2) is not None:
+			self._expected = Digest.parse(match.group(2).decode("ascii"))
+		if match.group(2) is not None and self._expected is None:
+			raise ProtocolError("Received an invalid digest", "Invalid: -1")
 		# Make sure the upload is to a permitted destination
 		elif (self._permitted_upload_dir is not None and 
 				not self._url.filename.startswith(self._permitted_upload_dir)):
 			raise ProtocolError("Invalid upload directory, upload denied",
 													"Not Permitted: -2")
 		# Now check if the file exists
-		elif not os.path.isfile(self._url.filename):
-			# We're go for file upload!
-			self._send_msg(b"Permitted")
-			self._filewriter = FileWriter(self._url.filename, int(filesize))
-		else:
+		elif os.path.isfile(self._url.filename):
 			# File already exists - let the client know it messed up
 			raise ProtocolError("File already exists, upload denied",
 													"Not Permitted: -1")
+		elif self._place_stored(filesize):
+			# The same content has been uploaded before, so there's no need to send
+			# it again
+			self._deduped = True
+			return self.ST_FINISH
+		else:
+			# We're go for file upload!  A partial upload of the same file and size
+			# is picked up where it left off
+			FileWriter.remove_expired(os.path.dirname(self._url.filename),
+																self._partialexpiry)
+			self._filewriter = FileWriter.open_upload(self._url.filename, filesize,
+																								self._algorithm, self._store)
+			self._send_msg(b"Permitted")
 		return self.ST_FILESEGM
 
+	# Create the file from the dedupe store, if skipping uploads is allowed, the
+	# client sent a digest and the store has that content.  Returns True if it
+	# was created
+	def _place_stored(self, filesize):
+		if self._expected is None or not self._dedupeskip:
+			return False
+		try:
+			return self._store.place(self._url.filename, self._expected[0],
+															 self._expected[1], filesize)
+		except OSError as e:
+			if e.errno == errno.EEXIST:
+				raise ProtocolError("File already exists, upload denied",
+														"Not Permitted: -1")
+			raise StateError("Error creating file", "Finish Error: -1")
+
 	# Handle the ST_FILESEGM state
 	def _state_filesegm(self, opcode, data):
 		if opcode != self.OP_TEXT:
 			raise ProtocolError("Received non-text frame while waiting "
 													"for segment metadata", "Invalid: -1")
+		data = bytes(data)
 		state = self.ST_FILESEGM
 		if data.startswith(b"File Finish"):
-			# The sender indicated that the file is done
+			# The sender indicated that the file is done, and maybe what its digest
+			# should be
+			match = _FINISH_RE.match(data)
+			if match is None:
+				raise ProtocolError("Received invalid file finish", "Invalid: -1")
+			elif match.group(1) is not None:
+				self._expected = Digest.parse(match.group(1).decode("ascii"))
+				if self._expected is None:
+					raise ProtocolError("Received an invalid digest", "Invalid: -1")
 			state = self.ST_FINISH
 		elif data.startswith(b"Segment Start:"):
-			#TODO: Parse out, verify, the segment start and finish data here
-			# A file data segment will follow
+			# A file data segment will follow.  Old clients don't send offsets, in
+			# which case the segment follows on from the last
+			match = _SEGMENT_RE.match(data)
+			if match is not None:
+				self._segment = self._filewriter.start_segment(int(match.group(1)),
+																											 int(match.group(2)))
+			else:
+				self._segment = self._filewriter.start_segment(self._segnext)
 			state = self.ST_FILESEGD
+		elif data.startswith(b"Query Ranges"):
+			# The client is resuming, and wants to know what it needn't send
+			ranges = ",".join("%d-%d" % (start, end)
+												for start, end in self._filewriter.ranges)
+			self._send_msg(("Ranges: " + ranges).encode())
 		else:
 			raise ProtocolError("Received invalid segment metadata",
 													"Invalid: -1")
 		return state
 
-	# Handle the ST_FILESEGD state
-	def _state_filesegd(self, opcode, data):
+	# Handle the ST_FILESEGD state, writing out each piece of the segment as it
+	# arrives
+	def _state_filesegd(self, opcode, data, final):
 		if opcode != self.OP_BIN and opcode != self.OP_TEXT:
 			raise ProtocolError("Invalid opcode while waiting for file data",
 													"Invalid: -1")
 		if opcode == self.OP_TEXT:
 			# In this case, the data is base64 encoded.  Decode it
-			data = base64.b64decode(bytes(data))
-		self._filewriter.append(data)
-		if self._filewriter.test_size() > 0:
-			raise ProtocolError("Received data after file met specified size",
+			data = self._decode_base64(data, final)
+		self._filewriter.append(self._segment, data)
+		self._metrics.add(Metrics.UPLOADED, len(data))
+		if final:
+			self._filewriter.end_segment(self._segment)
+			self._segnext = self._segment.pos
+			self._segment = None
+			return self.ST_FILESEGM
+		return self.ST_FILESEGD
+
+	# Decode a piece of a base64 message.  Pieces can end part way through a
+	# 4 character group, so the leftover characters wait for the next piece
+	def _decode_base64(self, data, final):
+		data = self._b64carry + bytes(data)
+		usable = len(data)
+		if not final:
+			usable -= usable % 4
+		self._b64carry = data[usable:]
+		try:
+			return base64.b64decode(data[:usable])
+		except (TypeError, ValueError):
+			# binascii.Error is a ValueError, or a TypeError before Python 3
+			raise ProtocolError("Received invalid base64 file data",
 													"Segment Error: -1")
-		return self.ST_FILESEGM
 
 	# Send a message over the websocket connection
 	def _send_msg(self, data, opcode=None):
@@ -159,9 +560,9 @@ class Websocket():
 			pass
 		elif len(data) < 126:
 			frame[1] = frame[1] | len(data)
-		elif len(data) < 65535:
+		elif len(data) <= 65535:
 			frame[1] = frame[1] | 126
-			packed = struct.pack(">I", len(data))
+			packed = struct.pack(">H", len(data))
 			frame.extend(packed)
 		else:
 			frame[1] = frame[1] | 127
@@ -181,38 +582,113 @@ class Websocket():
 					 tries < maxtries):
 			tries += 1
 			try:
-				self._curbuf.extend(bytearray(self._conn.recv(1024*256)))
+				received = self._curbuf.recv_into(self._conn, amount)
+				if received == 0:
+					break  # The client hung up
+				self._metrics.add(Metrics.RECEIVED, received)
+				self._pay_recv(received)
 			except socket.error:
 				tocount += 1
+			except BufferError:
+				raise ProtocolError("Upload exceeded the memory limit", "Invalid: -1")
 		if len(self._curbuf) < amount:
-			raise ProtocolError("Socket timeout waiting for frame header",
+			raise ProtocolError("Socket timeout waiting for frame data",
 													"Timeout: -1")
 
-	# Return a byte array representing one single websocket frame
-	def _get_frame(self):
-		# TODO: handle fin set case - namely, if it's not set
-		# Receive the header
-		self._recv_data(2)
-		headerlen = self._get_headerlen(self._curbuf)
-		self._recv_data(headerlen)
-		datalen = self._get_datalen(self._curbuf)
-		framesize = headerlen + datalen
-
-		# Receive the entire frame
-		self._recv_data(framesize)
-		frame = self._curbuf[0:framesize]
-		del self._curbuf[0:framesize]
-		opcode = self._get_opcode(frame)
-		data = frame[headerlen:]
-		# If there's a mask bit, unmask the frame
-		if self._test_mask(frame):
-			maskpos = headerlen - 4
-			mask = frame[maskpos:(maskpos+4)]
-			for i, byte in enumerate(data):
-				data[i] = byte ^ mask[i%4]
-		else:
+	# Pay the receive rate limits for amount bytes received, by waiting if need
+	# be.  The client's sends back up meanwhile, which slows it down
+	def _pay_recv(self, amount):
+		client = self._addr[0] if self._addr else None
+		delay = self._limiter.take(RateLimiter.RECV, client, amount)
+		if delay > 0:
+			time.sleep(delay)
+
+	# Return the next piece of a message, receiving until there is one
+	def _get_piece(self):
+		piece = self._next_buffered_piece()
+		while piece is None:
+			self._recv_data(len(self._curbuf) + 1)
+			piece = self._next_buffered_piece()
+		return piece
+
+	# Return the next piece of a message that's already been received, or None
+	def _next_buffered_piece(self):
+		piece = self._parse_piece()
+		while piece is None and self._pendingpos < len(self._pending):
+			# Move data received early into the buffer a little at a time, so the
+			# buffer stays within its limit however much there is
+			end = self._pendingpos + self._piecesize
+			self._curbuf.extend(self._pending[self._pendingpos:end])
+			self._pendingpos = end
+			piece = self._parse_piece()
+		return piece
+
+	# Return the next piece of a message in the buffer as (opcode, data, final),
+	# or None if more needs to arrive first.  Data frames are handed out in
+	# pieces of at least _piecesize, or whatever ends the frame.  Control frames
+	# are only handed out whole.  The data is only valid until more is received
+	def _parse_piece(self):
+		if self._frame is None:
+			self._frame = self._parse_header()
+			if self._frame is None:
+				return None
+		frame = self._frame
+		amount = min(len(self._curbuf), frame.remaining)
+		if amount < frame.remaining and (frame.opcode >= self.OP_CLOS or
+																		 amount < self._piecesize):
+			return None
+		data = self._curbuf.take(amount)
+		unmask(data, frame.take_mask(amount))
+		if frame.remaining > 0:
+			return self._msgopcode, data, False
+		self._frame = None
+		if frame.opcode >= self.OP_CLOS:
+			return frame.opcode, data, True
+		opcode = self._msgopcode
+		if frame.fin:
+			self._msgopcode = None
+		return opcode, data, frame.fin
+
+	# Consume the next frame header from the buffer and return it as a _Frame,
+	# or None if it hasn't all arrived
+	def _parse_header(self):
+		if len(self._curbuf) < 2:
+			return None
+		header = self._curbuf.peek(_MAX_HEADER)
+		headerlen = self._get_headerlen(header)
+		if len(self._curbuf) < headerlen:
+			return None
+		if not self._test_mask(header):
 			raise ProtocolError("Mask bit was not set", "Invalid: -1")
-		return opcode, data
+		self._curbuf.consume(headerlen)
+		opcode = self._get_opcode(header)
+		fin = self._test_fin(header)
+		length = self._get_datalen(header)
+		maskpos = headerlen - 4
+		# Only the first frame of a compressed message has the RSV1 bit set
+		compressed = self._test_rsv(header, 1)
+		if self._test_rsv(header, 2) or self._test_rsv(header, 3):
+			raise ProtocolError("Reserved bits set", "Invalid: -1")
+		elif compressed and (self._inflater is None or opcode == self.OP_CONT or
+												 opcode >= self.OP_CLOS):
+			raise ProtocolError("Unexpected compressed frame", "Invalid: -1")
+		if opcode == self.OP_OTH:
+			raise ProtocolError("Received a reserved opcode", "Invalid: -1")
+		elif opcode >= self.OP_CLOS:
+			# Control frames may arrive between the fragments of a message
+			if not fin or length > _MAX_CONTROL_PAYLOAD:
+				raise ProtocolError("Invalid control frame", "Invalid: -1")
+		elif opcode == self.OP_CONT:
+			if self._msgopcode is None:
+				raise ProtocolError("Continuation frame without a message",
+														"Invalid: -1")
+		elif self._msgopcode is not None:
+			raise ProtocolError("New message before the last one finished",
+													"Invalid: -1")
+		else:
+			self._msgopcode = opcode
+			self._msgcompressed = compressed
+		return _Frame(opcode, fin, bytes(header[maskpos:headerlen]), length)
 
 	# Return true if the mask bit is set
 	def _test_mask(self, data):
@@ -228,7 +704,7 @@ class Websocket():
 
 	# Return true if the specified rsv bit is set
 	def _test_rsv(self, data, index=1):
-		if (len(data) >= 1 and index > 1 and index < 3 and
+		if (len(data) >= 1 and index >= 1 and index <= 3 and
 				data[0] & (0x80 >> index)):
 			return True
 		return False
@@ -0,0 +1,161 @@
+"""Specifies the WorkerPool class."""
+
+# Standard library imports
+from __future__ import print_function # For python earlier than 3
+import sys
+import threading
+import logging
+if sys.version_info[0] >= 3:
+	import queue
+else:
+	import Queue as queue
+
+# Local imports
+import UserConnection
+import Metrics
+
+# Connections being turned away wait for the rejecting thread in a queue this
+# long.  Past that they're just closed
+_REJECT_QUEUE_SIZE = 100
+
+class WorkerPool():
+	"""Handle connections with a fixed number of threads.
+
+	Accepted connections wait in a bounded queue for a free worker.  When the
+	queue is full, new connections are turned away immediately instead of
+	piling up, so a burst slows everyone down a little rather than exhausting
+	the server.  Turning a connection away means reading its request, so a
+	thread of its own does that, and a slow client never holds up accepting.
+	Idle kept-alive connections are closed while others are queued, so they
+	never keep a worker from a connection with a request to answer.
+
+	Data items:
+		stats - get - A dictionary of queue depth, busy workers, and counts of
+						handled and rejected connections, for sizing the pool
+
+	"""
+
+	def __init__(self, settings, numthreads, queuesize):
+		"""Setup a pool of numthreads workers, fed by a queue of queuesize."""
+		self._settings = settings
+		self._queue = queue.Queue(queuesize)
+		self._lock = threading.Lock()	# Protects the counters below
+		self._busy = 0
+		self._handled = 0
+		self._rejected = 0
+		self._freeing = 0	# Workers closing idle connections for queued ones
+		self._threads = list()
+		for i in range(numthreads):
+			self._threads.append(threading.Thread(target=self._work))
+		self._rejects = queue.Queue(_REJECT_QUEUE_SIZE)
+		self._rejecter = threading.Thread(target=self._reject_queued)
+
+	def start(self):
+		"""Start all the worker threads, and show the pool's stats in the
+			metrics."""
+		for thread in self._threads:
+			thread.start()
+		self._rejecter.start()
+		Metrics.shared(self._settings).add_collector(self._collect_metrics)
+
+	def stop(self):
+		"""Let the workers exit once they finish the queued connections."""
+		for thread in self._threads:
+			self._queue.put(None)
+		self._rejects.put(None)
+
+	def submit(self, conn, addr):
+		"""Queue a connection for a worker, or reject it if the queue is full.
+
+			Returns True if the connection was queued.  Rejection never blocks.
+
+		"""
+		handler = UserConnection.UserConnection(self._settings, conn, addr,
+																						self._yield_idle)
+		try:
+			self._queue.put_nowait(handler)
+		except queue.Full:
+			with self._lock:
+				self._rejected += 1
+				rejected = self._rejected
+			logging.warning("%s: Server busy, connection rejected "
+											"(%d queued, %d rejected)", addr,
+											self._queue.qsize(), rejected)
+			try:
+				self._rejects.put_nowait(handler)
+			except queue.Full:
+				conn.close()	# Too busy even to say so
+			return False
+		return True
+
+	# Each worker thread runs this, handling connections until told to stop
+	def _work(self):
+		while True:
+			handler = self._queue.get()
+			if handler is None:
+				break
+			with self._lock:
+				self._busy += 1
+				self._freeing = max(self._freeing - 1, 0)
+			try:
+				handler.run()
+			except Exception:
+				# Keep this worker alive regardless.  run has logged the error, but
+				# not where it came from
+				logging.exception("Error handling a connection")
+			finally:
+				with self._lock:
+					self._busy -= 1
+					self._handled += 1
+
+	# Idle kept-alive connections call this now and then.  Return True if the
+	# connection should close so its worker can take a queued one.  Only one
+	# worker is freed for each queued connection
+	def _yield_idle(self):
+		with self._lock:
+			if self._queue.qsize() > self._freeing:
+				self._freeing += 1
+				return True
+			return False
+
+	# The rejecting thread runs this, turning connections away until told to
+	# stop
+	def _reject_queued(self):
+		while True:
+			handler = self._rejects.get()
+			if handler is None:
+				break
+			try:
+				handler.reject()
+			except Exception:
+				logging.exception("Error turning a connection away")
+
+	# Return a snapshot of the pool's counters
+	def _get_stats(self):
+		with self._lock:
+			return {"queuedepth": self._queue.qsize(),
+							"queuesize": self._queue.maxsize,
+							"workers": len(self._threads),
+							"busyworkers": self._busy,
+							"handled": self._handled,
+							"rejected": self._rejected}
+
+	# Return the pool's stats as metrics, for Metrics to show
+	def _collect_metrics(self):
+		stats = self._get_stats()
+		return [("frontporch_pool_queued_connections", Metrics.GAUGE,
+						 "Connections waiting for a worker thread.", stats["queuedepth"]),
+						("frontporch_pool_queue_size", Metrics.GAUGE,
+						 "Connections that can wait before more are turned away.",
+						 stats["queuesize"]),
+						("frontporch_pool_workers", Metrics.GAUGE,
+						 "Worker threads in the pool.", stats["workers"]),
+						("frontporch_pool_busy_workers", Metrics.GAUGE,
+						 "Worker threads handling a connection now.", stats["busyworkers"]),
+						("frontporch_pool_handled_total", Metrics.COUNTER,
+						 "Connections the pool's workers have handled.", stats["handled"]),
+						("frontporch_pool_rejected_total", Metrics.COUNTER,
+						 "Connections turned away because the queue was full.",
+						 stats["rejected"])]
+
+	stats = property(_get_stats)
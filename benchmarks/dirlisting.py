@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+"""Measure how long listing a large directory takes.
+
+Run from anywhere: python benchmarks/dirlisting.py [--entries N] [--dir PATH]
+A directory of N empty files (100000 by default) is made inside PATH (the
+system temp directory by default), timed, then removed.  Point --dir at an
+NFS mount to see the cost there, where every stat is a network round trip.
+The "listdir + 3 stats" method is how listings were built before scandir,
+and "full JSON listing" is what was sent before listings were paged.
+
+"""
+
+# Standard library imports
+from __future__ import print_function # For python earlier than 3
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# Local imports
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+																os.pardir))
+import DirCache
+import DirListing
+import UserConnection
+
+RUNS = 3	# Report the best of this many runs
+
+# The old enumeration - a stat, then isfile and isdir stat again
+def listdir_stats(dirname):
+	count = 0
+	for filename in os.listdir(dirname):
+		fullpath = os.path.join(dirname, filename)
+		os.stat(fullpath)
+		os.path.isfile(fullpath)
+		os.path.isdir(fullpath)
+		count += 1
+	return count
+
+def scan(dirname):
+	count = 0
+	for entry in DirListing.scan(dirname):
+		count += 1
+	return count
+
+# Return the JSON for every entry in a listing, as was sent before paging
+def full_json(connection, listing):
+	total, entries = listing.page()
+	contents = [connection._file_info("/", name, filetype, size, atime, mtime)
+							for name, filetype, size, atime, mtime, changed in entries]
+	return json.dumps({"dirname": "/", "contents": contents})
+
+# Return the JSON for the first page of a listing
+def first_page(connection, listing):
+	total, entries = listing.page(0, 500)
+	contents = [connection._file_info("/", name, filetype, size, atime, mtime)
+							for name, filetype, size, atime, mtime, changed in entries]
+	return json.dumps({"dirname": "/", "total": total, "contents": contents})
+
+# Return the best time function(dirname) takes
+def measure(function, dirname):
+	best = None
+	for run in range(RUNS):
+		start = time.time()
+		function(dirname)
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+def main():
+	parser = argparse.ArgumentParser(description="Time large directory listings")
+	parser.add_argument("--entries", type=int, default=100000,
+											help="how many files to list")
+	parser.add_argument("--dir", default=None,
+											help="where to make the test directory, e.g. an NFS mount")
+	args = parser.parse_args()
+
+	testdir = tempfile.mkdtemp(prefix="fp-dirlisting-", dir=args.dir)
+	try:
+		print("Making", args.entries, "files in", testdir)
+		for i in range(args.entries):
+			open(os.path.join(testdir, "file%07d.bin" % i), "w").close()
+		settings = {"basedir": os.path.dirname(testdir)}
+		connection = UserConnection.UserConnection(settings, None, None)
+		# Listings of just changed directories aren't trusted, so backdate it
+		backdated = time.time() - 60
+		os.utime(testdir, (backdated, backdated))
+		cache = DirCache.DirCache(1024*1024*1024)
+		cached = lambda dirname: cache.get(dirname, DirListing.Listing,
+																			 connection._listing_size)
+		cached(testdir)
+		methods = [("listdir + 3 stats", listdir_stats),
+							 ("scandir", scan),
+							 ("full JSON listing", lambda dirname:
+									full_json(connection, DirListing.Listing(dirname))),
+							 ("first page", lambda dirname:
+									first_page(connection, DirListing.Listing(dirname))),
+							 ("cached first page", lambda dirname:
+									first_page(connection, cached(dirname)))]
+		if DirListing.scandir is None:
+			print("scandir isn't available - scan falls back on listdir and stat")
+		for name, function in methods:
+			elapsed = measure(function, testdir)
+			print("{0:<20}{1:>10.3f} s".format(name, elapsed))
+	finally:
+		shutil.rmtree(testdir)
+
+if __name__ == "__main__":
+	main()
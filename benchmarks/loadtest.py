@@ -0,0 +1,453 @@
+#! /usr/bin/env python
+"""Load test a running server: downloads, listings and uploads.
+
+Run from anywhere: python benchmarks/loadtest.py [--output FILE] [options]
+The server is started on a free loopback port, serving a temporary root of
+test files, and driven by clients in this process:
+
+	downloads - every client downloads the same file over and over on a
+							kept-alive connection, for each file size
+	listings - every client fetches the first listing page of a directory,
+						 for each entry count.  The first, uncached, fetch is timed too
+	uploads - one websocket upload at a time, in binary and base64 segments
+
+Downloads and listings run --concurrency clients for --seconds each, and
+report throughput with p50 and p99 latency.  Results go to --output as JSON,
+so runs from different releases can be compared.  Use --python to run the
+server under another interpreter, e.g. python2.
+
+"""
+
+# Standard library imports
+from __future__ import print_function # For python earlier than 3
+import argparse
+import base64
+import json
+import math
+import os
+import platform
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Local imports
+REPODIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, REPODIR)
+import Websocket
+
+SERVER_START_TIMEOUT = 10	# Seconds to wait for the server to listen
+CLIENT_TIMEOUT = 30	# Seconds a client waits on the server before giving up
+RECV_SIZE = 256*1024
+# Results are numbered so a change of layout doesn't go unnoticed
+RESULTS_VERSION = 1
+
+class ServerError(Exception):
+	"""The server under test didn't start, or didn't answer as expected."""
+	pass
+
+class Server():
+	"""Run frontPorch.py on a free loopback port, serving root."""
+
+	def __init__(self, python, root, settings):
+		self.root = root
+		self.port = free_port()
+		self._inifile = os.path.join(root, os.pardir, "loadtest.ini")
+		with open(self._inifile, "w") as f:
+			f.write("[Settings]\nlistenhost = 127.0.0.1\n")
+			for name, value in sorted(settings.items()):
+				f.write("{0} = {1}\n".format(name, value))
+		self._process = subprocess.Popen(
+			[python, "frontPorch.py", "-r", root, "-p", str(self.port),
+			 "-c", self._inifile],
+			cwd=REPODIR, stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+		deadline = time.time() + SERVER_START_TIMEOUT
+		while True:
+			try:
+				socket.create_connection(("127.0.0.1", self.port), 1).close()
+				break
+			except socket.error:
+				if self._process.poll() is not None or time.time() > deadline:
+					self.stop()
+					raise ServerError("The server didn't start")
+				time.sleep(0.1)
+
+	def stop(self):
+		"""Interrupt the server, the way ctrl-c does, and wait for it."""
+		if self._process.poll() is None:
+			self._process.send_signal(signal.SIGINT)
+			deadline = time.time() + 10
+			while self._process.poll() is None and time.time() < deadline:
+				time.sleep(0.1)
+			if self._process.poll() is None:
+				self._process.kill()
+				self._process.wait()
+
+	def connect(self):
+		"""Return a new connection to the server."""
+		conn = socket.create_connection(("127.0.0.1", self.port), CLIENT_TIMEOUT)
+		conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		return conn
+
+class HTTPClient():
+	"""Send GET requests over one kept-alive connection, reconnecting when
+	the server closes it."""
+
+	def __init__(self, server):
+		self._server = server
+		self._conn = None
+		self._buf = bytearray()
+
+	def get(self, path):
+		"""Request path and read the whole response.  Returns the status code
+			and the length of the body."""
+		if self._conn is None:
+			self._conn = self._server.connect()
+			self._buf = bytearray()
+		self._conn.sendall(("GET " + path + " HTTP/1.1\r\nHost: loadtest\r\n\r\n")
+											 .encode("ascii"))
+		while b"\r\n\r\n" not in self._buf:
+			self._recv()
+		end = self._buf.index(b"\r\n\r\n")
+		lines = bytes(self._buf[:end]).decode("iso-8859-1").split("\r\n")
+		del self._buf[:end + 4]
+		status = int(lines[0].split()[1])
+		fields = dict()
+		for line in lines[1:]:
+			name, sep, value = line.partition(":")
+			fields[name.strip().lower()] = value.strip()
+		length = int(fields.get("content-length", 0))
+		# Count the body without keeping it
+		remaining = length - len(self._buf)
+		del self._buf[:length]
+		while remaining > 0:
+			remaining -= self._recv(remaining)
+		if fields.get("connection", "").lower() == "close":
+			self.close()
+		return status, length
+
+	def close(self):
+		"""Close the connection."""
+		if self._conn is not None:
+			self._conn.close()
+			self._conn = None
+
+	# Receive some data.  What's wanted beyond the body's end is buffered
+	def _recv(self, wanted=None):
+		data = self._conn.recv(RECV_SIZE)
+		if not data:
+			self.close()
+			raise ServerError("The server closed the connection mid-response")
+		if wanted is not None and len(data) <= wanted:
+			return len(data)
+		if wanted is not None:
+			self._buf.extend(data[wanted:])
+			return wanted
+		self._buf.extend(data)
+		return len(data)
+
+class UploadClient():
+	"""Upload a file over a websocket, the way UploaderWS.js does."""
+
+	def __init__(self, server):
+		self._server = server
+		self._conn = None
+		self._buf = b""
+
+	def upload(self, path, data, segmentsize, textsegments=False):
+		"""Upload data to path in segments, as base64 text if textsegments.
+			Raises ServerError unless the server says it finished."""
+		self._conn = self._server.connect()
+		try:
+			self._handshake(path)
+			self._send(Websocket.Websocket.OP_TEXT,
+								 ("Filesize: %d" % len(data)).encode("ascii"))
+			self._expect(b"Permitted")
+			for start in range(0, len(data), segmentsize):
+				segment = data[start:start + segmentsize]
+				self._send(Websocket.Websocket.OP_TEXT,
+									 ("Segment Start: %d Segment Finish: %d" %
+										(start, start + len(segment))).encode("ascii"))
+				if textsegments:
+					self._send(Websocket.Websocket.OP_TEXT, base64.b64encode(segment))
+				else:
+					self._send(Websocket.Websocket.OP_BIN, segment)
+			self._send(Websocket.Websocket.OP_TEXT, b"File Finish")
+			self._expect(b"Finished")
+		finally:
+			self._conn.close()
+
+	# Open the websocket
+	def _handshake(self, path):
+		key = base64.b64encode(os.urandom(16)).decode("ascii")
+		self._conn.sendall(("GET " + path + " HTTP/1.1\r\nHost: loadtest\r\n"
+			"Upgrade: websocket\r\nConnection: Upgrade\r\n"
+			"Sec-WebSocket-Key: " + key + "\r\nSec-WebSocket-Version: 13\r\n\r\n")
+			.encode("ascii"))
+		while b"\r\n\r\n" not in self._buf:
+			self._recv()
+		header, sep, self._buf = self._buf.partition(b"\r\n\r\n")
+		if not header.startswith(b"HTTP/1.1 101"):
+			raise ServerError("The websocket wasn't accepted")
+
+	# Send a masked, unfragmented frame, as clients must
+	def _send(self, opcode, payload):
+		mask = os.urandom(4)
+		header = bytearray([0x80 | opcode])
+		if len(payload) < 126:
+			header.append(0x80 | len(payload))
+		elif len(payload) < 65536:
+			header.append(0x80 | 126)
+			header.extend(struct.pack(">H", len(payload)))
+		else:
+			header.append(0x80 | 127)
+			header.extend(struct.pack(">Q", len(payload)))
+		header.extend(mask)
+		payload = bytearray(payload)
+		Websocket.unmask(payload, mask)	# Masking and unmasking are the same
+		self._conn.sendall(bytes(header))
+		self._conn.sendall(payload)
+
+	# Receive a message from the server, and fail unless it starts with text
+	def _expect(self, text):
+		while len(self._buf) < 2:
+			self._recv()
+		length = bytearray(self._buf[1:2])[0] & 0x7F
+		start = 2
+		if length == 126:
+			start = 4
+		elif length == 127:
+			start = 10
+		while len(self._buf) < start:
+			self._recv()
+		if length == 126:
+			length = struct.unpack(">H", self._buf[2:4])[0]
+		elif length == 127:
+			length = struct.unpack(">Q", self._buf[2:10])[0]
+		while len(self._buf) < start + length:
+			self._recv()
+		message = self._buf[start:start + length]
+		self._buf = self._buf[start + length:]
+		if not message.startswith(text):
+			raise ServerError("Expected " + repr(text) + ", got " + repr(message))
+
+	def _recv(self):
+		data = self._conn.recv(RECV_SIZE)
+		if not data:
+			raise ServerError("The server closed the websocket")
+		self._buf += data
+
+# Return a loopback port that nothing is listening on
+def free_port():
+	s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	s.bind(("127.0.0.1", 0))
+	port = s.getsockname()[1]
+	s.close()
+	return port
+
+# Return the pth percentile of sorted values, by the nearest rank method
+def percentile(values, p):
+	if not values:
+		return None
+	rank = int(math.ceil(p / 100.0 * len(values)))
+	return values[max(rank, 1) - 1]
+
+# Run concurrency clients requesting path until seconds pass.  Return the
+# wall time, the sorted latencies, the bytes received and the error count
+def run_load(server, path, concurrency, seconds):
+	latencies = list()
+	totals = {"bytes": 0, "errors": 0}
+	lock = threading.Lock()
+	deadline = time.time() + seconds
+
+	def client():
+		http = HTTPClient(server)
+		mine = list()
+		received = 0
+		errors = 0
+		try:
+			while time.time() < deadline:
+				start = time.time()
+				try:
+					status, length = http.get(path)
+				except (socket.error, ServerError):
+					http.close()
+					errors += 1
+					continue
+				mine.append(time.time() - start)
+				received += length
+				if status != 200:
+					errors += 1
+		finally:
+			http.close()
+			with lock:
+				latencies.extend(mine)
+				totals["bytes"] += received
+				totals["errors"] += errors
+
+	threads = [threading.Thread(target=client) for i in range(concurrency)]
+	start = time.time()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return time.time() - start, sorted(latencies), totals["bytes"], totals["errors"]
+
+# Return a result summarizing a run_load
+def load_result(elapsed, latencies, received, errors):
+	return {"requests": len(latencies),
+					"errors": errors,
+					"seconds": round(elapsed, 3),
+					"requests_per_second": round(len(latencies) / elapsed, 1),
+					"mb_per_second": round(received / elapsed / (1024*1024), 1),
+					"p50_ms": ms(percentile(latencies, 50)),
+					"p99_ms": ms(percentile(latencies, 99)),
+					"max_ms": ms(latencies[-1] if latencies else None)}
+
+def ms(seconds):
+	if seconds is None:
+		return None
+	return round(seconds * 1000, 3)
+
+def bench_downloads(server, sizes, concurrency, seconds):
+	results = list()
+	for size in sizes:
+		name = "download-%d.bin" % size
+		with open(os.path.join(server.root, name), "wb") as f:
+			f.write(os.urandom(size))
+		result = {"size": size}
+		result.update(load_result(*run_load(server, "/" + name, concurrency,
+																				seconds)))
+		report("download %10d B" % size, result)
+		results.append(result)
+	return results
+
+def bench_listings(server, entrycounts, concurrency, seconds):
+	results = list()
+	for entries in entrycounts:
+		dirname = "listing-%d" % entries
+		os.mkdir(os.path.join(server.root, dirname))
+		for i in range(entries):
+			open(os.path.join(server.root, dirname, "file%07d.bin" % i),
+					 "w").close()
+		# Listings of just changed directories aren't cached, so backdate it
+		backdated = time.time() - 60
+		os.utime(os.path.join(server.root, dirname), (backdated, backdated))
+		path = "/(system)/listing?dir=/" + dirname
+		http = HTTPClient(server)
+		start = time.time()
+		status, length = http.get(path)
+		first = time.time() - start
+		http.close()
+		if status != 200:
+			raise ServerError("Listing %s failed with %d" % (dirname, status))
+		result = {"entries": entries, "first_ms": ms(first)}
+		result.update(load_result(*run_load(server, path, concurrency, seconds)))
+		report("listing %10d entries" % entries, result)
+		results.append(result)
+	return results
+
+def bench_uploads(server, size, segmentsize, runs):
+	results = list()
+	data = os.urandom(size)
+	for encoding in ("binary", "base64"):
+		rates = list()
+		for run in range(runs):
+			name = "upload-%s-%d.bin" % (encoding, run)
+			start = time.time()
+			UploadClient(server).upload("/" + name, data, segmentsize,
+																	encoding == "base64")
+			rates.append(size / (time.time() - start) / (1024*1024))
+			os.unlink(os.path.join(server.root, name))
+		rates.sort()
+		result = {"encoding": encoding,
+							"size": size,
+							"segment_size": segmentsize,
+							"runs": runs,
+							"mb_per_second": round(percentile(rates, 50), 1),
+							"best_mb_per_second": round(rates[-1], 1)}
+		print("upload %-10s %10.1f MB/s (best %.1f)" % (encoding,
+			result["mb_per_second"], result["best_mb_per_second"]), file=sys.stderr)
+		results.append(result)
+	return results
+
+# Show a load test result as it's done
+def report(name, result):
+	print("%-28s %10.1f MB/s %8.0f req/s  p50 %8.3f ms  p99 %8.3f ms%s" % (
+		name, result["mb_per_second"], result["requests_per_second"],
+		result["p50_ms"] or 0, result["p99_ms"] or 0,
+		"  %d errors" % result["errors"] if result["errors"] else ""),
+		file=sys.stderr)
+
+# Parse a comma separated list of whole numbers
+def number_list(text):
+	return [int(number) for number in text.split(",") if number.strip()]
+
+def main():
+	parser = argparse.ArgumentParser(description="Load test the server")
+	parser.add_argument("--output", default="-",
+											help="where to write the JSON results (- for stdout)")
+	parser.add_argument("--python", default=sys.executable,
+											help="the interpreter to run the server with")
+	parser.add_argument("--servermode", default="threaded",
+											help="threaded or eventloop")
+	parser.add_argument("--workers", type=int, default=1,
+											help="server worker processes")
+	parser.add_argument("--concurrency", type=int, default=8,
+											help="clients downloading or listing at once")
+	parser.add_argument("--seconds", type=float, default=3.0,
+											help="how long each download and listing test runs")
+	parser.add_argument("--sizes", type=number_list,
+											default=[4096, 65536, 1048576, 16777216],
+											help="download file sizes in bytes, comma separated")
+	parser.add_argument("--entries", type=number_list,
+											default=[100, 1000, 10000],
+											help="listing directory sizes, comma separated")
+	parser.add_argument("--upload-size", type=int, default=32*1024*1024,
+											help="bytes per upload")
+	parser.add_argument("--segment-size", type=int, default=1024*1024,
+											help="bytes per upload segment")
+	parser.add_argument("--upload-runs", type=int, default=3,
+											help="uploads of each encoding")
+	args = parser.parse_args()
+
+	tempdir = tempfile.mkdtemp(prefix="fp-loadtest-")
+	root = os.path.join(tempdir, "root")
+	os.mkdir(root)
+	server = None
+	try:
+		server = Server(args.python, root, {"servermode": args.servermode,
+																				"workers": args.workers})
+		results = {"version": RESULTS_VERSION,
+							 "started": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+							 "client_python": platform.python_version(),
+							 "server_python": args.python,
+							 "platform": platform.platform(),
+							 "servermode": args.servermode,
+							 "workers": args.workers,
+							 "concurrency": args.concurrency,
+							 "seconds": args.seconds}
+		results["downloads"] = bench_downloads(server, args.sizes,
+																					 args.concurrency, args.seconds)
+		results["listings"] = bench_listings(server, args.entries,
+																				 args.concurrency, args.seconds)
+		results["uploads"] = bench_uploads(server, args.upload_size,
+																			 args.segment_size, args.upload_runs)
+	finally:
+		if server is not None:
+			server.stop()
+		shutil.rmtree(tempdir)
+	text = json.dumps(results, indent=2, sort_keys=True)
+	if args.output == "-":
+		print(text)
+	else:
+		with open(args.output, "w") as f:
+			f.write(text + "\n")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,50 @@
+#! /usr/bin/env python
+"""Measure websocket payload unmasking speed for each available method.
+
+Run from anywhere: python benchmarks/unmask.py
+The bytewise method is how payloads were unmasked before the faster methods
+were added.
+
+"""
+
+# Standard library imports
+from __future__ import print_function # For python earlier than 3
+import os
+import sys
+import time
+
+# Local imports
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+																os.pardir))
+import Websocket
+
+SIZES = [("64 KB", 64*1024), ("1 MB", 1024*1024), ("16 MB", 16*1024*1024)]
+MIN_SECONDS = 0.5	# Repeat each measurement for at least this long
+
+# Return the MB/s that method unmasks a payload of size bytes at
+def measure(method, size):
+	data = bytearray(os.urandom(size))
+	mask = bytearray(os.urandom(4))
+	runs = 0
+	start = time.time()
+	elapsed = 0
+	while elapsed < MIN_SECONDS:
+		method(data, mask)
+		runs += 1
+		elapsed = time.time() - start
+	return (size * runs) / elapsed / (1024*1024)
+
+def main():
+	methods = [("bytewise", Websocket._unmask_bytewise),
+						 ("translate", Websocket._unmask_translate)]
+	if Websocket.numpy is not None:
+		methods.append(("numpy", Websocket._unmask_numpy))
+	print("{0:<10}".format("MB/s") +
+				"".join("{0:>12}".format(name) for name, size in SIZES))
+	for name, method in methods:
+		results = [measure(method, size) for sizename, size in SIZES]
+		print("{0:<10}".format(name) +
+					"".join("{0:>12.1f}".format(result) for result in results))
+
+if __name__ == "__main__":
+	main()
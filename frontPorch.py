@@ -8,7 +8,10 @@
 from __future__ import print_function  # For python earlier than 3
 import signal
 import socket
+import threading
 import sys
+import errno
+import time
 import os.path
 import logging
 if sys.version_info[0] >= 3:
@@ -18,12 +21,16 @@ else:
 
 # Local imports
 import UserConnection
+import EventLoop
+import WorkerPool
+import SysFileCache
 from Error import DataError
 
 # Global variables
 DEFAULTCONFIGFILES = ["/usr/local/etc/frontPorch/fpDefaults.ini",
 									 		"fpDefaults.ini", "frontPorch.ini"]
 interrupted = False
+workerpids = dict()  # Maps worker process ids to the time they started
 
 
 def main():
@@ -44,33 +51,142 @@ def main():
 		return
 	logging.basicConfig(level=logging.INFO)
 
+	# Use SO_REUSEPORT for a listening socket per worker, if it's available
+	numworkers = int(settings.get("workers", 1))
+	reuseport = (numworkers > 1 and hasattr(socket, "SO_REUSEPORT") and
+							 settings.get("reuseport", "no").lower() in ("yes", "true", "1"))
+
 	# Build the IPV4 TCP socket and start listening
+	s = _listen(settings, reuseport)
+	if s is None:
+		return
+
+	# Load the system files before forking, so workers share the one copy
+	SysFileCache.shared(settings)
+
+	# Serve connections until we're interrupted, from worker processes if asked
+	if numworkers > 1 and hasattr(os, "fork"):
+		_supervise(settings, s, numworkers, reuseport)
+	else:
+		_serve(settings, s)
+	# When we're "interrupted"
+	s.close()
+
+# Build the IPV4 TCP listening socket.  Return None if that fails
+def _listen(settings, reuseport=False):
 	try:
 		s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		if reuseport:
+			s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 	except socket.error:
 		logging.critical("Main: Could not setup a socket.")
-		return
+		return None
 	try:
 		s.bind((settings["listenhost"], int(settings["listenport"])))
 	except socket.error:  # Happens when the interface is already bound
 		logging.critical("Main: Listening socket setup failed.  "
 										 "Interface may already be bound.")
-		return
-	s.listen(100)
+		s.close()
+		return None
+	s.listen(int(settings.get("listenbacklog", 100)))
+	return s
 
-	# Accept connections and farm them out to threads
+# Fork worker processes to serve from the socket.  Restart any that die
+def _supervise(settings, s, numworkers, reuseport):
+	global interrupted
+	global workerpids
+	if reuseport:
+		# Each worker listens on its own socket.  Connections the kernel sent to
+		# this one would never be accepted
+		s.close()
+	while not interrupted:
+		# Bring the workers up to strength
+		while len(workerpids) < numworkers and not interrupted:
+			pid = os.fork()
+			if pid == 0:
+				_serve_worker(settings, s, reuseport)
+			workerpids[pid] = time.time()
+			logging.info("Main: Started worker %d", pid)
+		# Wait for one to die.  The SIGINT handler signals them all to exit
+		try:
+			pid, status = os.waitpid(-1, 0)
+		except OSError as e:
+			if e.errno == errno.ECHILD:
+				break
+			continue  # Interrupted by a signal - check interrupted again
+		started = workerpids.pop(pid, None)
+		if started is not None and not interrupted:
+			logging.error("Main: Worker %d died, restarting", pid)
+			if time.time() - started < 1:
+				time.sleep(1)  # Don't spin if workers die as soon as they start
+	# Make sure every worker heard about the interrupt, then let them finish up
+	_signal_workers(signal.SIGINT)
+	while workerpids:
+		try:
+			pid, status = os.waitpid(-1, 0)
+		except OSError as e:
+			if e.errno == errno.ECHILD:
+				break
+			continue
+		workerpids.pop(pid, None)
+
+# The body of a forked worker process.  Never returns
+def _serve_worker(settings, s, reuseport):
+	workerpids.clear()  # Those are the supervisor's to look after
+	if reuseport:
+		# Have the kernel balance connections across a socket per worker
+		s = _listen(settings, reuseport)
+		if s is None:
+			sys.exit(1)
+	_serve(settings, s)
+	s.close()
+	sys.exit(0)
+
+# Serve connections in the configured way until we're interrupted
+def _serve(settings, s):
+	servermode = settings.get("servermode", "threaded")
+	if servermode == "eventloop" and not EventLoop.available():
+		logging.warning("Main: The event loop needs Python 3.4 or later.  "
+										"Using threaded mode.")
+		servermode = "threaded"
+	if servermode == "eventloop":
+		_serve_eventloop(settings, s)
+	else:
+		_serve_threaded(settings, s)
+
+# Accept connections and farm them out to threads
+def _serve_threaded(settings, s):
+	numthreads = int(settings.get("workerthreads", 50))
+	pool = None
+	if numthreads > 0:
+		pool = WorkerPool.WorkerPool(settings, numthreads,
+																 int(settings.get("connectionqueue", 100)))
+		pool.start()
+	# Python 3.5+ retries accept after a signal, so wake up now and then to
+	# notice that we've been interrupted
+	s.settimeout(1)
 	global interrupted
 	while not interrupted:
 		try:
 			conn, addr = s.accept()	# Block while waiting for a connection
-			handler = UserConnection.UserConnection(settings, conn, addr)
-			handler.start()
+			UserConnection.set_nodelay(conn)
+			if pool is not None:
+				pool.submit(conn, addr)
+			else:
+				handler = UserConnection.UserConnection(settings, conn, addr)
+				threading.Thread(target=handler.run).start()
 		except socket.error:
-			# accept will throw this when someone hits ctrl-c - ignore it
+			# accept will throw this when someone hits ctrl-c, or on timeout
 			pass
-	# When we're "interrupted"
-	s.close()
+	if pool is not None:
+		logging.info("Main: Worker pool stats %s", pool.stats)
+		pool.stop()
+
+# Serve every connection from this thread, without blocking on any of them
+def _serve_eventloop(settings, s):
+	loop = EventLoop.EventLoop(settings, s)
+	loop.run(lambda: interrupted)
 
 # Determine the desired configuration.  Throw Exception for invalid args,
 # throw IOError for configfile problems
@@ -152,10 +268,19 @@ def _print_usage():
 	print("\t-c file\tConfiguration File")
 	print("\t-p port\tListen Port")
 
-# Handle the ctrl-c signal
+# Handle the ctrl-c signal.  Pass it through to any worker processes
 def _sigint_handler(signum, frame):
 	global interrupted
 	interrupted = True
+	_signal_workers(signum)
+
+# Send a signal to every worker process
+def _signal_workers(signum):
+	for pid in workerpids:
+		try:
+			os.kill(pid, signum)
+		except OSError:
+			pass  # It already exited
 
 # This sets up main to execute if we've not been included as a module
 if __name__ == "__main__":
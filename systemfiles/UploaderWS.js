@@ -1,10 +1,13 @@
 //This defines a custom websocket object
 //Goes through several states - 
-function UploaderWS(fi, dir, onopen, onmessage, onclose, onerror, onstatusupdate, onfinish) {
+//dg is optional: the file's digest as "sha256:<hex>", if it's already known
+function UploaderWS(fi, dir, onopen, onmessage, onclose, onerror, onstatusupdate, onfinish, dg) {
 	var stvalinc = 0
 	var ST_OPENING = stvalinc++			//Connection is attempting to open
 	var ST_OPENED = stvalinc++			//Connection is open
+	var ST_DEDUPE = stvalinc++			//Asked if the server can skip uploads it has already
 	var ST_FILESIZE = stvalinc++		//Filesize has been sent
+	var ST_RANGES = stvalinc++			//Asked which parts of the file the server has
 	var ST_FILESENDING = stvalinc++	//In process of sending segments
 	var ST_FILEFIN = stvalinc++			//All file segments sent, waiting for server OK
 	var	ST_ERROR = stvalinc++				//Some kind of error received
@@ -32,7 +35,17 @@ function UploaderWS(fi, dir, onopen, onmessage, onclose, onerror, onstatusupdate
 		state = ST_CLOSED
 	}
 	var readpos = 0	//Stores the current position in the file
+	var sentbytes = 0	//Stores how much of the file the server has
 	var oldPercent = 0	//Stores the old percentage, so we can let the user know how far we are
+	var HASH_STEP = 1024*1024	//The file is hashed this much at a time, so memory use stays small
+	var digest = null	//The file's digest as "sha256:<hex>", for the server to check it against
+	var digestPending = null	//A promise that's kept once the digest has been worked out
+	if(typeof dg === "string") {
+		digest = dg
+	} else if(state != ST_CLOSED && typeof Promise !== "undefined" && typeof SHA256 !== "undefined" &&
+			(file.slice || file.webkitSlice || file.mozSlice)) {
+		digestPending = hashFile()
+	}
 	if( dir[0] != "/" ) {
 		dir = "/" + dir
 	}
@@ -56,7 +69,13 @@ function UploaderWS(fi, dir, onopen, onmessage, onclose, onerror, onstatusupdate
 	socket.onopen = function() {	//After the websocket opens do this
 		state = ST_OPENED
 		outputStatus = uploader.startUpload()	//Start the upload
-		onopen("Opened") //Run the requested onopen event
+		//Browsers offer permessage-deflate themselves.  If the server took it up,
+		//everything sent is compressed on the way, base64 text included
+		if(socket.extensions && socket.extensions.indexOf("permessage-deflate") != -1) {
+			onopen("Opened (compressed)")
+		} else {
+			onopen("Opened") //Run the requested onopen event
+		}
 	}
 	socket.onmessage = function(message) {	//Whenever websocket receives a message...
 		outputStatus = uploader.handleMessage(message)	//Call the message handler func
@@ -73,10 +92,35 @@ function UploaderWS(fi, dir, onopen, onmessage, onclose, onerror, onstatusupdate
 	}
 	//End Initialization
 
+	//Work out the file's SHA-256 digest, for the server to check the upload
+	//against.  If it can't be, the upload just goes without one
+	function hashFile() {
+		var slicer = file.slice || file.webkitSlice || file.mozSlice
+		var hasher = new SHA256()
+		var reader = new FileReader()
+		var pos = 0
+		return new Promise(function(resolve) {
+			reader.onload = function(e) {	//Hash each piece as it's read, then read the next
+				hasher.update(e.target.result)
+				pos += HASH_STEP
+				if(pos < file.size) {
+					reader.readAsArrayBuffer(slicer.call(file, pos, Math.min(pos+HASH_STEP, file.size)))
+				} else {
+					digest = "sha256:" + hasher.hexDigest()
+					resolve()
+				}
+			}
+			reader.onerror = function() {	//Upload without a digest
+				resolve()
+			}
+			reader.readAsArrayBuffer(slicer.call(file, 0, Math.min(HASH_STEP, file.size)))
+		})
+	}
+
 	//Object Functions
 	//This calls a user specified function with an updated upload percentage
 	this.updateStatus = function() {	
-		newPercent = Math.floor((readpos / file.size)*100)
+		newPercent = file.size > 0 ? Math.floor((sentbytes / file.size)*100) : 100
 		if( newPercent != oldPercent ) {
 			oldPercent = newPercent
 			onstatusupdate(newPercent)
@@ -96,11 +140,21 @@ function UploaderWS(fi, dir, onopen, onmessage, onclose, onerror, onstatusupdate
 		interval = 0
 	}
 
-	//Begin to upload a file
+	//Begin to upload a file.  If the digest is known it goes with the file size,
+	//so that if the server has the same file already it needn't be sent.  If
+	//it's still being worked out, first ask whether that's worth waiting for
 	this.startUpload = function() {
 		outputStatus = ""
-		if(this.socketIsValid() && state == ST_OPENED) {
-			socket.send("Filesize: " + file.size)	//Send the file size
+		if(this.socketIsValid() && state == ST_OPENED && digestPending !== null) {
+			socket.send("Query Dedupe")
+			state = ST_DEDUPE
+			outputStatus = "Checking"
+		} else if(this.socketIsValid() && (state == ST_OPENED || state == ST_DEDUPE)) {
+			if(digest !== null) {
+				socket.send("Filesize: " + file.size + " Digest: " + digest)
+			} else {
+				socket.send("Filesize: " + file.size)	//Send the file size
+			}
 			state = ST_FILESIZE	//Next, wait for a server response
 			outputStatus = "Filesize sent"
 		} else {	//Generally occurs when we're in the wrong state
@@ -118,25 +172,70 @@ function UploaderWS(fi, dir, onopen, onmessage, onclose, onerror, onstatusupdate
 			if(message.data == "Invalid: -1") {
 				state = ST_ERROR
 				this.handleError("Invalid Characters in Filename")
+			} else if(message.data == "Busy: -1") {
+				state = ST_ERROR
+				this.handleError("Server is busy.  Try again later.")
 			} else {
 				state = ST_ERROR
 				this.handleError("Message Received Before Filesize Sent")
 			}
+		} else if(state == ST_DEDUPE) {
+			if(message.data == "Dedupe: yes" && digestPending !== null) {	//Wait for the digest
+				outputStatus = "Hashing"
+				digestPending.then(function() {
+					digestPending = null
+					uploader.startUpload()
+				})
+			} else if(message.data == "Dedupe: yes" || message.data == "Dedupe: no") {
+				//The digest goes with File Finish instead, if it's ready by then
+				outputStatus = this.startUpload()
+			} else if(message.data == "Invalid: -1") {
+				state = ST_ERROR
+				this.handleError("Invalid Characters in Filename")
+			} else if(message.data == "Busy: -1") {
+				state = ST_ERROR
+				this.handleError("Server is busy.  Try again later.")
+			} else {	//Some odd error
+				state = ST_ERROR
+				this.handleError("While Checking For Deduplication: " + message.data)
+			}
 		} else if(state==ST_FILESIZE) {
-			if(message.data == "Permitted") {	//Good to go!
-				outputStatus = "Sending"
-				state = ST_FILESENDING
-				this.sendFile()
+			if(message.data == "Permitted") {	//Good to go!  Find out if we're resuming
+				outputStatus = "Checking"
+				state = ST_RANGES
+				socket.send("Query Ranges")
+			} else if(message.data == "Already Have") {	//The server had the same file, so it's done
+				outputStatus = "File Sent"
+				sentbytes = file.size
+				uploader.updateStatus()
+				state = ST_CLOSING
+				this.close()
+				onfinish()
 			} else if(message.data == "Invalid: -1") {
 				state = ST_ERROR
 				this.handleError("Invalid Characters in Filename")
 			} else if(message.data == "Not Permitted: -1") {
 				state = ST_ERROR
 				this.handleError("File already exists on server.")
+			} else if(message.data == "Not Permitted: -3") {
+				state = ST_ERROR
+				this.handleError("File is already being uploaded.")
+			} else if(message.data == "Busy: -1") {
+				state = ST_ERROR
+				this.handleError("Server is busy.  Try again later.")
 			} else {	//Some odd error
 				state = ST_ERROR
 				this.handleError("Before Filesize Response Received: " + message.data)
 			}
+		} else if(state == ST_RANGES) {
+			if(message.data.indexOf("Ranges:") == 0) {	//Send only what's missing
+				outputStatus = "Sending"
+				state = ST_FILESENDING
+				this.sendFile(this.missingRanges(message.data))
+			} else {	//Some kind of error
+				state = ST_ERROR
+				this.handleError("While Checking For A Partial Upload: " + message.data)
+			}
 		} else if(state == ST_FILESENDING ) {	//Messages while sending the file are errors
 			if(message.data == "Invalid: -1") {
 				state = ST_ERROR
@@ -151,12 +250,23 @@ function UploaderWS(fi, dir, onopen, onmessage, onclose, onerror, onstatusupdate
 				state = ST_CLOSING
 				this.close()
 				onfinish()
+			} else if(message.data == "Segments Received") {	//Another upload of the file will finish it
+				outputStatus = "Segments Sent"
+				state = ST_CLOSING
+				this.close()
+				onfinish()
 			} else if(message.data == "Finish Error: -1") {
 				state = ST_ERROR
 				this.handleError("File storage error on server.")
 			} else if(message.data == "Finish Error: -2") {
 				state = ST_ERROR
 				this.handleError("Error during file transfer.  Transfer failed.")
+			} else if(message.data == "Digest Error: -1") {
+				state = ST_ERROR
+				this.handleError("File was corrupted on the way.  Please upload it again.")
+			} else if(message.data == "Digest Error: -2") {
+				state = ST_ERROR
+				this.handleError("Server can't check the file's digest.")
 			} else if(message.data == "Invalid: -1") {
 				state = ST_ERROR
 				this.handleError("Error during file transfer.  Transfer failed.")
@@ -181,9 +291,40 @@ function UploaderWS(fi, dir, onopen, onmessage, onclose, onerror, onstatusupdate
 		return (typeof socket !== "undefined" && socket.readyState == OPEN)
 	}
 
-	this.sendFile = function() {
+	//Work out which [start, end) parts of the file still need sending, from
+	//a "Ranges: 0-100,200-300" message listing the parts the server already has
+	this.missingRanges = function(message) {
+		var missing = []
+		var pos = 0
+		var list = message.replace("Ranges:", "").replace(/\s/g, "")
+		var ranges = list.length > 0 ? list.split(",") : []
+		for(var i = 0; i < ranges.length; i++) {
+			var bounds = ranges[i].split("-")
+			var start = parseInt(bounds[0], 10)
+			if(start > pos) {
+				missing.push([pos, start])
+			}
+			pos = Math.max(pos, parseInt(bounds[1], 10))
+		}
+		if(pos < file.size) {
+			missing.push([pos, file.size])
+		}
+		return missing
+	}
+
+	this.sendFile = function(missing) {
 		if(this.socketIsValid() && state == ST_FILESENDING) {
-			readpos = 0
+			var rangeidx = 0	//Which missing range is being sent
+			var end = 0
+			sentbytes = file.size
+			for(var i = 0; i < missing.length; i++) {
+				sentbytes -= missing[i][1] - missing[i][0]
+			}
+			if(missing.length == 0) {	//The server has it all already
+				this.sendFinish()
+				return
+			}
+			readpos = missing[0][0]
 			var slice
 			var stepsize = 0
 			if(file.webkitSlice) {	//If this is supported, we can use WebSocket send on blobs
@@ -213,20 +354,26 @@ function UploaderWS(fi, dir, onopen, onmessage, onclose, onerror, onstatusupdate
 					}
 					uploader.updateStatus()
 					//Send metadata
-					socket.send("Segment Start: ", readpos, " Segment Finish: ", end)
+					socket.send("Segment Start: " + readpos + " Segment Finish: " + end)
 					//Send data
 					socket.send(contents)
-					readpos += stepsize
-					if( readpos < file.size ) {
+					sentbytes += end - readpos
+					readpos = end
+					if( readpos >= missing[rangeidx][1] ) {	//On to the next missing range
+						rangeidx++
+						if( rangeidx < missing.length ) {
+							readpos = missing[rangeidx][0]
+						}
+					}
+					if( rangeidx < missing.length ) {
 						slice()
 					}	else {
-						socket.send("File Finish")
-						state = ST_FILEFIN
+						uploader.sendFinish()
 					}
 				}
 			}
 			slice = function () {
-				end = Math.min(readpos+stepsize, file.size)
+				end = Math.min(readpos+stepsize, missing[rangeidx][1])
 				if(file.webkitSlice) {
 					sliced = file.webkitSlice(readpos, end)
 				} else if(file.mozSlice) {
@@ -250,6 +397,20 @@ function UploaderWS(fi, dir, onopen, onmessage, onclose, onerror, onstatusupdate
 		}
 	}
 
+	//Tell the server the whole file has been sent, with its digest if there is
+	//one.  If it's still being worked out, wait for it
+	this.sendFinish = function() {
+		state = ST_FILEFIN
+		if(digestPending !== null) {
+			digestPending.then(function() {
+				digestPending = null
+				uploader.sendFinish()
+			})
+		} else if(this.socketIsValid()) {
+			socket.send(digest !== null ? "File Finish Digest: " + digest : "File Finish")
+		}
+	}
+
 	this.close = function() {
 		if( state != ST_CLOSING ) {
 			this.handle_error("While Closing")
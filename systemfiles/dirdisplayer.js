@@ -2,33 +2,182 @@ var titletext = "Front Porch"
 var dirname = ""
 var ws = null //This will store the UploaderWS object
 var error_occurred = false
+var listingurl = "/(system)/listing"
+//listing describes what the directory table shows, and how
+var listing = {token: "", total: 0, loaded: 0, limit: 0, sort: "name", order: "asc", filter: ""}
+var rowsByName = {}	//The table rows shown, by file name
+var filterTimer = null
 
 //setNameDiv displays the directory name in the correct place
 function setNameDiv(data, dirnamearea) {
 	dirnamearea.innerHTML = data.dirname
 }
 
-//genFilesTable populates the directory listing table with the json data
+//genFilesTable adds a page of the directory listing json data to the table
 function genFilesTable(data, filetable) {
+	if(data.parent) {
+		fillRow(filetable.insertRow(1), data.parent)
+	}
 	for(var i=0, len=data.contents.length; i<len; i++) {
 		var item = data.contents[i]
 		var row = filetable.insertRow(filetable.rows.length)
-		var cellCount = 0
-		var filenameCell = row.insertCell(cellCount++)
-		var sizeCell = row.insertCell(cellCount++)
-		var modifiedCell = row.insertCell(cellCount++)
-		var accessedCell = row.insertCell(cellCount++)
-		filenameCell.innerHTML = "<a href=\"" + item.fileurl + "\">" + item.filename + "</a>"
-		accessedCell.innerHTML = item.dateaccessed
-		modifiedCell.innerHTML = item.datemodified
-		if( item.type == "file" ) {
-			sizeCell.innerHTML = humanizeSize(item.size)
+		fillRow(row, item)
+		rowsByName[item.filename] = row
+	}
+}
+
+//fillRow fills in (or replaces) a table row's cells for one file
+function fillRow(row, item) {
+	while(row.cells.length > 0) {
+		row.deleteCell(0)
+	}
+	var cellCount = 0
+	var filenameCell = row.insertCell(cellCount++)
+	var sizeCell = row.insertCell(cellCount++)
+	var modifiedCell = row.insertCell(cellCount++)
+	var accessedCell = row.insertCell(cellCount++)
+	filenameCell.innerHTML = "<a href=\"" + item.fileurl + "\">" + item.filename + "</a>"
+	accessedCell.innerHTML = item.dateaccessed
+	modifiedCell.innerHTML = item.datemodified
+	if( item.type == "file" ) {
+		sizeCell.innerHTML = humanizeSize(item.size)
+	}
+	filenameCell.className = "ftname"
+	sizeCell.className = "ftsize"
+	modifiedCell.className = "ftdatem"
+	accessedCell.className = "ftdatea"
+	row.item = item
+}
+
+//clearFilesTable removes every row but the heading
+function clearFilesTable(filetable) {
+	while(filetable.rows.length > 1) {
+		filetable.deleteRow(1)
+	}
+	rowsByName = {}
+	listing.loaded = 0
+}
+
+//showPage adds a page of listing data to the table, emptying it first if reset
+function showPage(data, reset) {
+	var filestable = document.getElementById("filetable")
+	if(reset) {
+		clearFilesTable(filestable)
+	}
+	genFilesTable(data, filestable)
+	listing.loaded += data.contents.length
+	listing.total = data.total
+	listing.limit = data.limit
+	listing.token = data.token
+	listing.sort = data.sort
+	listing.order = data.order
+	showCount()
+}
+
+//showCount says how much of the listing is shown, and offers more if there is
+function showCount() {
+	var more = document.getElementById("morebutton")
+	document.getElementById("listingcount").innerHTML = "Showing " + listing.loaded + " of " + listing.total
+	more.style.display = listing.loaded < listing.total ? "inline" : "none"
+}
+
+//fetchListing requests a page of the listing, and calls callback with it
+function fetchListing(params, callback) {
+	var url = listingurl + "?dir=" + encodeURIComponent(dirname) + "&sort=" + listing.sort + "&order=" + listing.order
+	if(listing.filter != "") {
+		url += "&filter=" + encodeURIComponent(listing.filter)
+	}
+	for(var name in params) {
+		url += "&" + name + "=" + encodeURIComponent(params[name])
+	}
+	var request = new XMLHttpRequest()
+	request.open("GET", url, true)
+	request.onreadystatechange = function() {
+		if(request.readyState == 4 && request.status == 200) {
+			callback(JSON.parse(request.responseText))
+		}
+	}
+	request.send(null)
+}
+
+//loadPage fetches the next page of the listing, or the first one again if reset
+function loadPage(reset) {
+	var offset = reset ? 0 : listing.loaded
+	fetchListing({offset: offset}, function(data) {
+		showPage(data, reset)
+	})
+}
+
+//sortBy is called by the column headings.  Choosing the current sort flips it
+function sortBy(key) {
+	if(listing.sort == key) {
+		listing.order = listing.order == "asc" ? "desc" : "asc"
+	} else {
+		listing.sort = key
+		listing.order = "asc"
+	}
+	loadPage(true)
+}
+
+//filterChanged is called as the filter is typed in, and reloads once it settles
+function filterChanged() {
+	clearTimeout(filterTimer)
+	filterTimer = setTimeout(function() {
+		listing.filter = document.getElementById("namefilter").value
+		loadPage(true)
+	}, 300)
+}
+
+//refreshListing fetches only what changed since the last fetch, and updates
+//the table rows in place.  If that can't account for the new total, say
+//because a file was deleted, it reloads the first page instead
+function refreshListing() {
+	fetchListing({since: listing.token}, function(data) {
+		if(data.contents.length >= data.limit || listing.sort != "name") {
+			loadPage(true)	//Too much changed, or rows may have moved
+			return
+		}
+		var filestable = document.getElementById("filetable")
+		var added = 0
+		var complete = listing.loaded >= listing.total
+		for(var i=0, len=data.contents.length; i<len; i++) {
+			var item = data.contents[i]
+			var row = rowsByName[item.filename]
+			if(row) {
+				fillRow(row, item)
+				continue
+			}
+			var position = findPosition(filestable, item.filename)
+			if(position < filestable.rows.length || complete) {
+				row = filestable.insertRow(position)
+				fillRow(row, item)
+				rowsByName[item.filename] = row
+				listing.loaded++
+				added++
+			}
+		}
+		if(data.total != listing.total + added) {
+			loadPage(true)
+			return
+		}
+		listing.total = data.total
+		listing.token = data.token
+		showCount()
+	})
+}
+
+//findPosition returns where a file name belongs in the table, sorted by name
+function findPosition(filetable, filename) {
+	for(var i=1, len=filetable.rows.length; i<len; i++) {
+		var shown = filetable.rows[i].item
+		if(shown.filename == "..") {
+			continue	//The parent directory always comes first
+		}
+		if(listing.order == "asc" ? filename < shown.filename : filename > shown.filename) {
+			return i
 		}
-		filenameCell.className = "ftname"
-		sizeCell.className = "ftsize"
-		modifiedCell.className = "ftdatem"
-		accessedCell.className = "ftdatea"
 	}
+	return filetable.rows.length
 }
 
 //setTitle sets the titlebar text appropriately
@@ -62,8 +211,7 @@ function processData(data) {
 	var dirnamearea = document.getElementById("dirnamespan")
 	setNameDiv(data,dirnamearea)
 
-	var filestable = document.getElementById("filetable")
-	genFilesTable(data, filestable)
+	showPage(data, true)
 }
 
 //intermedSend gets called with the send button's onclick.  It's just a middle man
@@ -111,8 +259,7 @@ function send(statusbox, percentbar, fileselector) {
 				percentbar.style.width = percent + "%"
 			},
 			function() { //on finish
-				setTimeout(function(){window.location.reload()}, 500)	//Reload the dir, see the new file
-				//TODO: It would be better if we could just make an Ajax call and get the JSON update
+				refreshListing()	//Fetch just the new file's details
 			}
 			)	//end new UploaderWS call
 }
@@ -0,0 +1,90 @@
+//SHA-256, fed a piece at a time so a file never has to be in memory at once.
+//SubtleCrypto can only hash all of something at once, and only on HTTPS
+var sha256K = new Int32Array([
+	0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+	0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+	0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+	0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+	0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+	0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+	0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+	0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2])
+
+function SHA256() {
+	var h = new Uint32Array([0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a,
+		0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19])
+	var w = new Int32Array(64)
+	var K = sha256K	//Globals are slow to look up in the inner loop
+	var block = new Uint8Array(64)	//Bytes waiting for a whole block
+	var blocklen = 0
+	var total = 0	//Bytes hashed so far
+
+	//Mix one 64 byte block, starting at pos in bytes, into the hash
+	function compress(bytes, pos) {
+		for(var i = 0; i < 16; i++, pos += 4) {
+			w[i] = (bytes[pos] << 24) | (bytes[pos+1] << 16) | (bytes[pos+2] << 8) | bytes[pos+3]
+		}
+		for(i = 16; i < 64; i++) {
+			var x = w[i-15], y = w[i-2]
+			var s0 = ((x >>> 7) | (x << 25)) ^ ((x >>> 18) | (x << 14)) ^ (x >>> 3)
+			var s1 = ((y >>> 17) | (y << 15)) ^ ((y >>> 19) | (y << 13)) ^ (y >>> 10)
+			w[i] = (w[i-16] + s0 + w[i-7] + s1) | 0
+		}
+		var a = h[0], b = h[1], c = h[2], d = h[3], e = h[4], f = h[5], g = h[6], k = h[7]
+		for(i = 0; i < 64; i++) {
+			var t1 = k + (((e >>> 6) | (e << 26)) ^ ((e >>> 11) | (e << 21)) ^ ((e >>> 25) | (e << 7))) +
+				((e & f) ^ (~e & g)) + K[i] + w[i] | 0
+			var t2 = (((a >>> 2) | (a << 30)) ^ ((a >>> 13) | (a << 19)) ^ ((a >>> 22) | (a << 10))) +
+				((a & b) ^ (a & c) ^ (b & c)) | 0
+			k = g
+			g = f
+			f = e
+			e = (d + t1) | 0
+			d = c
+			c = b
+			b = a
+			a = (t1 + t2) | 0
+		}
+		h[0] += a; h[1] += b; h[2] += c; h[3] += d
+		h[4] += e; h[5] += f; h[6] += g; h[7] += k
+	}
+
+	//Hash the next piece of the data, an ArrayBuffer or Uint8Array
+	this.update = function(data) {
+		var bytes = new Uint8Array(data)
+		var pos = 0
+		total += bytes.length
+		if(blocklen > 0) {	//Top up the waiting block first
+			while(blocklen < 64 && pos < bytes.length) {
+				block[blocklen++] = bytes[pos++]
+			}
+			if(blocklen < 64) {
+				return
+			}
+			compress(block, 0)
+			blocklen = 0
+		}
+		for(; pos + 64 <= bytes.length; pos += 64) {
+			compress(bytes, pos)
+		}
+		while(pos < bytes.length) {
+			block[blocklen++] = bytes[pos++]
+		}
+	}
+
+	//Finish the hash, returning it as lowercase hex.  Don't update it after
+	this.hexDigest = function() {
+		var bits = total * 8
+		var padding = new Uint8Array((blocklen < 56 ? 64 : 128) - blocklen)
+		padding[0] = 0x80
+		for(var i = 0; i < 8; i++) {	//The length, big-endian, at the very end
+			padding[padding.length-1-i] = Math.floor(bits / Math.pow(2, 8*i)) & 0xff
+		}
+		this.update(padding)
+		var hex = ""
+		for(i = 0; i < 8; i++) {
+			hex += ("0000000" + h[i].toString(16)).slice(-8)
+		}
+		return hex
+	}
+}
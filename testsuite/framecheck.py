@@ -0,0 +1,43 @@
+"""Check the websocket frames sent for replies of each length form."""
+
+# Standard library imports
+from __future__ import print_function # For python earlier than 3
+import os
+import struct
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+																".."))
+from Websocket import Websocket
+
+class _Recorder():
+	"""Stands in for a socket, keeping everything sent on it."""
+
+	def __init__(self):
+		self.sent = bytearray()
+
+	def sendall(self, data):
+		self.sent.extend(data)
+
+# The reply lengths on either side of each length form's limits
+lengths = [0, 125, 126, 200, 65535, 65536]
+failed = False
+for length in lengths:
+	recorder = _Recorder()
+	websocket = Websocket(recorder, ("127.0.0.1", 0), "/", {})
+	websocket._send_msg(b"x" * length)
+	frame = bytes(recorder.sent)
+	field = bytearray(frame[1:2])[0] & 0x7f
+	if field == 126:
+		header = 4
+		sentlength = struct.unpack(">H", frame[2:4])[0]
+	elif field == 127:
+		header = 10
+		sentlength = struct.unpack(">Q", frame[2:10])[0]
+	else:
+		header = 2
+		sentlength = field
+	if sentlength != length or len(frame) != header + length:
+		print("Bad frame for a reply of %d bytes" % length)
+		failed = True
+sys.exit(1 if failed else 0)
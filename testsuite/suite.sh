@@ -102,6 +102,13 @@ testserver() {
 		echo "Fail Text Upload Test"
 	fi
 
+	$1 framecheck.py
+	if [ $? == 0 ]; then
+		echo "Pass Long Reply Test"
+	else
+		echo "Fail Long Reply Test"
+	fi
+
 	if [ "$DEBUG" == "YES" ]; then echo "killing"; fi
 	kill -s SIGINT $serverPID
 	if [ $? != 0 ]; then